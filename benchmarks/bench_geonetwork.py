@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2021 ARC Centre of Excellence for Climate Extremes
+# author: Paola Petrelli <paola.petrelli@utas.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Compare the lxml single pass extractor with the original BeautifulSoup
+one on a corpus of geonetwork ISO19139 records.
+
+Usage:
+  python benchmarks/bench_geonetwork.py <dir, files or globs> [--repeat N]
+
+Each record is converted with both extractors, the plans are checked
+to be identical and the records per second of each are reported.
+'''
+
+import argparse
+import os
+import sys
+import time
+
+ZENMETA = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'zenmeta')
+sys.path.insert(0, ZENMETA)
+
+from geonetwork import (find_files, extract_fields, extract_fields_soup,
+                        convert_fields, file_geo_id)
+
+
+def time_extractor(extractor, corpus, repeat):
+    """Return the best time over repeat runs to extract all the corpus"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for data in corpus.values():
+            extractor(data)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark geonetwork extractors")
+    parser.add_argument('paths', nargs='+', help="xml files, directories or globs")
+    parser.add_argument('--repeat', '-r', type=int, default=3,
+        help="Number of timed runs, best is reported (default 3)")
+    args = parser.parse_args()
+
+    fnames = find_files([os.path.abspath(p) for p in args.paths])
+    # vocabularies are read relative to the zenmeta directory
+    os.chdir(ZENMETA)
+    corpus = {}
+    for fname in fnames:
+        with open(fname, 'rb') as f:
+            corpus[fname] = f.read()
+    # check both extractors give the same plans before timing them
+    mismatch = 0
+    for fname, data in corpus.items():
+        geo_id = file_geo_id(fname)
+        try:
+            soup_plan = convert_fields(extract_fields_soup(data), geo_id)
+        except Exception:
+            continue
+        if convert_fields(extract_fields(data), geo_id) != soup_plan:
+            print(f"Plans differ for {fname}")
+            mismatch += 1
+
+    nrec = len(corpus)
+    soup_time = time_extractor(extract_fields_soup, corpus, args.repeat)
+    lxml_time = time_extractor(extract_fields, corpus, args.repeat)
+    print(f"{nrec} records, {mismatch} mismatches")
+    print(f"BeautifulSoup: {soup_time:.3f} s, {nrec/soup_time:.1f} records/s")
+    print(f"lxml:          {lxml_time:.3f} s, {nrec/lxml_time:.1f} records/s")
+    print(f"Speed up: {soup_time/lxml_time:.1f}x")
+    sys.exit(1 if mismatch else 0)
+
+
+if __name__ == "__main__":
+    main()
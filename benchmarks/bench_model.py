@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2021 ARC Centre of Excellence for Climate Extremes
+# author: Paola Petrelli <paola.petrelli@utas.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+'''
+Compare the memory needed to hold a batch of plans converted to
+Invenio records as dictionaries and as model.Record objects.
+
+Usage:
+  python benchmarks/bench_model.py [--n 100000] [--kind geonetwork]
+
+Plans are generated one at a time and discarded once converted, so
+only the memory retained by the converted batch is measured. The time
+to build the batch and to expand it to the wire format is reported too.
+'''
+
+import argparse
+import time
+import tracemalloc
+
+from synthetic import generate
+
+from invenio import process_invenio_plan
+from model import Record
+
+
+def measure(build, plans):
+    """Return the batch, MB retained and seconds to build it"""
+    tracemalloc.start()
+    start = time.process_time()
+    batch = [build(p) for p in plans]
+    elapsed = time.process_time() - start
+    size = tracemalloc.get_traced_memory()[0] / 2**20
+    tracemalloc.stop()
+    return batch, size, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark record model memory")
+    parser.add_argument('--n', type=int, default=100000,
+        help="Plans in the batch (default 100000)")
+    parser.add_argument('--kind', default='geonetwork',
+        choices=['geonetwork', 'csiro'], help="Kind of synthetic plans")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    # load vocabularies outside the measurements
+    Record(next(generate(args.kind, 1, seed=args.seed)))
+    dicts, dict_mb, dict_s = measure(
+        lambda p: process_invenio_plan(p, "community-id"),
+        generate(args.kind, args.n, seed=args.seed))
+    del dicts
+    records, rec_mb, rec_s = measure(Record,
+        generate(args.kind, args.n, seed=args.seed))
+    start = time.process_time()
+    for r in records:
+        r.to_json("community-id")
+    expand_s = time.process_time() - start
+    print(f"{args.n} {args.kind} plans")
+    print(f"{'dicts':8} {dict_mb:9.1f} MB  built in {dict_s:.2f}s")
+    print(f"{'records':8} {rec_mb:9.1f} MB  built in {rec_s:.2f}s, " +
+          f"expanded in {expand_s:.2f}s")
+    print(f"records use {rec_mb / dict_mb:.0%} of the memory of dicts")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2021 ARC Centre of Excellence for Climate Extremes
+# author: Paola Petrelli <paola.petrelli@utas.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+'''
+Guard the startup time of the zen command line.
+
+Usage:
+  python benchmarks/bench_startup.py [--repeat N] [--max-time SECONDS]
+
+Runs "zen --help" in a new interpreter several times and reports the
+best wall time and the slowest imports. Exits with an error if the
+best time is above --max-time, so it can be used in CI.
+'''
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+ZENMETA = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'zenmeta')
+# modules that should not be imported just to start zen
+HEAVY = ['requests', 'bs4', 'lxml', 'util', 'zenodo', 'invenio']
+
+
+def run_help():
+    """Return the wall time of a zen --help call"""
+    start = time.perf_counter()
+    subprocess.run([sys.executable, 'cli.py', '--help'], cwd=ZENMETA,
+                   stdout=subprocess.DEVNULL, check=True)
+    return time.perf_counter() - start
+
+
+def import_times():
+    """Return cumulative import times in microseconds for each module
+    imported when showing zen help
+    """
+    res = subprocess.run([sys.executable, '-X', 'importtime', 'cli.py', '--help'],
+                         cwd=ZENMETA, stdout=subprocess.DEVNULL,
+                         stderr=subprocess.PIPE, text=True, check=True)
+    times = {}
+    for line in res.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark zen startup time")
+    parser.add_argument('--repeat', '-r', type=int, default=10,
+        help="Number of timed runs, best is reported (default 10)")
+    parser.add_argument('--max-time', type=float, default=0.5,
+        help="Fail if best time in seconds is above this (default 0.5)")
+    parser.add_argument('--top', type=int, default=10,
+        help="Number of slowest imports to show (default 10)")
+    args = parser.parse_args()
+
+    best = min(run_help() for _ in range(args.repeat))
+    times = import_times()
+    print(f"zen --help: best of {args.repeat} runs {best*1000:.1f} ms")
+    print("Slowest imports (cumulative ms):")
+    for name, t in sorted(times.items(), key=lambda x: -x[1])[:args.top]:
+        print(f"  {t/1000:8.1f}  {name}")
+    failed = False
+    heavy = [m for m in HEAVY if m in times]
+    if heavy:
+        print(f"Modules imported at startup that should be lazy: {', '.join(heavy)}")
+        failed = True
+    if best > args.max_time:
+        print(f"Startup time above {args.max_time*1000:.0f} ms limit")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2021 ARC Centre of Excellence for Climate Extremes
+# author: Paola Petrelli <paola.petrelli@utas.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Benchmark the plan transform functions on synthetic plans.
+
+Usage:
+  python benchmarks/bench_transforms.py [--sizes 1000 10000 100000]
+      [--only NAME ...] [--save] [--check] [--tolerance 0.3]
+
+For each function and size the throughput (calls/s) and the peak
+memory allocated by one call are reported. --save stores them in
+benchmarks/baseline.json, --check compares them with the stored
+baseline and exits with an error if a benchmark is slower or
+allocates more than the tolerance allows.
+
+Every run also times a reference workload (a deepcopy of the same
+synthetic plans) and speeds are compared as a ratio to it, so a
+baseline saved on a faster or slower machine can still be checked.
+The ratio is only approximate across python versions and CPUs, if
+--check fails on a clean tree run --save on the checking machine
+first and compare the branch against that.
+'''
+
+import argparse
+import contextlib
+import copy
+import gc
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+from synthetic import ZENMETA, generate
+
+import zenodo
+from invenio import (process_invenio_plan, process_links, process_parties,
+                     convert_v10)
+from util import convert_ror, convert_for, read_vocab
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+CHUNK = 1000
+WARMUP = 100
+# timed in every run, rates are compared relative to this one
+REFERENCE = ('geonetwork', copy.deepcopy)
+
+
+def _to_invenio(plan):
+    # to_invenio prints each record, keep the output out of the report
+    with contextlib.redirect_stdout(io.StringIO()):
+        return zenodo.to_invenio(plan)
+
+
+# name: (generator kind, function of one plan)
+BENCHMARKS = {
+    'process_invenio_plan[geonetwork]': ('geonetwork',
+        lambda p: process_invenio_plan(p, "community-id")),
+    'process_invenio_plan[csiro]': ('csiro',
+        lambda p: process_invenio_plan(p, "community-id")),
+    'process_zenodo_plan': ('zenodo',
+        lambda p: zenodo.process_zenodo_plan(p, "community-id")),
+    'to_invenio': ('zenodo_export', _to_invenio),
+    'convert_v10': ('record_v9', lambda p: convert_v10(p, "community-id")),
+    'process_links': ('geonetwork', lambda p: process_links(p['related_identifiers'])),
+    'process_parties': ('geonetwork', lambda p: process_parties(p['parties'])),
+    'convert_ror': ('geonetwork',
+        lambda p: [convert_ror(x['affiliation']) for x in p['parties']]),
+    'convert_for': ('zenodo_export',
+        lambda p: [convert_for(x['subject']) for x in p['metadata']['subjects']]),
+}
+
+
+def run(kind, func, n, args):
+    """Return calls per second and peak KB allocated per call
+
+    Plans are generated in chunks outside the timed section, as most
+    functions modify their input. The rate uses cpu time and is the
+    median of the chunk rates, so it is less sensitive to other load
+    on the machine. Each run starts from a collected heap and a few
+    untimed calls, so it doesn't pay for the garbage or the cold
+    caches left by the previous benchmark.
+    """
+    zenodo.authors = {}
+    for p in generate(kind, WARMUP, seed=args.seed + 2, parties=args.parties,
+                      links=args.links, subjects=args.subjects):
+        func(p)
+    zenodo.authors = {}
+    gc.collect()
+    rates = []
+    plans = generate(kind, n, seed=args.seed, parties=args.parties,
+                     links=args.links, subjects=args.subjects)
+    done = 0
+    while done < n:
+        chunk = [next(plans) for _ in range(min(CHUNK, n - done))]
+        start = time.process_time()
+        for p in chunk:
+            func(p)
+        rates.append(len(chunk) / max(time.process_time() - start, 1e-9))
+        done += len(chunk)
+        gc.collect()
+    # allocations on a separate pass, tracing slows down the calls
+    zenodo.authors = {}
+    chunk = list(generate(kind, min(n, 200), seed=args.seed + 1,
+                          parties=args.parties, links=args.links,
+                          subjects=args.subjects))
+    tracemalloc.start()
+    peak = 0
+    for p in chunk:
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        func(p)
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - base)
+    tracemalloc.stop()
+    return statistics.median(rates), peak / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark plan transforms")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000],
+        help="Number of plans for each run (default 1000 10000)")
+    parser.add_argument('--only', nargs='+', default=None,
+        choices=list(BENCHMARKS), help="Run only these benchmarks")
+    parser.add_argument('--parties', type=int, default=4,
+        help="Parties per plan (default 4)")
+    parser.add_argument('--links', type=int, default=3,
+        help="Related identifiers per plan (default 3)")
+    parser.add_argument('--subjects', type=int, default=3,
+        help="Keywords and FOR codes per plan (default 3)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', action='store_true',
+        help=f"Save results as baseline in {BASELINE}")
+    parser.add_argument('--check', action='store_true',
+        help="Fail if results are worse than baseline")
+    parser.add_argument('--tolerance', type=float, default=0.3,
+        help="Allowed fraction of slowdown or extra memory (default 0.3)")
+    args = parser.parse_args()
+
+    # vocabularies are loaded once, outside the timings
+    for fname in ('affiliations.json', 'for_map.json', 'CI_RoleCode.json'):
+        read_vocab(fname)
+    baseline = {}
+    if args.check:
+        with open(BASELINE, 'r') as f:
+            saved = json.load(f)
+        baseline = saved['results']
+        if 'reference' not in saved:
+            sys.exit(f"{BASELINE} has no reference rate, save it again")
+    # reference rate of this machine, same sizes as the benchmarks
+    reference = statistics.median(run(*REFERENCE, n, args)[0]
+                                  for n in args.sizes)
+    scale = reference / saved['reference'] if args.check else 1
+    results = {}
+    failed = []
+    print(f"reference {reference:.0f} calls/s, {scale:.2f}x the baseline machine")
+    print(f"{'benchmark':36} {'n':>7} {'calls/s':>10} {'peak KB':>8}  baseline")
+    for name in args.only or BENCHMARKS:
+        kind, func = BENCHMARKS[name]
+        for n in args.sizes:
+            rate, peak = run(kind, func, n, args)
+            key = f"{name}@{n}"
+            results[key] = {'rate': round(rate, 1), 'peak_kb': round(peak, 2)}
+            note = ""
+            if key in baseline:
+                old = baseline[key]
+                expected = old['rate'] * scale
+                note = f"{rate/expected:.2f}x speed"
+                if rate < expected * (1 - args.tolerance):
+                    note += " SLOWER"
+                    failed.append(key)
+                if peak > old['peak_kb'] * (1 + args.tolerance) + 1:
+                    note += " MORE MEMORY"
+                    failed.append(key)
+            print(f"{name:36} {n:7d} {rate:10.0f} {peak:8.1f}  {note}")
+    if args.save:
+        with open(BASELINE, 'w') as f:
+            json.dump({'python': platform.python_version(),
+                       'machine': platform.machine(),
+                       'reference': round(reference, 1),
+                       'parties': args.parties, 'links': args.links,
+                       'subjects': args.subjects, 'results': results},
+                      f, indent=2)
+        print(f"Saved baseline to {BASELINE}")
+    if failed:
+        print(f"Regressions: {', '.join(sorted(set(failed)))}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
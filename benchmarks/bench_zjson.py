@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2021 ARC Centre of Excellence for Climate Extremes
+# author: Paola Petrelli <paola.petrelli@utas.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+'''
+Benchmark json encoding and decoding of synthetic plans and records
+with each backend available to zenmeta/zjson.py.
+
+Usage:
+  python benchmarks/bench_zjson.py [--n 2000] [--kinds geonetwork ...]
+
+For each kind of record the mean encoded size and the throughput in
+records/s and MB/s are reported for compact encoding (request bodies
+and json lines), pretty encoding (backups), decoding and reading a
+json lines and a json list file with iter_json. The json backend is
+always run, orjson only if it is installed.
+'''
+
+import argparse
+import contextlib
+import os
+import statistics
+import tempfile
+import time
+
+from synthetic import GENERATORS, generate
+
+import zjson
+from util import iter_json, write_json_stream
+
+
+@contextlib.contextmanager
+def backend(name):
+    """Use only the named backend in zjson while in the context"""
+    saved = zjson.orjson
+    if name == 'json':
+        zjson.orjson = None
+    try:
+        yield
+    finally:
+        zjson.orjson = saved
+
+
+def rate(func, repeat):
+    """Return median of cpu time over repeat calls of func"""
+    times = []
+    for _ in range(repeat):
+        start = time.process_time()
+        func()
+        times.append(time.process_time() - start)
+    return max(statistics.median(times), 1e-9)
+
+
+def run(records, repeat, workdir):
+    """Return {operation: seconds} for one list of records"""
+    compact = [zjson.dumpb(r) for r in records]
+    jsonl = os.path.join(workdir, 'records.jsonl')
+    with open(jsonl, 'wb') as f:
+        f.writelines(b + b"\n" for b in compact)
+    jlist = os.path.join(workdir, 'records.json')
+    write_json_stream(records, jlist)
+    return {
+        'encode': rate(lambda: [zjson.dumpb(r) for r in records], repeat),
+        'encode pretty': rate(lambda: [zjson.dumps(r, indent=3)
+                                       for r in records], repeat),
+        'decode': rate(lambda: [zjson.loads(b) for b in compact], repeat),
+        'iter_json jsonl': rate(lambda: sum(1 for _ in iter_json(jsonl)), repeat),
+        'iter_json list': rate(lambda: sum(1 for _ in iter_json(jlist)), repeat),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark json backends")
+    parser.add_argument('--n', type=int, default=2000,
+        help="Records of each kind (default 2000)")
+    parser.add_argument('--kinds', nargs='+', default=['geonetwork',
+        'zenodo_export', 'record_v9'], choices=list(GENERATORS),
+        help="Kinds of synthetic records (default geonetwork " +
+             "zenodo_export record_v9)")
+    parser.add_argument('--repeat', type=int, default=5,
+        help="Runs of each operation, the median is reported (default 5)")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    backends = ['json'] + (['orjson'] if zjson.orjson else [])
+    print(f"{'kind':14} {'bytes':>6} {'operation':16} " +
+          " ".join(f"{b + ' rec/s':>13} {'MB/s':>7}" for b in backends))
+    with tempfile.TemporaryDirectory() as workdir:
+        for kind in args.kinds:
+            records = list(generate(kind, args.n, seed=args.seed))
+            with backend('json'):
+                mbytes = sum(len(zjson.dumpb(r)) for r in records) / 1e6
+            results = {}
+            for name in backends:
+                with backend(name):
+                    results[name] = run(records, args.repeat, workdir)
+            size = mbytes * 1e6 / args.n
+            for op in results['json']:
+                cols = " ".join(f"{args.n / results[b][op]:13.0f} " +
+                                f"{mbytes / results[b][op]:7.1f}"
+                                for b in backends)
+                print(f"{kind:14} {size:6.0f} {op:16} {cols}")
+
+
+if __name__ == "__main__":
+    main()
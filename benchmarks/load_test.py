@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2021 ARC Centre of Excellence for Climate Extremes
+# author: Paola Petrelli <paola.petrelli@utas.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+'''
+Load test zen commands against the local mock api.
+
+Usage:
+  python benchmarks/load_test.py [--concurrency 1 2 4 8 16] [--plans 200]
+      [--commands meta list upload remove] [--latency 50] [--jitter 20]
+      [--error-rate 0] [--throttle-rate 0] [--rate-limit 0]
+
+For each concurrency level the mock server (zenmeta/mock_server.py) is
+started with the given faults and that many zen processes run each
+command at the same time, meta splitting the plans among them.
+Request events recorded with --metrics-file give throughput and
+latency percentiles, written to load_test.csv and, if matplotlib is
+installed, plotted in load_test.png.
+'''
+
+import argparse
+import csv
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from synthetic import ZENMETA, generate
+
+import mock_server
+from metrics import percentile
+
+CLI = os.path.join(ZENMETA, 'cli.py')
+
+
+def run_processes(commands, workdir, inputs=None):
+    """Run zen commands at the same time and return the wall time
+
+    Parameters
+    ----------
+    commands : list(list(str))
+        Arguments of each zen process
+    workdir : str
+        Working directory, each process uses its own sub-directory
+    inputs : list(str), optional
+        Standard input of each process (default None)
+
+    Returns
+    -------
+    elapsed : float
+        Seconds from start of first to end of last process
+    """
+    env = dict(os.environ, ZENMETA_NO_SERVER="1",
+               ZENMETA_CACHE=os.path.join(workdir, 'cache'))
+    start = time.perf_counter()
+    procs = []
+    for i, args in enumerate(commands):
+        cwd = os.path.join(workdir, f"p{i}")
+        os.makedirs(cwd, exist_ok=True)
+        # each process rotates its own log file
+        env['ZENMETA_LOG'] = os.path.join(cwd, 'zenmeta_log.txt')
+        procs.append(subprocess.Popen([sys.executable, CLI] + args, cwd=cwd,
+            env=dict(env), stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL, text=True))
+    for i, p in enumerate(procs):
+        p.communicate(inputs[i] if inputs else None)
+    return time.perf_counter() - start
+
+
+def read_events(fnames):
+    """Return events from the metrics files that exist"""
+    events = []
+    for fname in fnames:
+        if os.path.exists(fname):
+            with open(fname) as f:
+                events.extend(json.loads(line) for line in f)
+    return events
+
+
+def summarise(command, concurrency, events, elapsed):
+    """Return a result row with throughput and latency percentiles"""
+    latency = sorted(e['latency'] * 1000 for e in events)
+    ok = sum(e['outcome'] == '2xx' for e in events)
+    return {'command': command, 'concurrency': concurrency,
+            'requests': len(events), 'ok': ok,
+            'throttled': sum(e['outcome'] == '429' for e in events),
+            'errors': sum(e['outcome'] not in ('2xx', '429') for e in events),
+            'elapsed': round(elapsed, 3),
+            'ok_per_s': round(ok / elapsed, 2) if elapsed else 0,
+            'p50_ms': round(percentile(latency, 50) or 0, 1),
+            'p95_ms': round(percentile(latency, 95) or 0, 1),
+            'p99_ms': round(percentile(latency, 99) or 0, 1)}
+
+
+def split(items, n):
+    """Split items in n lists of similar length"""
+    return [items[i::n] for i in range(n)]
+
+
+def run_level(c, plans, args, workdir):
+    """Run all commands with c concurrent processes against a new server"""
+    state = mock_server.MockState(args.latency / 1000, args.jitter / 1000,
+        args.error_rate, args.throttle_rate, args.rate_limit, seed=c)
+    server = mock_server.make_server(0, state)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/api"
+    rows = []
+    try:
+        for command in args.commands:
+            level_dir = os.path.join(workdir, f"{command}-{c}")
+            os.makedirs(level_dir)
+            events_files = [os.path.join(level_dir, f"events{i}.jsonl")
+                            for i in range(c)]
+            zen = [['-t', 'load-test', '--api-url', url, '--metrics-file', ev]
+                   for ev in events_files]
+            inputs = None
+            if command == 'meta':
+                cmds = []
+                for i, part in enumerate(split(plans, c)):
+                    fname = os.path.join(level_dir, f"plans{i}.jsonl")
+                    with open(fname, 'w') as f:
+                        f.writelines(json.dumps(p) + "\n" for p in part)
+                    cmds.append(zen[i] + ['meta', '-f', fname])
+            elif command == 'list':
+                cmds = [z + ['list', '--draft'] for z in zen]
+            else:
+                ids = split(sorted(state.records), c)
+                if command == 'upload':
+                    fname = os.path.join(level_dir, 'files.txt')
+                    with open(fname, 'w') as f:
+                        f.write(os.path.join(level_dir, 'files.txt') + "\n")
+                    # one process per record, at most c records
+                    cmds = [zen[i] + ['upload', '-i', part[0], '-f', fname]
+                            for i, part in enumerate(ids) if part]
+                else:
+                    cmds = []
+                    for i, part in enumerate(ids):
+                        cmds.append(zen[i] + ['remove'] +
+                                    [a for rid in part for a in ('-i', rid)])
+                    # remove asks confirmation for each record
+                    inputs = ["Y\n" * len(part) for part in ids]
+            elapsed = run_processes(cmds, level_dir, inputs)
+            row = summarise(command, c, read_events(events_files), elapsed)
+            rows.append(row)
+            print(f"{command:8} {c:4d} {row['requests']:8d} {row['ok']:6d} " +
+                  f"{row['throttled']:6d} {row['errors']:6d} " +
+                  f"{row['ok_per_s']:8.1f} {row['p50_ms']:8.1f} " +
+                  f"{row['p95_ms']:8.1f} {row['p99_ms']:8.1f}")
+    finally:
+        server.shutdown()
+        server.server_close()
+    return rows
+
+
+def plot(rows, fname):
+    """Plot throughput and p99 latency against concurrency"""
+    try:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+    except ImportError:
+        print("matplotlib is not installed, skipping plot")
+        return
+    fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(11, 4))
+    for command in dict.fromkeys(r['command'] for r in rows):
+        sel = [r for r in rows if r['command'] == command]
+        x = [r['concurrency'] for r in sel]
+        ax1.plot(x, [r['ok_per_s'] for r in sel], marker='o', label=command)
+        ax2.plot(x, [r['p99_ms'] for r in sel], marker='o', label=command)
+    ax1.set(xlabel="concurrent processes", ylabel="successful requests/s",
+            xscale='log', title="Throughput")
+    ax2.set(xlabel="concurrent processes", ylabel="p99 latency (ms)",
+            xscale='log', title="Tail latency")
+    ax1.legend()
+    fig.tight_layout()
+    fig.savefig(fname)
+    print(f"Plot saved to {fname}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test zen against the mock api")
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4, 8, 16],
+        help="Numbers of concurrent zen processes (default 1 2 4 8 16)")
+    parser.add_argument('--plans', type=int, default=200,
+        help="Plans uploaded by meta at each level (default 200)")
+    parser.add_argument('--commands', nargs='+', default=['meta', 'list', 'upload', 'remove'],
+        choices=['meta', 'list', 'upload', 'remove'],
+        help="Commands to run, in order, meta creates the records the others use")
+    parser.add_argument('--latency', type=float, default=50,
+        help="Mock api latency in ms (default 50)")
+    parser.add_argument('--jitter', type=float, default=20,
+        help="Mean of exponential extra latency in ms (default 20)")
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--throttle-rate', type=float, default=0)
+    parser.add_argument('--rate-limit', type=float, default=0,
+        help="Requests per second accepted by the mock api (default no limit)")
+    parser.add_argument('--output', '-o', default='load_test',
+        help="Prefix of csv and png outputs (default load_test)")
+    args = parser.parse_args()
+
+    plans = list(generate('geonetwork', args.plans))
+    rows = []
+    print(f"{'command':8} {'conc':>4} {'requests':>8} {'ok':>6} {'429':>6} " +
+          f"{'errors':>6} {'ok/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    with tempfile.TemporaryDirectory() as workdir:
+        for c in args.concurrency:
+            rows.extend(run_level(c, plans, args, workdir))
+    with open(f"{args.output}.csv", 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+    print(f"Results saved to {args.output}.csv")
+    plot(rows, f"{args.output}.png")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2021 ARC Centre of Excellence for Climate Extremes
+# author: Paola Petrelli <paola.petrelli@utas.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+'''
+Generators of realistic synthetic plans and records for benchmarks.
+
+Plans are built from the zenmeta vocabularies, so affiliations, roles
+and FOR codes are found by the lookups as often as in real data. All
+generators take a random.Random so the same seed gives the same plans.
+'''
+
+import os
+import random
+import sys
+
+ZENMETA = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'zenmeta')
+sys.path.insert(0, ZENMETA)
+
+from util import read_vocab
+
+
+WORDS = ("climate ocean atmosphere model rainfall temperature wind soil "
+         "ensemble reanalysis drought heatwave carbon aerosol ice sea "
+         "surface flux regional daily monthly historical projection "
+         "simulation observation gridded station satellite hydrology").split()
+LINK_TYPES = ['geonetwork', 'DAP', 'RDA', 'TDS', 'paper', 'website']
+FORMATS = ['netCDF', 'GRIB', 'HDF5', 'um', 'GeoTIFF', 'mat', 'csv']
+CUSTOMS = ["region", "resolution", "frequency", "format", "realm"]
+
+
+def text(rng, nwords):
+    return " ".join(rng.choice(WORDS) for _ in range(nwords))
+
+
+def name(rng):
+    first = rng.choice(['Anna', 'Ben', 'Chen', 'Dana', 'Eli', 'Fatima',
+                        'Giulia', 'Hiro', 'Ivan', 'Jo'])
+    last = rng.choice(['Smith', 'Nguyen', 'Rossi', 'Kumar', 'Brown',
+                       'Wang', 'Garcia', 'Muller', 'Ito', 'Walker'])
+    return f"{first} {last}"
+
+
+def date(rng, start=1950, end=2023):
+    return f"{rng.randint(start, end)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"
+
+
+def vocab_keys():
+    affs = read_vocab('affiliations.json')
+    return (list(affs.keys()), [v['acronym'] for v in affs.values()],
+            list(read_vocab('CI_RoleCode.json').keys()),
+            list(read_vocab('for_map.json').values()))
+
+
+def party(rng, vocabs, role=None):
+    affs, acronyms, roles, _ = vocabs
+    p = {'role': role or rng.choice(roles)}
+    if rng.random() < 0.2:
+        p['name'] = text(rng, 3).title()
+        p['org'] = True
+    else:
+        p['name'] = name(rng)
+        p['org'] = False
+        if rng.random() < 0.5:
+            p['orcid'] = f"0000-000{rng.randint(1, 9)}-{rng.randint(1000, 9999)}-{rng.randint(1000, 9999)}"
+    r = rng.random()
+    # by full name, by acronym or not in the vocabulary
+    if r < 0.5:
+        p['affiliation'] = rng.choice(affs)
+    elif r < 0.8:
+        p['affiliation'] = rng.choice(acronyms)
+    else:
+        p['affiliation'] = text(rng, 4).title()
+    return p
+
+
+def for_codes(rng, vocabs, n):
+    codes = []
+    for v in rng.sample(vocabs[3], n):
+        codes.extend(v['codes_2020'])
+    return codes
+
+
+def geonetwork_plan(rng, vocabs, parties=4, links=3, subjects=3):
+    """Return a plan as written by geonetwork.py"""
+    start = date(rng, 1950, 2000)
+    return {'title': text(rng, 8).capitalize(),
+        'alt_title': text(rng, 3) if rng.random() < 0.3 else "",
+        'version': f"v{rng.randint(1, 5)}.0" if rng.random() < 0.5 else "",
+        'doi': f"10.25914/{rng.getrandbits(48):012x}" if rng.random() < 0.8 else "",
+        'license': "http://creativecommons.org/licenses/by/4.0/",
+        'fformat': rng.choice(FORMATS),
+        'location': f"/g/data/{text(rng, 1)}/{text(rng, 1)}",
+        'keywords': [text(rng, 1) for _ in range(subjects)],
+        'for_codes': for_codes(rng, vocabs, subjects),
+        'parties': [party(rng, vocabs, 'author')] +
+                   [party(rng, vocabs) for _ in range(parties - 1)],
+        'publication_date': date(rng, 2000),
+        'citation': text(rng, 30),
+        'related_identifiers': [{rng.choice(LINK_TYPES):
+            f"https://example.org/{text(rng, 1)}/{rng.getrandbits(32):x}"}
+            for _ in range(links)],
+        'geospatial': [round(rng.uniform(110, 130), 2), round(rng.uniform(130, 155), 2),
+                       round(rng.uniform(-45, -25), 2), round(rng.uniform(-25, -10), 2)],
+        'time_coverage': [start, date(rng, 2000)],
+        'description': text(rng, 150),
+        'publisher': "NCI Australia"}
+
+
+def csiro_plan(rng, vocabs, parties=4, links=3, subjects=3):
+    """Return a plan as written by csiro.py"""
+    plan = geonetwork_plan(rng, vocabs, parties, links, subjects)
+    plan['license_link'] = "https://creativecommons.org/licenses/by/4.0/"
+    plan['resource_type'] = {'id': 'dataset', 'title': "Dataset"}
+    plan['handle'] = f"102.100.100/{rng.randint(1, 999999)}"
+    plan['publisher'] = 'CSIRO (Australia)'
+    plan['version'] = ""
+    plan['location'] = ""
+    plan['fformat'] = ""
+    plan['related_identifiers'][0] = {'DAP': "https://data.csiro.au/collection/" +
+                                      f"csiro:{rng.randint(1, 99999)}"}
+    return plan
+
+
+def zenodo_plan(rng, vocabs, parties=4, links=3, subjects=3):
+    """Return a plan in the old zenodo upload format"""
+    return {'title': text(rng, 8).capitalize(), 'version': "1.0",
+        'description': text(rng, 150), 'citation': text(rng, 30),
+        'license': "Creative Commons Attribution 4.0 International",
+        'author': {'name': name(rng), 'email': "someone@example.org",
+                   'orcid': f"https://orcid.org/0000-0002-{rng.randint(1000, 9999)}-0000"},
+        'geonetwork': f"https://geonetwork.nci.org.au/{rng.getrandbits(32):x}",
+        'rda': f"https://researchdata.edu.au/{rng.getrandbits(32):x}",
+        'related': [f"https://example.org/{rng.getrandbits(32):x}" for _ in range(links)],
+        'keywords': ",".join(text(rng, 1) for _ in range(subjects))}
+
+
+def zenodo_export(rng, vocabs, parties=4, links=3, subjects=3):
+    """Return a record as exported by the zenodo api"""
+    rid = rng.randint(1000000, 9999999)
+    for_names = [v['name_2008'] for v in rng.sample(vocabs[3], subjects)]
+    return {'id': rid,
+        'links': {'parent_html': f"https://zenodo.org/records/{rid}"},
+        'pids': {'doi': {'identifier': f"10.5281/zenodo.{rid}"}},
+        'metadata': {'title': text(rng, 8).capitalize(),
+            'description': text(rng, 150),
+            'creators': [{'name': name(rng), 'affiliation': rng.choice(vocabs[0])}
+                         for _ in range(parties)],
+            'subjects': [{'subject': n, 'scheme': 'url',
+                          'identifier': f"https://example.org/{i}"}
+                         for i, n in enumerate(for_names)],
+            'related_identifiers': [{'identifier': f"https://example.org/{rng.getrandbits(32):x}",
+                'relation': 'isSupplementTo', 'scheme': 'url'} for _ in range(links)],
+            'alternate_identifiers': [],
+            'communities': [{'id': rng.choice(["arc-coe-clex-data", "other"])}],
+            'grants': [{'id': f"10.13039/501100000923::{rng.randint(1, 99999)}",
+                        'code': str(rng.randint(1, 99999)),
+                        'funder': {'doi': "10.13039/501100000923"}}]}}
+
+
+def record_v9(rng, vocabs, parties=4, links=3, subjects=3):
+    """Return an invenio record before the v10 schema, as in backups"""
+    from invenio import process_invenio_plan
+    record = process_invenio_plan(geonetwork_plan(rng, vocabs, parties, links,
+                                                  subjects), "community-id")
+    meta = record['metadata']
+    meta['subjects'].extend({'id': text(rng, 1), 'scheme': rng.choice(CUSTOMS),
+                             'subject': text(rng, 1)} for _ in range(subjects))
+    meta['dates'] = [{'date': f"{date(rng, 1950, 2000)}/{date(rng, 2000)}",
+                      'type': {'id': "coverage", 'title': {'en': "Temporal coverage"}}}]
+    return record
+
+
+GENERATORS = {'geonetwork': geonetwork_plan, 'csiro': csiro_plan,
+              'zenodo': zenodo_plan, 'zenodo_export': zenodo_export,
+              'record_v9': record_v9}
+
+
+def generate(kind, n, seed=0, **kwargs):
+    """Yield n synthetic plans of kind, see GENERATORS"""
+    rng = random.Random(seed)
+    vocabs = vocab_keys()
+    gen = GENERATORS[kind]
+    for _ in range(n):
+        yield gen(rng, vocabs, **kwargs)
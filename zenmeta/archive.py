@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2021 ARC Centre of Excellence for Climate Extremes
+# author: Paola Petrelli <paola.petrelli@utas.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+'''
+Compressed and indexed archive of records, used for backups.
+
+An archive is a directory with:
+  manifest.json            codec, segments and number of records
+  seg-00000.jsonl.gz       json lines segments, .jsonl.zst with zstd
+  index.tsv                id, doi, segment, offset, length, line
+
+Records are compressed in blocks, each block is a gzip member or a zstd
+frame, so a segment is still a valid gzip or zstd file of json lines.
+The index gives for each record the offset and size of its block and
+its line in the block, so a single record is read by decompressing one
+block only. zstd is used when the zstandard package is installed,
+otherwise gzip. The manifest is written last, a directory without it
+is an incomplete archive.
+'''
+
+import gzip
+import io
+import os
+import shutil
+import datetime as dt
+import zjson
+from exception import ZenException
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+FORMAT = 1
+MANIFEST = 'manifest.json'
+INDEX = 'index.tsv'
+EXTENSIONS = {'gzip': '.jsonl.gz', 'zstd': '.jsonl.zst'}
+
+
+def is_archive(path):
+    """Return True if path is a complete archive"""
+    return os.path.isfile(os.path.join(path, MANIFEST))
+
+
+def record_keys(record):
+    """Return id and doi of an invenio or zenodo record, "" if missing"""
+    rid = str(record.get('id', "") or "")
+    doi = record.get('pids', {}).get('doi', {}).get('identifier', "")
+    if not doi:
+        doi = record.get('doi', "") or record.get('metadata', {}).get('doi', "")
+    return rid, doi or ""
+
+
+def _compress(codec, data, level):
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=level or 3).compress(data)
+    return gzip.compress(data, compresslevel=level or 6, mtime=0)
+
+
+def _decompress(codec, data):
+    if codec == 'zstd':
+        return zstandard.ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+
+class ArchiveWriter:
+    """Write records to a new archive as they are produced
+
+    The archive is written to <path>.tmp and moved to path when closed.
+    An archive already there is first moved to <path>.old and removed
+    only once the new one is in place, so if the move is interrupted
+    the previous archive is still in <path>.old.
+
+    Parameters
+    ----------
+    path : str
+        Archive directory
+    codec : str, optional
+        'zstd' or 'gzip', if None zstd when available (default None)
+    level : int, optional
+        Compression level, if None the codec default (default None)
+    block_records : int, optional
+        Records compressed together, larger blocks compress better
+        but reading one record decompresses more (default 64)
+    segment_bytes : int, optional
+        Compressed size after which a new segment starts (default 64 MB)
+    """
+
+    def __init__(self, path, codec=None, level=None, block_records=64,
+                 segment_bytes=64*1024*1024):
+        if codec is None:
+            codec = 'zstd' if zstandard else 'gzip'
+        if codec == 'zstd' and zstandard is None:
+            raise ZenException("zstd archives need the zstandard package")
+        if codec not in EXTENSIONS:
+            raise ZenException(f"Unknown archive codec: {codec}")
+        self.path = path.rstrip('/')
+        self.tmpdir = f"{self.path}.tmp"
+        self.codec = codec
+        self.level = level
+        self.block_records = block_records
+        self.segment_bytes = segment_bytes
+        if os.path.exists(self.tmpdir):
+            shutil.rmtree(self.tmpdir)
+        os.makedirs(self.tmpdir)
+        self.segments = []
+        self.segment = None
+        self.block = []
+        self.keys = []
+        self.nrec = 0
+        self.index = open(os.path.join(self.tmpdir, INDEX), 'w',
+                          encoding='utf-8')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, record):
+        """Add a record to the archive"""
+        self.block.append(zjson.dumpb(record))
+        self.keys.append(record_keys(record))
+        self.nrec += 1
+        if len(self.block) >= self.block_records:
+            self._flush()
+
+    def _flush(self):
+        if not self.block:
+            return
+        if self.segment is None or self.segment.tell() >= self.segment_bytes:
+            self._new_segment()
+        data = _compress(self.codec, b"\n".join(self.block) + b"\n", self.level)
+        offset = self.segment.tell()
+        self.segment.write(data)
+        seg = len(self.segments) - 1
+        for line, (rid, doi) in enumerate(self.keys):
+            self.index.write(f"{rid}\t{doi}\t{seg}\t{offset}\t{len(data)}\t{line}\n")
+        self.block = []
+        self.keys = []
+
+    def _new_segment(self):
+        if self.segment is not None:
+            self.segment.close()
+        name = f"seg-{len(self.segments):05d}{EXTENSIONS[self.codec]}"
+        self.segments.append(name)
+        self.segment = open(os.path.join(self.tmpdir, name), 'wb')
+
+    def close(self):
+        """Write the last block and the manifest and move the archive
+        to its final path
+
+        Returns
+        -------
+        nrec : int
+            Number of records written
+        """
+        self._flush()
+        if self.segment is not None:
+            self.segment.close()
+        self.index.close()
+        manifest = {'format': FORMAT, 'codec': self.codec,
+                    'segments': self.segments, 'records': self.nrec,
+                    'created': dt.datetime.now(dt.timezone.utc).strftime(
+                               '%Y-%m-%dT%H:%M:%SZ')}
+        with open(os.path.join(self.tmpdir, MANIFEST), 'w') as f:
+            zjson.dump(manifest, f, indent=2)
+        old = f"{self.path}.old"
+        if os.path.exists(self.path):
+            # a <path>.old left with the archive in place is stale,
+            # without it it's the only complete archive until the
+            # new one is moved in
+            if os.path.exists(old):
+                shutil.rmtree(old)
+            os.rename(self.path, old)
+        os.rename(self.tmpdir, self.path)
+        shutil.rmtree(old, ignore_errors=True)
+        return self.nrec
+
+    def abort(self):
+        """Remove the partial archive"""
+        if self.segment is not None:
+            self.segment.close()
+        self.index.close()
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+
+def write_archive(records, path, **kwargs):
+    """Write records to an archive, see ArchiveWriter for options
+
+    Returns
+    -------
+    nrec : int
+        Number of records written
+    """
+    with ArchiveWriter(path, **kwargs) as writer:
+        for record in records:
+            writer.write(record)
+    return writer.nrec
+
+
+class ArchiveReader:
+    """Read records from an archive, all in order or one at a time
+
+    Parameters
+    ----------
+    path : str
+        Archive directory
+    """
+
+    def __init__(self, path):
+        if not is_archive(path):
+            raise ZenException(f"{path} is not a complete record archive")
+        self.path = path
+        with open(os.path.join(path, MANIFEST), 'rb') as f:
+            self.manifest = zjson.load(f)
+        if self.manifest['format'] > FORMAT:
+            raise ZenException(f"{path} has archive format " +
+                f"{self.manifest['format']}, upgrade zenmeta to read it")
+        self.codec = self.manifest['codec']
+        if self.codec == 'zstd' and zstandard is None:
+            raise ZenException("zstd archives need the zstandard package")
+        self._ids = None
+        self._dois = None
+        self._block = (None, None)
+
+    def __len__(self):
+        return self.manifest['records']
+
+    def __iter__(self):
+        """Yield all records, decompressing one segment at a time"""
+        for name in self.manifest['segments']:
+            with open(os.path.join(self.path, name), 'rb') as f:
+                if self.codec == 'zstd':
+                    stream = io.BufferedReader(zstandard.ZstdDecompressor(
+                        ).stream_reader(f, read_across_frames=True))
+                else:
+                    stream = gzip.GzipFile(fileobj=f)
+                for line in stream:
+                    yield zjson.loads(line)
+
+    def _load_index(self):
+        self._ids = {}
+        self._dois = {}
+        with open(os.path.join(self.path, INDEX), 'r', encoding='utf-8') as f:
+            for row in f:
+                rid, doi, seg, offset, length, line = row.rstrip('\n').split('\t')
+                loc = (int(seg), int(offset), int(length), int(line))
+                if rid:
+                    self._ids[rid] = loc
+                if doi:
+                    self._dois[doi] = loc
+
+    def keys(self):
+        """Return the ids of the records in the archive"""
+        if self._ids is None:
+            self._load_index()
+        return self._ids.keys()
+
+    def get(self, key, default=None):
+        """Return the record with id or doi key
+
+        Only the block with the record is read and decompressed, the
+        last block read is kept so records stored together are fast
+        to read in sequence.
+        """
+        if self._ids is None:
+            self._load_index()
+        loc = self._ids.get(str(key), None) or self._dois.get(key, None)
+        if loc is None:
+            return default
+        seg, offset, length, line = loc
+        if self._block[0] != (seg, offset):
+            with open(os.path.join(self.path,
+                      self.manifest['segments'][seg]), 'rb') as f:
+                f.seek(offset)
+                data = _decompress(self.codec, f.read(length))
+            self._block = ((seg, offset), data.split(b"\n"))
+        return zjson.loads(self._block[1][line])
+
+    def __getitem__(self, key):
+        record = self.get(key)
+        if record is None:
+            raise KeyError(key)
+        return record
+
+
+def iter_archive(path):
+    """Yield all records in an archive"""
+    yield from ArchiveReader(path)
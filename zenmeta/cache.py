@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2021 ARC Centre of Excellence for Climate Extremes
+# author: Paola Petrelli <paola.petrelli@utas.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import os
+import time
+from os.path import expanduser
+import zjson
+
+
+def cache_dir(*parts):
+    """Return a cache directory, creating it if needed
+
+    The root is ~/.cache/zenmeta unless ZENMETA_CACHE is set
+
+    Parameters
+    ----------
+    parts : str
+        Sub-directories under the cache root
+
+    Returns
+    -------
+    path : str
+        The cache directory path
+    """
+    root = os.environ.get('ZENMETA_CACHE', expanduser('~/.cache/zenmeta'))
+    path = os.path.join(root, *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def content_hash(data):
+    """Return the sha256 hex digest of bytes"""
+    return hashlib.sha256(data).hexdigest()
+
+
+def cached_extract(fname, source, version, extractor, use_cache=True):
+    """Extract fields from a source file using a content-addressed cache
+
+    The fields are stored as json keyed by the file content hash and
+    the extractor version, so unchanged files are not parsed again and
+    bumping the version invalidates older entries.
+
+    Parameters
+    ----------
+    fname : str
+        Source file to extract fields from
+    source : str
+        Name of the source, used as cache sub-directory
+    version : int
+        Version of the extractor
+    extractor : function
+        Function taking the file content as bytes and returning
+        a json compatible dictionary
+    use_cache : bool, optional
+        If False always run the extractor and don't save result
+        (default True)
+
+    Returns
+    -------
+    fields : dict
+        The extracted fields
+    """
+    with open(fname, 'rb') as f:
+        data = f.read()
+    if not use_cache:
+        return extractor(data)
+    path = os.path.join(cache_dir('parsed', source),
+                        f"{content_hash(data)}-v{version}.json")
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            return zjson.load(f)
+    fields = extractor(data)
+    # write to a temporary file first so parallel workers never
+    # read a partial entry
+    tmpname = f"{path}.{os.getpid()}.tmp"
+    with open(tmpname, 'wb') as f:
+        f.write(zjson.dumpb(fields))
+    os.replace(tmpname, path)
+    return fields
+
+
+def _lookup_path(name):
+    return os.path.join(cache_dir(), f"{name}.json")
+
+
+def read_lookup(name, key, ttl):
+    """Return a value saved with write_lookup if it is not expired
+
+    Parameters
+    ----------
+    name : str
+        Name of the lookup table, saved as <cache root>/<name>.json
+    key : str
+        The key of the value
+    ttl : float
+        Time to live of the value in seconds
+
+    Returns
+    -------
+    value : json compatible object or None
+        The value, None if missing or older than ttl
+    """
+    try:
+        with open(_lookup_path(name), 'rb') as f:
+            entry = zjson.load(f).get(key, None)
+    except (OSError, ValueError):
+        return None
+    if entry is None or time.time() - entry['time'] > ttl:
+        return None
+    return entry['value']
+
+
+def write_lookup(name, key, value):
+    """Save a value in a lookup table with the current time
+
+    Parameters
+    ----------
+    name : str
+        Name of the lookup table, saved as <cache root>/<name>.json
+    key : str
+        The key of the value
+    value : json compatible object
+        The value to save
+    """
+    path = _lookup_path(name)
+    try:
+        with open(path, 'rb') as f:
+            table = zjson.load(f)
+    except (OSError, ValueError):
+        table = {}
+    table[key] = {'value': value, 'time': time.time()}
+    tmpname = f"{path}.{os.getpid()}.tmp"
+    with open(tmpname, 'wb') as f:
+        f.write(zjson.dumpb(table, indent=2))
+    os.replace(tmpname, path)
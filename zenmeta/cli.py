@@ -15,22 +15,21 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import requests
-import json
 import click
 import logging
 import sys
-from util import (config_log, post_json, get_token, read_json, write_json,
-                  get_bucket, get_records, extract_records, remove_record)
-from zenodo import set_zenodo, process_zenodo_plan, to_invenio
-from invenio import (set_invenio, process_invenio_plan, convert_v10,
-                     submit_review, add_community)
-# if this remain different from zenodo I should move it to invenio.py file
-from exception import ZenException
+# api modules and their dependencies are imported by the commands
+# that use them, so starting zen and showing help stays fast
+
 
 def zen_catch():
     debug_logger = logging.getLogger('zen_debug')
     debug_logger.setLevel(logging.CRITICAL)
+    # run the command with zen serve if it is running
+    from server import forward
+    code = forward(sys.argv[1:], zen)
+    if code is not None:
+        sys.exit(code)
     try:
         zen()
     except Exception as e:
@@ -50,48 +49,108 @@ def zen_catch():
 @click.option('--token', '-t', 'token', required=False,
                help="User token, passed to override one configured in "
                      "~/invenio_<production/test> file")
+@click.option('--api-url', 'api_url', default=None,
+               help="Base api url, i.e. http://localhost:5000/api for " +
+                    "mock_server.py, overrides production/test urls")
 @click.option('--debug', is_flag=True, default=False,
                help="Show debug info")
+@click.option('--metrics', is_flag=True, default=False,
+               help="Print api request latency and throughput summary at end")
+@click.option('--metrics-file', 'metrics_file', default=None,
+               help="Write api request events to this json lines file")
+@click.option('--profile', is_flag=True, default=False,
+               help="Print wall and cpu time of each stage at end")
+@click.option('--profiler', type=click.Choice(['cprofile', 'sample']),
+               default=None, help="Also profile functions with cProfile or " +
+               "by sampling stacks, implies --profile")
+@click.option('--profile-output', 'profile_output', default='zen_profile',
+               help="Prefix of profiler report files, default is zen_profile")
+@click.option('--memory', is_flag=True, default=False,
+               help="Trace memory and print peak memory of each stage at end")
 @click.pass_context
-def zen(ctx, portal, production, community_id, token, debug):
+def zen(ctx, portal, production, community_id, token, api_url, debug, metrics,
+        metrics_file, profile, profiler, profile_output, memory):
+    # only save options here, log, api details and token are set up
+    # by setup_ctx when a command runs
     ctx.obj={}
-    ctx.obj['log'] = config_log()
-    # set up a config depending on portal and production values
     ctx.obj['production'] = production
     ctx.obj['community_id'] = community_id
-    if portal is None:
-        ctx.obj['portal'] = 'invenio' 
-        ctx = set_invenio(ctx, production)
-    else:
-        ctx.obj['portal'] = portal 
-        # can only be zenodo currently could change in future
-        ctx = set_zenodo(ctx, production)
-    # get either sandbox or api token to connect
-    if token:
-        ctx.obj['token'] = token
-    else:
-        ctx.obj['token'] = get_token(ctx.obj['portal'], ctx.obj['production'])
+    ctx.obj['portal'] = 'zenodo' if portal == 'zenodo' else 'invenio'
+    ctx.obj['token'] = token
+    ctx.obj['api_url'] = api_url
+    ctx.obj['debug'] = debug
+    if metrics or metrics_file:
+        import metrics as zen_metrics
+        zen_metrics.start(ctx.invoked_subcommand, metrics_file)
+        ctx.call_on_close(zen_metrics.stop)
+    if profile or profiler:
+        import profiling
+        profiling.start(ctx.invoked_subcommand, profiler, profile_output)
+        ctx.call_on_close(profiling.stop)
+    if memory:
+        import memory as zen_memory
+        zen_memory.start(ctx.invoked_subcommand)
+        ctx.call_on_close(zen_memory.stop)
+
+
+def setup_ctx(ctx, community=False):
+    """Set up log, api urls and token in the context object
 
-    if debug:
-        ctx.obj['log'].setLevel(logging.DEBUG)
-    ctx.obj['log'].debug(f"Token: {ctx.obj['token']}") 
-    ctx.obj['log'].debug(f"Portal: {ctx.obj['portal']}") 
-    ctx.obj['log'].debug(f"Community: {ctx.obj['community_id']}") 
-    ctx.obj['log'].debug(f"API url: {ctx.obj['url']}") 
-    ctx.obj['log'].debug(f"Production: {ctx.obj['production']}") 
+    Parameters
+    ----------
+    ctx: dict
+        Click context obj with the options passed to zen
+    community: bool, optional
+        If True also resolve the community db id, this needs a
+        request to the api (default False)
+
+    Returns
+    -------
+    ctx: dict
+        Click context obj with log, urls and token added
+    """
+    from util import config_log, get_token
+    if 'log' not in ctx.obj.keys():
+        ctx.obj['log'] = config_log()
+        # set up a config depending on portal and production values
+        if ctx.obj['portal'] == 'zenodo':
+            from zenodo import set_zenodo
+            ctx = set_zenodo(ctx, ctx.obj['production'])
+        else:
+            from invenio import set_invenio
+            ctx = set_invenio(ctx, ctx.obj['production'])
+        # get either sandbox or api token to connect
+        if not ctx.obj['token']:
+            ctx.obj['token'] = get_token(ctx.obj['portal'], ctx.obj['production'])
+        if ctx.obj['debug']:
+            ctx.obj['log'].setLevel(logging.DEBUG)
+        ctx.obj['log'].debug("Token: %s", ctx.obj['token'])
+        ctx.obj['log'].debug("Portal: %s", ctx.obj['portal'])
+        ctx.obj['log'].debug("Community: %s", ctx.obj['community_id'])
+        ctx.obj['log'].debug("API url: %s", ctx.obj['url'])
+        ctx.obj['log'].debug("Production: %s", ctx.obj['production'])
+    if (community and ctx.obj['portal'] == 'invenio'
+            and 'community_id_db' not in ctx.obj.keys()):
+        from invenio import get_community_id
+        ctx.obj['community_id_db'] = get_community_id(ctx.obj)
+        ctx.obj['log'].debug("Community db id: %s", ctx.obj['community_id_db'])
+    return ctx
 
 
 @zen.command(name='meta')
 @click.option('--fname', '-f', multiple=False, help="JSON file " +
-              "containing metadata records to upload")
+              "or archive containing metadata records to upload")
 @click.option('--version', is_flag=True, default=False,
                help="Create new version if record already exists")
 @click.option('--skip', is_flag=True, default=False,
                help="Skip processing if record comes from backup")
 @click.option('--fromzen', is_flag=True, default=False,
                help="Minimal processing if record comes from zenodo")
+@click.option('--dedup', is_flag=True, default=False,
+               help="Don't upload records that are likely duplicates of " +
+                    "an earlier one in the file, see duplicates.json")
 @click.pass_context
-def upload_meta(ctx, fname, version, skip, fromzen):
+def upload_meta(ctx, fname, version, skip, fromzen, dedup):
     """Upload metadata from a list of records in a json input file.
 
     If a record exists already is updated, otherwise creates a new one.
@@ -105,53 +164,89 @@ def upload_meta(ctx, fname, version, skip, fromzen):
         Input json filename containing records to upload
     version: bool, optional
         If True create a new version for any existing records in list
+    dedup: bool, optional
+        If True skip likely duplicates, the clusters found are saved
+        in duplicates.json
 
     Returns
     -------
     """
 
-    token = ctx.obj['token']
+    from util import iter_json
+    from submit import submit_plans
+    ctx = setup_ctx(ctx, community=not fromzen)
     zen_log = ctx.obj['log']
     zen_log.info(f"Uploading metadata from {fname} to {ctx.obj['portal']},"
                  + f" production: {ctx.obj['production']}")
-
     # read data from input json file and process plans in file
-    data = read_json(fname)
-    # process data for each plan and post records returned by process_plan()
-    for plan in data:
-        if ctx.obj['portal'] == 'zenodo':
-            zen_log.info(plan['metadata']['title'])
-            if skip:
-                record = plan
-            else:
-                record = process_zenodo_plan(plan, ctx.obj['community_id'])
-        else:
-            if skip:
-                #record = plan
-                # temporarily convert record from v9 to v10
-                record = convert_v10(plan, ctx.obj['community_id_db'])
-                #print(record)
-            elif fromzen:
-                zen_log.info(plan['metadata']['title'])
-                record = to_invenio(plan)
-                if record == {}:
-                    zen_log.info('Skipping record')
-                    continue
-            else:
-                zen_log.info(plan['title'])
-                record = process_invenio_plan(plan, ctx.obj['community_id_db'])
-        r = post_json(ctx.obj['url'], token, record, zen_log)
-        zen_log.debug(f"Request: {r.request}") 
-        zen_log.debug(f"Request url: {r.url}") 
-        zen_log.info(r.status_code) 
-        #if ctx.obj['portal'] == "invenio" and ctx.obj['community_id_db'] != "":
-        #    r_review = submit_review(ctx, r.json()['id'])
-        #zen_log.debug(f"Review request: {r_review.request}") 
-        #zen_log.debug(f"Review request url: {r_review.url}") 
-        #zen_log.info(r_review.status_code) 
+    plans = iter_json(fname)
+    if dedup:
+        # a first pass over the file finds the duplicates
+        from dedup import duplicate_indices
+        from profiling import stage
+        with stage('dedup'):
+            duplicates = duplicate_indices(fname, 'duplicates.json')
+        zen_log.info(f"Skipping {len(duplicates)} likely duplicates, " +
+                     "see duplicates.json")
+        plans = (p for i, p in enumerate(plans) if i not in duplicates)
+    submit_plans(ctx, plans, skip=skip, fromzen=fromzen)
     return
 
 
+@zen.command(name='migrate')
+@click.option('--fname', '-f', required=True, help="JSON file " +
+              "or archive containing backup records to migrate")
+@click.option('--output', '-o', default='migrated.json',
+              help="JSON file to write migrated records to, " +
+                   "default is migrated.json")
+@click.option('--from-version', 'from_version', type=int, default=9,
+              help="Schema version of backup records, default is 9")
+@click.option('--to-version', 'to_version', type=int, default=None,
+              help="Schema version to migrate to, default is latest")
+@click.option('--workers', '-w', type=int, default=None,
+              help="Number of worker processes, default is number of cpus")
+@click.pass_context
+def migrate_records(ctx, fname, output, from_version, to_version, workers):
+    """Migrate records in a backup file to a newer schema version.
+
+    Records are streamed through the registered migration steps using
+    a pool of worker processes, nothing is uploaded.
+
+    Parameters
+    ----------
+    ctx: dict
+        Click context obj including api information 
+    fname: str
+        Input json filename containing records to migrate
+    output: str
+        Output json filename
+    from_version: int
+        Schema version of records in input file
+    to_version: int, optional
+        Schema version to migrate to, if not passed use latest
+    workers: int, optional
+        Number of worker processes to use
+
+    Returns
+    -------
+    """
+    from migrate import migrate_file, migration_chain, needs_community
+    from metrics import add_records
+    ctx = setup_ctx(ctx)
+    # the community is resolved with the api only if a step uses it
+    if needs_community(migration_chain(from_version, to_version)):
+        ctx = setup_ctx(ctx, community=True)
+    zen_log = ctx.obj['log']
+    zen_log.info(f"Migrating records in {fname} from v{from_version}" +
+                 f" to v{to_version or 'latest'}")
+    nrec = migrate_file(fname, output, ctx.obj.get('community_id_db', ""),
+                        from_version=from_version, to_version=to_version,
+                        workers=workers)
+    add_records(nrec)
+    zen_log.info(f"Written {nrec} migrated records to {output}",
+                 extra={'stage': 'migrate'})
+
+
 @zen.command(name='remove')
 @click.option('--ids', '-i', multiple=True, help="Record ids to remove")
 @click.option('--draft',  is_flag=True, default=True, help="If True " +
@@ -170,6 +265,8 @@ def delete_records(ctx, ids, draft):
     # same for get_drafts 
     # add safe parameter
     # add drafts/published option where possible currently only drafts are selected
+    from util import get_records, remove_record
+    ctx = setup_ctx(ctx)
     token = ctx.obj['token']
     zen_log = ctx.obj['log']
     if len(ids) == 0:
@@ -184,7 +281,7 @@ def delete_records(ctx, ids, draft):
             records = get_records(ctx, user=True, draft=draft, mode='ids')
             zen_log.info(f"Found {records['hits']['total']} records")
             ids = [x['id'] for x in records['hits']['hits']]
-        zen_log.debug(f'{ids}')
+        zen_log.debug('%s', ids)
 
     zen_log.info(f"Removing records {ids} from {ctx.obj['portal']},"
                  + f" production: {ctx.obj['production']}")
@@ -203,6 +300,9 @@ def upload_files(ctx, record_id, fname):
     """Upload files to existing record
     """
 
+    from util import get_bucket
+    from zenodo import upload_file
+    ctx = setup_ctx(ctx)
     token = ctx.obj['token']
     zen_log = ctx.obj['log']
     # get either sandbox or api token to connect
@@ -218,8 +318,9 @@ def upload_files(ctx, record_id, fname):
     for f in file_paths:
         zen_log.info(f"Uploading {f} ...")
         f = f.replace('\n','')
-        status = upload_file(bucket_url, token, record_id, f)
-        zen_log.info(f"Request status: {status}")
+        r = upload_file(bucket_url, token, record_id, f)
+        zen_log.info(f"Request status: {r}", extra={'stage': 'upload',
+                     'record_id': record_id, 'status': r.status_code})
 
 
 @zen.command(name='list')
@@ -232,19 +333,36 @@ def upload_files(ctx, record_id, fname):
               help="If True list only user records")
 @click.option('--draft',  is_flag=True, default=False,
               help="If True list drafts, default is False")
+@click.option('--archive', '-a', 'archive_path', default=None,
+              help="Save json records to this compressed archive " +
+                   "instead of output.json")
 @click.pass_context
-def list_records(ctx, rids, user, draft, mode):
+def list_records(ctx, rids, user, draft, mode, archive_path):
     """List records based on input arguments
     """
+    from util import get_records, extract_records, iter_records, write_json
+    from metrics import add_records
+    from profiling import stage
+    ctx = setup_ctx(ctx)
     #token = ctx.obj['token']
     #url = ctx.obj['url']
     zen_log = ctx.obj['log']
     # if draft is used with invenio user is automatically True
     if ctx.obj['portal'] == "invenio" and draft:
         user = True
-    zen_log.debug(f"Draft is {draft}")
-    zen_log.debug(f"Output mode is {mode}")
-    zen_log.debug(f"User is {user}")
+    zen_log.debug("Draft is %s", draft)
+    zen_log.debug("Output mode is %s", mode)
+    zen_log.debug("User is %s", user)
+    json_modes = ['json', 'datacite-json', 'csl', 'vnd.zenodo.v1+json']
+    if archive_path and len(rids) == 0 and mode in json_modes:
+        # stream all the pages to the archive
+        from archive import write_archive
+        zen_log.info(f"Writing output to {archive_path} archive")
+        with stage('write'):
+            nrec = write_archive(iter_records(ctx, user=user, draft=draft,
+                                              mode=mode), archive_path)
+        add_records(nrec)
+        return
     if len(rids) == 0:
         records = get_records(ctx, user=user, draft=draft, mode=mode)
     else:
@@ -252,13 +370,21 @@ def list_records(ctx, rids, user, draft, mode):
         for recid in rids:
             records.append( get_records(ctx, record_id = recid, 
                             user=user, draft=draft, mode=mode) )
-        zen_log.debug(f'{rids}')
+        zen_log.debug('%s', rids)
     if mode not in ['bibtex', 'biblio']:
         records = extract_records(ctx, records, mode, len(rids), user=user, draft=draft)  
+        add_records(len(records))
     # if mode compatible with json save to file instead of printing
-    if mode in ['json', 'datacite-json', 'csl', 'vnd.zenodo.v1+json']:
-        zen_log.info('Writing output to output.json file')
-        write_json(records)
+    if mode in json_modes:
+        if archive_path:
+            from archive import write_archive
+            zen_log.info(f"Writing output to {archive_path} archive")
+            with stage('write'):
+                write_archive(records, archive_path)
+        else:
+            zen_log.info('Writing output to output.json file')
+            with stage('write'):
+                write_json(records)
     elif mode in ['bibtex']:
         print(records)
     else:
@@ -266,6 +392,61 @@ def list_records(ctx, rids, user, draft, mode):
             print(r)
 
 
+@zen.command(name='harvest-oai')
+@click.option('--set', '-s', 'set_spec', default=None,
+              help="OAI-PMH set to harvest, default is the community set")
+@click.option('--prefix', default='oai_datacite',
+              help="Metadata format, default is oai_datacite")
+@click.option('--output', '-o', default=None,
+              help="JSON lines file to write records to, " +
+                   "default is oai_<set>.jsonl")
+@click.option('--full', is_flag=True, default=False,
+              help="Harvest all records, ignoring the last harvest date")
+@click.pass_context
+def harvest_oai(ctx, set_spec, prefix, output, full):
+    """Harvest community records in bulk using OAI-PMH.
+
+    Pages are streamed following resumption tokens. Unless --full is
+    passed only records changed since the last harvest of the same set
+    are requested and appended to the output file.
+
+    Parameters
+    ----------
+    ctx: dict
+        Click context obj including api information 
+    set_spec: str, optional
+        OAI-PMH set, if not passed use the one for the community
+    prefix: str
+        Metadata format to request
+    output: str, optional
+        Output json lines filename
+    full: bool
+        If True ignore last harvest date
+
+    Returns
+    -------
+    """
+    from oai import harvest
+    from metrics import add_records
+    from exception import ZenException
+    ctx = setup_ctx(ctx)
+    zen_log = ctx.obj['log']
+    if set_spec is None:
+        if ctx.obj['community_id'] == "":
+            raise ZenException("This would harvest all records!!\n" +
+                "Select a community_id or a set to limit harvest")
+        if ctx.obj['portal'] == 'zenodo':
+            set_spec = f"user-{ctx.obj['community_id']}"
+        else:
+            set_spec = f"community-{ctx.obj['community_id']}"
+    if output is None:
+        output = f"oai_{set_spec}.jsonl"
+    nrec = harvest(ctx.obj['oai'], output, prefix=prefix, set_spec=set_spec,
+                   full=full, log=zen_log)
+    add_records(nrec)
+    zen_log.info(f"Harvested {nrec} records to {output}")
+
+
 @zen.command(name='community')
 @click.option('--record_id', '-i', 'rids', multiple=True, 
               required=True, help="Record ids to add to community")
@@ -285,6 +466,9 @@ def community(ctx, rids):
     Returns
     -------
     """
+    from invenio import add_community
+    from exception import ZenException
+    ctx = setup_ctx(ctx, community=True)
     if 'community_id_db' not in ctx.obj.keys():
         raise ZenException("There is no community defined")
     zen_log = ctx.obj['log']
@@ -294,5 +478,131 @@ def community(ctx, rids):
         zen_log.info(f"Request status: {status}")
 
 
+@zen.command(name='watch')
+@click.argument('directory', type=click.Path(exists=True, file_okay=False))
+@click.option('--skip', is_flag=True, default=False,
+               help="Skip processing if records come from backup")
+@click.option('--fromzen', is_flag=True, default=False,
+               help="Minimal processing if records come from zenodo")
+@click.option('--debounce', type=float, default=2.0,
+               help="Seconds without changes before a file is uploaded, " +
+                    "default is 2")
+@click.option('--state', 'state_file', default=None,
+               help="File recording uploaded files, default is " +
+                    "~/.zenmeta_watch_state.json")
+@click.pass_context
+def watch_dir(ctx, directory, skip, fromzen, debounce, state_file):
+    """Upload plan files as they are written to a directory.
+
+    Each json or json lines file is uploaded as with zen meta, once,
+    and again only if its content changes. Stop with Ctrl-C.
+
+    Parameters
+    ----------
+    ctx: dict
+        Click context obj including api information 
+    directory: str
+        Directory to watch for plan files
+
+    Returns
+    -------
+    """
+    from util import iter_json_data
+    from submit import submit_plans
+    from invenio import plan_record
+    from watch import watch
+    ctx = setup_ctx(ctx, community=not fromzen)
+    # plans waiting to be posted are held as compact records
+    compact = ctx.obj['portal'] != 'zenodo' and not (skip or fromzen)
+
+    def upload(fname, data):
+        # decode the whole file first, so an incomplete file is not
+        # partly uploaded
+        plans = iter_json_data(data, fname)
+        if compact:
+            plans = [plan_record(p) for p in plans]
+        else:
+            plans = list(plans)
+        return submit_plans(ctx, plans, skip=skip, fromzen=fromzen)
+
+    try:
+        watch(directory, upload, ctx.obj['log'], debounce=debounce,
+              state_file=state_file)
+    except KeyboardInterrupt:
+        pass
+
+
+@zen.command(name='mirror')
+@click.argument('directory', type=click.Path(file_okay=False))
+@click.option('--user', '-u', is_flag=True, default=False,
+               help="Mirror user records instead of community records")
+@click.option('--full', is_flag=True, default=False,
+               help="Fetch all records, not only the updated ones, " +
+                    "and record deletions")
+@click.option('--page-size', 'page_size', type=int, default=100,
+               help="Records per request, default is 100")
+@click.option('--archive', '-a', 'archive_path', default=None,
+               help="Also save the current records to this archive")
+@click.pass_context
+def mirror_records(ctx, directory, user, full, page_size, archive_path):
+    """Update a local copy of the community or user records.
+
+    Only records updated since the last run are requested, each
+    version of a record is stored once. Run with --full from time to
+    time to find deleted records.
+
+    Parameters
+    ----------
+    ctx: dict
+        Click context obj including api information 
+    directory: str
+        Mirror directory, created on first run
+
+    Returns
+    -------
+    """
+    from mirror import mirror, iter_mirror
+    from metrics import add_records
+    ctx = setup_ctx(ctx)
+    zen_log = ctx.obj['log']
+    zen_log.info(f"Mirroring {'user' if user else ctx.obj['community_id']}" +
+                 f" records to {directory}, full: {full}")
+    counts = mirror(ctx.obj, directory, user=user, full=full,
+                    page_size=page_size)
+    add_records(sum(counts.values()))
+    zen_log.info("Mirror: %s", counts)
+    print(", ".join(f"{v} {k}" for k, v in counts.items()))
+    if archive_path:
+        from archive import write_archive
+        nrec = write_archive(iter_mirror(directory), archive_path)
+        zen_log.info(f"Written {nrec} records to {archive_path}")
+
+
+@zen.command(name='serve')
+@click.option('--socket', '-s', 'path', default=None,
+               help="Unix socket to listen on, default is ~/.zenmeta.sock" +
+                    " or ZENMETA_SOCKET")
+@click.pass_context
+def serve(ctx, path):
+    """Run commands sent by other zen processes from one long-running process.
+
+    While the server is running list, meta and community commands are
+    forwarded to it, stop it with Ctrl-C or SIGTERM.
+
+    Parameters
+    ----------
+    ctx: dict
+        Click context obj including api information 
+    path: str
+        Unix socket path
+
+    Returns
+    -------
+    """
+    from server import serve, socket_path
+    ctx = setup_ctx(ctx)
+    serve(path or socket_path(), ctx.obj['log'], ctx.find_root().command)
+
+
 if __name__ == '__main__':
-    zen()
+    zen_catch()
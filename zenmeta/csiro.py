@@ -1,11 +1,19 @@
-import json
-from bs4 import BeautifulSoup
+import argparse
+import ast
+import csv
 import sys
-from util import read_json, convert_for
-import json
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
+from util import read_json, convert_for, get_session, batches
+from cache import cached_extract
+import zjson
 from exception import ZenException
 
 
+# Increase when extract_fields output changes, to invalidate cached fields
+EXTRACTOR_VERSION = 2
+
+
 def process_urls(landing, related):
     """
     """
@@ -13,7 +21,8 @@ def process_urls(landing, related):
     links.append({'DAP': landing['href']})
     for l in related:
         links.append({l['type']: l['address']})
-    links_unique = [dict(t) for t in {tuple(d.items()) for d in links}]
+    # dict keeps insertion order so output is the same at every run
+    links_unique = [dict(t) for t in dict.fromkeys(tuple(d.items()) for d in links)]
     return links_unique
 
 
@@ -114,72 +123,283 @@ def convert_spatial(spatial):
     return geo 
 
 
-def main():
-    fname = sys.argv[1]
-    data = read_json(fname)
-    keys = [k for k in data.keys()]
-    print(keys)
-    ##       'contributors',   
-    csiro_id = data['dataCollectionId'] 
+def extract_fields(data):
+    """Extract the fields we use from a DAP collection json
+
+    Only values read from the collection are returned, so they can be
+    cached, parties, links, dates and extents are built from them by
+    convert_fields.
+
+    Parameters
+    ----------
+    data : bytes
+        The collection json as returned by the DAP api
+
+    Returns
+    -------
+    fields : dict
+        Title, people, dates, links, codes, extents and the other
+        values needed to build the plan
+    """
+    data = zjson.loads(data)
+    fields = {}
+    # these attributes are already named as we want them in output
+    for k in ['dataCollectionId', 'title', 'doi', 'description', 'licence',
+              'keywords', 'collectionContentType', 'fieldsOfResearch',
+              'attributionStatement', 'andsPid', 'dataStartDate',
+              'dataEndDate', 'contact']:
+        fields[k] = data.get(k, None)
+    fields['licence_link'] = data['licenceLink']['href']
+    # only the keys present, get_parties checks if there is a contact
+    fields['people'] = {k: data[k] for k in ['leadResearcher', 'contact',
+                        'allNames', 'organisations'] if k in data}
+    fields['published'] = data['published']
+    fields['access'] = {k: data[k] for k in
+                        ['access', 'accessLevel', 'rights', 'dataRestricted']}
+    fields['landing_page'] = data.get('landingPage')
+    fields['related_links'] = data.get('relatedLinks', [])
+    fields['spatial'] = data.get('spatialParameters', None)
+    # fields added to the description by process_description
+    fields['extra'] = {k: data.get(k, None) for k in ['lineage', 'credit',
+        'size', 'keywords', 'organisationalLevels', 'project', 'activity',
+        'withdrawn']}
+    return fields
+
+
+def convert_fields(fields):
+    """Map the fields extracted from a DAP collection to a plan
 
+    Parameters
+    ----------
+    fields : dict
+        The fields returned by extract_fields
+
+    Returns
+    -------
+    out : dict
+        The plan
+    """
     # initial output dict
     # Retrieve string tags
     out = {}
     # these attributes are already named as we want them in output
     identical = ['title', 'doi', 'description']
-    out['license'] = data['licence']
-    if "," in data['keywords']:
-        out['keywords'] = data['keywords'].split(",")
+    out['license'] = fields['licence']
+    if "," in fields['keywords']:
+        out['keywords'] = fields['keywords'].split(",")
     else:
-        out['keywords'] = data['keywords'].split(";")
+        out['keywords'] = fields['keywords'].split(";")
     for k in identical:
-        out[k] = data[k]
+        out[k] = fields[k]
     out['alt_title'] = "" 
 
     #'metadata', 'data', 'serviceCount', 'supportingFiles',
     #'spatialParameters'
 
-    out['license_link'] = data['licenceLink']['href']
+    out['license_link'] = fields['licence_link']
     res_types = {'Data': {'id': 'dataset', 'title': "Dataset"},
                  'Software': {'id': 'software', 'title': "Software"},
                  'Service': {'id': 'service', 'title': 'Web service'}}
-    out['resource_type'] = res_types[data['collectionContentType']]
+    out['resource_type'] = res_types[fields['collectionContentType']]
 
-    for_codes = data['fieldsOfResearch']
+    for_codes = fields['fieldsOfResearch']
     out['for_codes'] = []
     for c in for_codes:
         codes20 = convert_for(c)
         out['for_codes'].extend(codes20)
  
-    out['parties'] = get_parties(data, keys)
+    people = fields['people']
+    out['parties'] = get_parties(people, list(people.keys()))
 
-    out['publication_date'], year = get_dates(data)
+    out['publication_date'], year = get_dates(fields)
     out['citation'] = " ".join(["<p>Preferred citation:</p>",
-                               f"<p>{data['attributionStatement']}</p>"]) 
-    extra = ['access', 'accessLevel', 'rights', 'dataRestricted']
-    for k in extra:
-        out['citation'] += f"<p>{k.capitalize()}: {data[k]} </p>"
-    if 'contact' in keys:
-        out['citation'] += f"<p>Contact: {' - '.join([v for v in data['contact'].values()])} </p>"
+                               f"<p>{fields['attributionStatement']}</p>"]) 
+    for k,v in fields['access'].items():
+        out['citation'] += f"<p>{k.capitalize()}: {v} </p>"
+    if fields['contact'] is not None:
+        out['citation'] += f"<p>Contact: {' - '.join([v for v in fields['contact'].values()])} </p>"
     # Links
-    out['related_identifiers'] = process_urls(data.get('landingPage'), data.get('relatedLinks',[]))
-    out['handle'] = data['andsPid']
+    out['related_identifiers'] = process_urls(fields['landing_page'],
+                                              fields['related_links'])
+    out['handle'] = fields['andsPid']
 
     # Find geo spatial extent
-    spatial = data.get('spatialParameters', None)
-    if spatial:
-        out['geospatial'] = convert_spatial(spatial) 
+    if fields['spatial']:
+        out['geospatial'] = convert_spatial(fields['spatial'])
         
-    out['time_coverage'] = [data['dataStartDate'], data['dataEndDate']] 
+    out['time_coverage'] = [fields['dataStartDate'], fields['dataEndDate']] 
     # save 2008 version of for_codes in description
-    out['description'] = process_description(out['description'], data, for_codes)
+    out['description'] = process_description(out['description'],
+                                             fields['extra'], for_codes)
     out['version'] = ""
     out['location'] = ""
     out['fformat'] = ""
     out['publisher'] = 'CSIRO (Australia)'
+    return out
+
+
+DAP_URL = "https://data.csiro.au/dap/ws/v2/collections"
+
+
+def detail_url(row):
+    """Return the collection detail url from a catalogue row
+
+    Parameters
+    ----------
+    row : dict
+        A row of the catalogue written by csiro/csiro_query.py
+
+    Returns
+    -------
+    url : str
+        The DAP url for the collection details
+    """
+    url = row.get('url', "")
+    # csiro_query saves the self link as it is returned by the api
+    if url.startswith("{"):
+        url = ast.literal_eval(url).get('href', "")
+    if not url.startswith("http"):
+        url = f"{DAP_URL}/{row['id']}"
+    return url
+
+
+def fetch_collection(session, url):
+    """Download a collection details json, errors are returned
+    instead of raised so one failed request doesn't stop the pipeline
+    """
+    try:
+        r = session.get(url, headers={"Accept": "application/json"})
+        r.raise_for_status()
+        return r.content, None
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+
+
+def _convert_worker(data):
+    """Convert a collection json to a plan in a worker process"""
+    try:
+        return convert_fields(extract_fields(data)), None
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+
+
+def convert_catalogue(catalogue, output, errors, fetchers=8, workers=None,
+                      chunk_size=100):
+    """Fetch and convert all the collections listed in a catalogue
+
+    Rows are read in chunks: the details of a chunk are downloaded by a
+    pool of threads while the previous chunk is being converted by a
+    pool of processes. Plans are written in catalogue order to one
+    json lines file, collections that fail are listed in errors.
+
+    Parameters
+    ----------
+    catalogue : str
+        Csv file with id, title, url, type columns
+    output : str
+        Json lines filename for plans
+    errors : str
+        Filename for the error report
+    fetchers : int, optional
+        Number of concurrent downloads (default 8)
+    workers : int, optional
+        Number of worker processes, if None use all cpus (default None)
+    chunk_size : int, optional
+        Number of collections downloaded at once (default 100)
+
+    Returns
+    -------
+    nplans : int
+        Number of plans written
+    nerrors : int
+        Number of collections skipped
+    """
+    nplans = 0
+    nerrors = 0
+
+    def process(chunk, futures):
+        nonlocal nplans, nerrors
+        fetched = [f.result() for f in futures]
+        ok = [i for i, (data, err) in enumerate(fetched) if err is None]
+        converted = dict(zip(ok, pool.map(_convert_worker,
+                                          [fetched[i][0] for i in ok])))
+        for i, row in enumerate(chunk):
+            out, err = converted.get(i, fetched[i])
+            if err is None:
+                fout.write(zjson.dumps(out) + "\n")
+                nplans += 1
+            else:
+                ferr.write(f"{row['id']}\t{err}\n")
+                nerrors += 1
+
+    with open(catalogue, newline='') as fcat, open(output, 'w', encoding='utf-8') as fout, \
+         open(errors, 'w') as ferr, get_session(fetchers) as session, \
+         ThreadPoolExecutor(max_workers=fetchers) as executor, \
+         Pool(workers) as pool:
+        pending = None
+        for chunk in batches(csv.DictReader(fcat), chunk_size):
+            futures = [executor.submit(fetch_collection, session,
+                       detail_url(row)) for row in chunk]
+            # convert previous chunk while this one is downloading
+            if pending:
+                process(*pending)
+            pending = (chunk, futures)
+        if pending:
+            process(*pending)
+    return nplans, nerrors
+
+def convert(args):
+    """Run the conversion selected by the main arguments"""
+    if args.catalogue:
+        nplans, nerrors = convert_catalogue(args.catalogue, args.output,
+            args.errors, fetchers=args.fetchers, workers=args.workers)
+        print(f"Converted {nplans} collections to {args.output}, " +
+              f"skipped {nerrors} listed in {args.errors}")
+        return
+    # extracted fields are cached by file content, so if the file was
+    # already converted only the mapping to a plan is run again
+    fields = cached_extract(args.fname, 'csiro', EXTRACTOR_VERSION,
+                            extract_fields, use_cache=args.use_cache)
+    out = convert_fields(fields)
+
+    with open(f"csiro_{fields['dataCollectionId']}_meta.json", 'w',
+              encoding='utf-8') as fp:
+        zjson.dump([out], fp)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert CSIRO DAP " +
+        "collections to plans")
+    parser.add_argument('fname', nargs='?', help="collection json file")
+    parser.add_argument('--catalogue', '-c', default=None,
+        help="Csv of collections from csiro_query.py, their details are " +
+             "downloaded and converted to one json lines file")
+    parser.add_argument('--output', '-o', default='csiro_plans.jsonl',
+        help="Output with --catalogue, default is csiro_plans.jsonl")
+    parser.add_argument('--errors', '-e', default='csiro_errors.txt',
+        help="Error report with --catalogue, default is csiro_errors.txt")
+    parser.add_argument('--fetchers', '-f', type=int, default=8,
+        help="Concurrent downloads with --catalogue, default is 8")
+    parser.add_argument('--workers', '-w', type=int, default=None,
+        help="Worker processes with --catalogue, default is number of cpus")
+    parser.add_argument('--no-cache', dest='use_cache', action='store_false',
+        help="Parse the file again instead of using cached fields")
+    parser.add_argument('--memory', action='store_true',
+        help="Trace memory and print peak memory at end, worker " +
+             "processes are not included")
+    args = parser.parse_args()
+
+    if args.fname is None and args.catalogue is None:
+        parser.error("a collection json file or --catalogue is required")
+    if args.memory:
+        import memory
+        memory.start('csiro')
+    try:
+        convert(args)
+    finally:
+        if args.memory:
+            memory.stop()
 
-    with open(f'csiro_{csiro_id}_meta.json', 'w') as fp:
-        json.dump([out], fp)
 
 if __name__ == "__main__":
     main()
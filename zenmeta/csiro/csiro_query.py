@@ -32,20 +32,30 @@ Try:
   pip install requests
 '''
 
-import json
+import argparse
+import datetime as dt
+import os
 import urllib
-import requests
 import sys
 import csv
+from concurrent.futures import ThreadPoolExecutor
 
+# the zenmeta modules are in the parent directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from util import get_session, read_state, write_state
 
-def write_records(resultPage, writer):
+
+def get_rows(resultPage):
     # Do something with the results...
     collections = resultPage.get("dataCollections")
     # then so far collections=None
     if not collections:
         collections = resultPage.get("dataCollection")
+    # an incremental search can return no new collections
+    if not collections:
+        return []
 
+    rows = []
     for collection in collections:
         title = collection["title"]
         detail = collection["self"]
@@ -53,50 +63,103 @@ def write_records(resultPage, writer):
         collectionType = collection["collectionType"]
         collectionCode = collection["dataCollectionId"]
         #description = collection["description"]
-    # write a row to the csv file
-        row = [str(collectionCode), title, detail, collectionType]
-        writer.writerow(row)
-    return writer
+    # add a row for the csv file
+        rows.append([str(collectionCode), title, detail, collectionType])
+    return rows
+
+
+def read_catalogue(fname):
+    # Return existing catalogue rows keyed by collection id,
+    # dict keeps the rows in the same order as the file
+    catalogue = {}
+    if os.path.exists(fname):
+        with open(fname, newline='') as f:
+            reader = csv.reader(f)
+            next(reader, None)
+            for row in reader:
+                catalogue[row[0]] = row
+    return catalogue
+
 
+def write_catalogue(catalogue, fname):
+    # Write to a temporary file first so an interrupted run
+    # doesn't lose the existing catalogue
+    tmpname = fname + ".tmp"
+    with open(tmpname, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(["id", "title", "url", "type"])
+        writer.writerows(catalogue.values())
+    os.replace(tmpname, fname)
 
-def run_query(url, queryParams, headers):
+
+def run_query(session, url, queryParams, headers):
     # Use % encoding for params
     queryParams = urllib.parse.urlencode(queryParams, quote_via=urllib.parse.quote)
-    r = requests.get(url, headers=headers, params=queryParams)
+    r = session.get(url, headers=headers, params=queryParams)
+    r.raise_for_status()
     print(r.url + "\n")
     resultPage = r.json()   # A dict of the response
     return resultPage
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Search DAP collections " +
+        "by FOR code and merge them into a csv catalogue")
+    parser.add_argument('forcode', help="FOR code to search for")
+    parser.add_argument('--query', '-q', default="",
+        help="Text to search for, default is none")
+    parser.add_argument('--output', '-o', default='csiro_records.csv',
+        help="Catalogue to merge results into, default is csiro_records.csv")
+    parser.add_argument('--state', '-s', default='csiro_harvest_state.json',
+        help="File storing the last harvested date for each FOR code " +
+             "and query, default is csiro_harvest_state.json")
+    parser.add_argument('--since', default=None,
+        help="Publication start date in ISO 8601 format, overrides the " +
+             "stored one")
+    parser.add_argument('--full', action='store_true',
+        help="Ignore the stored date and search all collections")
+    parser.add_argument('--workers', '-w', type=int, default=8,
+        help="Maximum number of concurrent page requests, default is 8")
+    parser.add_argument('--retries', '-r', type=int, default=5,
+        help="Number of retries for failed requests, default is 5")
+    args = parser.parse_args()
+
     # define api details
     baseURL = "https://data.csiro.au/dap/ws/v2/"
     endpoint = "collections"
     url = baseURL + endpoint
     
-    # open output file
-    f = open('csiro_records.csv', 'w')
-    # create the csv writer
-    writer = csv.writer(f)
-    header = ["id", "title", "url", "type"] 
-    writer.writerow(header)
+    # read existing catalogue, new results are merged into it
+    catalogue = read_catalogue(args.output)
+
+    # work out publication date window from last harvest
+    forcode = args.forcode
+    key = f"{forcode}|{args.query}"
+    state = read_state(args.state)
+    psd = args.since
+    if psd is None and not args.full:
+        psd = state.get(key, None)
+    ped = dt.datetime.now().astimezone().isoformat(timespec='seconds')
+    print(f"Searching collections published since {psd} to {ped}")
 
     # define first query
-    forcode = sys.argv[1]
-    #keyw = sys.argv[1]
     headers = {"Accept":"application/json"}
     queryParams = {
-               #"q": "climate",
                "p": 1,
                "rpp": 100,  # maximum value
                "for": forcode,
                "soud": False,
                "showFacets": True,
-               "psd":"2022-07-01T17:20:10+10:00",
-               "ped":"2023-07-13T10:20:10+10:00",
+               "ped": ped,
                "sb": "RELEVANCE"}
-    resultPage = run_query(url, queryParams, headers)
-    writer = write_records(resultPage, writer)
+    if args.query:
+        queryParams["q"] = args.query
+    if psd:
+        queryParams["psd"] = psd
+    session = get_session(args.workers, args.retries)
+    resultPage = run_query(session, url, queryParams, headers)
+    for row in get_rows(resultPage):
+        catalogue[row[0]] = row
     # Check if more than 1 page of results where returned and grab extra pages
     # Ex. last-href 'https://data.csiro.au/dap/ws/v2/collections.json?rpp=500&for=040503&soud=False&sb=RELEVANCE&p=64'
     last = resultPage['last']
@@ -104,14 +167,21 @@ def main():
         last_page = last['href'].split('&')[-1]
         npages = int(last_page[2:])
         print(f"Found {npages} pages of results")
-        # if more than 1 page retrieve all
-        for i in range(2, npages+1):
-            queryParams['p'] = i
-            resultPage = run_query(url, queryParams, headers)
-            writer = write_records(resultPage, writer)
-
-    # close the file
-    f.close()
+        # if more than 1 page retrieve all, pages are requested
+        # concurrently but map returns them in page order
+        pages = [dict(queryParams, p=i) for i in range(2, npages+1)]
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            for resultPage in executor.map(lambda params: run_query(
+                    session, url, params, headers), pages):
+                for row in get_rows(resultPage):
+                    catalogue[row[0]] = row
+    session.close()
+
+    # save catalogue and update state only once all pages were retrieved
+    write_catalogue(catalogue, args.output)
+    state[key] = ped
+    write_state(state, args.state)
+    print(f"Catalogue {args.output} has {len(catalogue)} collections")
 
 if __name__ == "__main__":
     main()
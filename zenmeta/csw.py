@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2021 ARC Centre of Excellence for Climate Extremes
+# author: Paola Petrelli <paola.petrelli@utas.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Harvest ISO19139 records from a GeoNetwork CSW endpoint and convert
+them to plans, by default from the NCI catalogue.
+
+Usage:
+  python csw.py [--url URL] [--output plans.jsonl] [--full]
+
+Only records modified since the last successful harvest are requested
+and appended to the output. Use --url to point to a different catalogue,
+i.e. the stand-in server in mock_csw.py to test the harvester:
+  python mock_csw.py xml_dir --error-rate 0.1 &
+  python csw.py --url http://127.0.0.1:5001/csw --full
+'''
+
+import argparse
+import datetime as dt
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from os.path import expanduser
+from lxml import etree
+from geonetwork import convert_xml
+from util import read_state, write_state, get_session
+from profiling import timed_iter
+import zjson
+from exception import ZenException
+
+
+CSW_URL = "https://geonetwork.nci.org.au/geonetwork/srv/eng/csw"
+NS = {'csw': 'http://www.opengis.net/cat/csw/2.0.2',
+      'gmd': 'http://www.isotc211.org/2005/gmd',
+      'gco': 'http://www.isotc211.org/2005/gco',
+      'ows': 'http://www.opengis.net/ows'}
+
+
+def get_records_page(session, url, start, page_size, since=None):
+    """Send a CSW GetRecords request for one page of ISO19139 records
+
+    Parameters
+    ----------
+    session : requests.Session
+        The session to send the request with
+    url : str
+        The CSW endpoint
+    start : int
+        Position of first record, starting from 1
+    page_size : int
+        Maximum number of records to return
+    since : str, optional
+        Only return records modified since this date (default None)
+
+    Returns
+    -------
+    results : lxml Element
+        The csw:SearchResults element
+    """
+    params = {'service': 'CSW', 'version': '2.0.2', 'request': 'GetRecords',
+              'typeNames': 'gmd:MD_Metadata', 'resultType': 'results',
+              'namespace': f"xmlns(gmd={NS['gmd']})",
+              'outputSchema': NS['gmd'], 'elementSetName': 'full',
+              'startPosition': start, 'maxRecords': page_size}
+    if since:
+        params['constraintLanguage'] = 'CQL_TEXT'
+        params['constraint_language_version'] = '1.1.0'
+        params['constraint'] = f"Modified >= '{since}'"
+    r = session.get(url, params=params)
+    if r.status_code >= 400:
+        raise ZenException(f"CSW request failed: {r.status_code} {r.url}")
+    root = etree.fromstring(r.content)
+    if etree.QName(root).localname == 'ExceptionReport':
+        text = " ".join(root.itertext()).strip()
+        raise ZenException(f"CSW exception: {text}")
+    results = root.find('csw:SearchResults', NS)
+    if results is None:
+        raise ZenException(f"No SearchResults in CSW response: {r.url}")
+    return results
+
+
+def convert_page(results, start=1):
+    """Convert the records in a page of results to plans
+
+    Parameters
+    ----------
+    results : lxml Element
+        The csw:SearchResults element
+    start : int, optional
+        Position of the first record of the page (default 1)
+
+    Yields
+    ------
+    geo_id : str
+        The record file identifier, or its position in the results
+        if it has none
+    plan : dict or None
+        The plan, None if the record could not be converted
+    error : str or None
+        The error message if the conversion failed
+    """
+    for i, record in enumerate(results.iterfind('gmd:MD_Metadata', NS)):
+        geo_id = record.findtext('gmd:fileIdentifier/gco:CharacterString',
+                                 namespaces=NS)
+        if not geo_id:
+            yield f"record {start + i}", None, "No fileIdentifier"
+            continue
+        try:
+            plan = convert_xml(etree.tostring(record), geo_id)
+            yield geo_id, plan, None
+        except Exception as e:
+            yield geo_id, None, f"{type(e).__name__}: {e}"
+
+
+def fetch_pages(fetch, starts, workers):
+    """Fetch pages concurrently and yield them in order
+
+    At most 2 * workers pages are requested ahead of the one being
+    yielded, so pages waiting to be converted don't pile up in memory.
+
+    Parameters
+    ----------
+    fetch : function
+        Called with the start position, returns the page
+    starts : iterable(int)
+        Start positions of the pages
+    workers : int
+        Maximum number of concurrent requests
+
+    Yields
+    ------
+    page : object
+        The pages returned by fetch, in the order of starts
+    """
+    starts = iter(starts)
+    window = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for start in itertools.islice(starts, 2 * workers):
+            window.append(executor.submit(fetch, start))
+        while window:
+            page = window.popleft().result()
+            for start in itertools.islice(starts, 1):
+                window.append(executor.submit(fetch, start))
+            yield page
+
+
+def harvest(url, output, errors, page_size=50, workers=4, since=None):
+    """Harvest all matching records, fetching pages concurrently
+
+    The first page gives the number of matching records, the other
+    pages are then requested in parallel. Pages are converted in order
+    as soon as they arrive and plans written to a json lines file.
+    With since the plans are appended to output, so it keeps the
+    records of the previous harvests.
+
+    Parameters
+    ----------
+    url : str
+        The CSW endpoint
+    output : str
+        Json lines filename for plans
+    errors : str
+        Filename for records that could not be converted
+    page_size : int, optional
+        Records per GetRecords request (default 50)
+    workers : int, optional
+        Maximum number of concurrent requests (default 4)
+    since : str, optional
+        Only harvest records modified since this date (default None)
+
+    Returns
+    -------
+    nplans : int
+        Number of plans written
+    nerrors : int
+        Number of records skipped
+    """
+    nplans = 0
+    nerrors = 0
+    mode = 'a' if since else 'w'
+    with get_session(workers) as session, \
+         open(output, mode, encoding='utf-8') as fout, open(errors, 'w') as ferr:
+        first = get_records_page(session, url, 1, page_size, since)
+        total = int(first.get('numberOfRecordsMatched', 0))
+        starts = range(1 + page_size, total + 1, page_size)
+        pages = fetch_pages(lambda s: get_records_page(session, url, s,
+                            page_size, since), starts, workers)
+        for start, results in zip(itertools.chain([1], starts),
+                                  timed_iter(_chain(first, pages), 'fetch')):
+            for geo_id, plan, err in timed_iter(convert_page(results, start),
+                                                'convert'):
+                if err is None:
+                    fout.write(zjson.dumps(plan) + "\n")
+                    nplans += 1
+                else:
+                    ferr.write(f"{geo_id}\t{err}\n")
+                    nerrors += 1
+    return nplans, nerrors
+
+
+def _chain(first, others):
+    """Yield first then all the others"""
+    yield first
+    yield from others
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Harvest geonetwork " +
+        "records via CSW and convert them to plans")
+    parser.add_argument('--url', default=CSW_URL,
+        help=f"CSW endpoint, default is {CSW_URL}")
+    parser.add_argument('--output', '-o', default='csw_plans.jsonl',
+        help="Output json lines file, default is csw_plans.jsonl")
+    parser.add_argument('--errors', '-e', default='csw_errors.txt',
+        help="Error report, default is csw_errors.txt")
+    parser.add_argument('--page-size', type=int, default=50,
+        help="Records per request, default is 50")
+    parser.add_argument('--workers', '-w', type=int, default=4,
+        help="Concurrent requests, default is 4")
+    parser.add_argument('--full', action='store_true',
+        help="Harvest all records, ignoring the last harvest date")
+    parser.add_argument('--state', default=expanduser('~/.zenmeta_csw_state.json'),
+        help="File storing last harvest date for each endpoint")
+    parser.add_argument('--memory', action='store_true',
+        help="Trace memory and print peak memory of each stage at end")
+    args = parser.parse_args()
+
+    if args.memory:
+        import memory
+        memory.start('csw')
+    try:
+        state = read_state(args.state)
+        since = None if args.full else state.get(args.url, None)
+        # use the time the harvest started so changes made while
+        # harvesting are picked up next time
+        started = dt.datetime.now(dt.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        nplans, nerrors = harvest(args.url, args.output, args.errors,
+            page_size=args.page_size, workers=args.workers, since=since)
+        state[args.url] = started
+        write_state(state, args.state)
+        print(f"Harvested {nplans} records modified since {since} to " +
+              f"{args.output}, skipped {nerrors} listed in {args.errors}")
+    finally:
+        if args.memory:
+            memory.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,369 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2021 ARC Centre of Excellence for Climate Extremes
+# author: Paola Petrelli <paola.petrelli@utas.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Find likely duplicate datasets across plans and records harvested from
+geonetwork, the CSIRO DAP and Zenodo before uploading them.
+
+Usage:
+  python dedup.py plans1.jsonl plans2.json ... [-o duplicates.json]
+  zen meta -f plans.jsonl --dedup
+
+Records are linked if they share a DOI, handle or url, or if their
+titles and abstracts are similar. Similar texts are found with MinHash
+signatures and locality sensitive hashing, so records are never
+compared pairwise across the whole catalogue. The text the converters
+add to every description, such as the NCI access note and the
+Lineage/Credit/Format labels, is removed first, so it doesn't make
+unrelated records look similar.
+'''
+
+import argparse
+import hashlib
+import re
+import sys
+from collections import defaultdict
+from urllib.parse import urlsplit
+from util import iter_json
+import zjson
+
+
+# signature length, bands and rows per band used for LSH,
+# with 16 bands of 4 rows pairs with similarity above ~0.5 are candidates
+NUM_HASHES = 64
+BANDS = 16
+ROWS = NUM_HASHES // BANDS
+MAX_HASH = 2**64
+
+# text added to descriptions and citations by geonetwork.py, csiro.py
+# and zenodo.py, the same for every record. Only the labels of the
+# extra fields are removed, their values are kept
+BOILERPLATE = re.compile(r"Official metadata and access to the data is "
+    r"via the NCI geonetwork record in related identifiers\.|"
+    r"Record listed as withdrawn!!!|"
+    r"<p>\s*(Preferred citation|Update|Format|Lineage|Credit|Classification|"
+    r"Keywords|FOR codes|Size|Project|Activity|Contact):", re.IGNORECASE)
+
+
+def normalise_doi(doi):
+    """Return DOI in lower case without resolver prefix"""
+    doi = doi.strip().lower()
+    doi = re.sub(r'^(https?://)?(dx\.)?doi\.org/', '', doi)
+    doi = re.sub(r'^doi:', '', doi)
+    return doi if doi.startswith('10.') else ""
+
+
+def normalise_url(url):
+    """Return url without scheme, www, default ports, query order
+    and trailing slash differences, lower case host
+    """
+    url = url.strip()
+    if not url.startswith(('http://', 'https://')):
+        return ""
+    parts = urlsplit(url)
+    host = parts.hostname or ""
+    if host.startswith('www.'):
+        host = host[4:]
+    path = parts.path.rstrip('/')
+    query = "&".join(sorted(parts.query.split('&'))) if parts.query else ""
+    norm = host + path
+    if query:
+        norm += "?" + query
+    # geonetwork uses the fragment to identify the record
+    if parts.fragment.startswith('/'):
+        norm += "#" + parts.fragment
+    return norm
+
+
+def record_keys(rec):
+    """Return identifier keys and text of a plan or an api record
+
+    Parameters
+    ----------
+    rec : dict
+        A plan from geonetwork.py/csiro.py or a zenodo/invenio record
+
+    Returns
+    -------
+    keys : set(str)
+        Normalised identifiers prefixed by type, i.e. doi:10.1234/abc
+    title : str
+        The record title
+    text : str
+        Title and description without html
+    """
+    meta = rec.get('metadata', rec)
+    keys = set()
+    dois = [rec.get('doi', ""), meta.get('doi', "")]
+    dois.append(rec.get('pids', {}).get('doi', {}).get('identifier', ""))
+    urls = []
+    handles = [rec.get('handle', "")]
+    for rel in meta.get('related_identifiers', []):
+        if 'identifier' in rel:
+            scheme = rel.get('scheme', 'url')
+            if scheme == 'doi':
+                dois.append(rel['identifier'])
+            elif scheme == 'handle':
+                handles.append(rel['identifier'])
+            else:
+                urls.append(rel['identifier'])
+        else:
+            # plans use {type: url}
+            urls.extend(rel.values())
+    for ident in meta.get('identifiers', []) + meta.get('alternate_identifiers', []):
+        if ident.get('scheme') == 'handle':
+            handles.append(ident['identifier'])
+        elif ident.get('scheme') == 'doi':
+            dois.append(ident['identifier'])
+    for link in rec.get('links', {}).values():
+        if isinstance(link, str) and '/api/' not in link:
+            urls.append(link)
+    keys.update(f"doi:{d}" for d in map(normalise_doi, filter(None, dois)) if d)
+    keys.update(f"handle:{h.strip().lower()}" for h in handles if h and h.strip())
+    keys.update(f"url:{u}" for u in map(normalise_url, urls) if u)
+    title = meta.get('title', "")
+    text = strip_boilerplate(f"{title} {meta.get('description', '')}")
+    return keys, title, text
+
+
+def strip_boilerplate(text):
+    """Return text without html tags and the converters boilerplate"""
+    text = BOILERPLATE.sub(' ', text)
+    return re.sub(r'<[^>]+>', ' ', text)
+
+
+def shingles(text, size=3):
+    """Return the set of word n-grams in text"""
+    words = re.findall(r'\w+', text.lower())
+    if len(words) < size:
+        return {" ".join(words)} if words else set()
+    return {" ".join(words[i:i+size]) for i in range(len(words) - size + 1)}
+
+
+def minhash(tokens, num_hashes=NUM_HASHES):
+    """MinHash signature using one permutation hashing
+
+    Each token is hashed once, the hash picks one of num_hashes bins
+    and each bin keeps its minimum value. Empty bins take the value of
+    the next non-empty bin so that signatures can be compared by slot.
+
+    Parameters
+    ----------
+    tokens : set(str)
+        The shingles of a text
+    num_hashes : int, optional
+        Length of signature (default NUM_HASHES)
+
+    Returns
+    -------
+    signature : tuple(int) or None
+        The signature, None if there are no tokens
+    """
+    if not tokens:
+        return None
+    bins = [None] * num_hashes
+    for t in tokens:
+        h = int.from_bytes(hashlib.blake2b(t.encode(), digest_size=8).digest(),
+                           'little')
+        b, v = h % num_hashes, h // num_hashes
+        if bins[b] is None or v < bins[b]:
+            bins[b] = v
+    # densify empty bins by rotation, borrowing from original values only
+    filled = list(bins)
+    for i in range(num_hashes):
+        if bins[i] is None:
+            j = 1
+            while bins[(i + j) % num_hashes] is None:
+                j += 1
+            filled[i] = bins[(i + j) % num_hashes] + j * MAX_HASH
+    return tuple(filled)
+
+
+def similarity(sig1, sig2):
+    """Estimate Jaccard similarity from two signatures"""
+    return sum(a == b for a, b in zip(sig1, sig2)) / len(sig1)
+
+
+def find(parent, i):
+    """Return root of i in union-find parent list"""
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+
+def find_duplicates(records, threshold=0.7, max_shared=10, max_bucket=100):
+    """Group records that are likely the same dataset
+
+    Parameters
+    ----------
+    records : list(dict)
+        The records as returned by load_records, each with source,
+        index, identifier keys, title and text signature
+    threshold : float, optional
+        Minimum estimated similarity of texts (default 0.7)
+    max_shared : int, optional
+        Identifiers shared by more records are ignored, as they are
+        likely generic links such as a service home page (default 10)
+    max_bucket : int, optional
+        LSH buckets with more records are skipped with a warning, as
+        they are texts left with only common words and would be
+        compared pairwise (default 100)
+
+    Returns
+    -------
+    clusters : list(dict)
+        Each cluster has the list of members and the reasons they
+        were linked
+    """
+    n = len(records)
+    parent = list(range(n))
+    reasons = defaultdict(set)
+
+    def union(i, j, reason):
+        ri, rj = find(parent, i), find(parent, j)
+        if ri != rj:
+            parent[rj] = ri
+        reasons[(min(i, j), max(i, j))].add(reason)
+
+    # exact identifiers
+    postings = defaultdict(list)
+    for i, rec in enumerate(records):
+        for k in rec['keys']:
+            postings[k].append(i)
+    for k, idxs in postings.items():
+        if 1 < len(idxs) <= max_shared:
+            for j in idxs[1:]:
+                union(idxs[0], j, k)
+
+    # similar texts, records in the same LSH bucket are candidates
+    buckets = defaultdict(list)
+    for i, rec in enumerate(records):
+        if rec['signature'] is None:
+            continue
+        for b in range(BANDS):
+            band = rec['signature'][b*ROWS:(b+1)*ROWS]
+            buckets[(b, band)].append(i)
+    skipped = []
+    for (band, _), idxs in buckets.items():
+        if len(idxs) < 2:
+            continue
+        if len(idxs) > max_bucket:
+            skipped.append(len(idxs))
+            continue
+        for a in range(len(idxs)):
+            for b in range(a + 1, len(idxs)):
+                i, j = idxs[a], idxs[b]
+                sig1, sig2 = records[i]['signature'], records[j]['signature']
+                # a pair is compared only in the first band they share,
+                # so there's no need to remember the pairs checked
+                if any(sig1[c*ROWS:(c+1)*ROWS] == sig2[c*ROWS:(c+1)*ROWS]
+                       for c in range(band)):
+                    continue
+                sim = similarity(sig1, sig2)
+                if sim >= threshold:
+                    union(i, j, f"text:{sim:.2f}")
+    if skipped:
+        print(f"Warning: skipped {len(skipped)} text buckets with more than " +
+              f"{max_bucket} records, largest has {max(skipped)}", file=sys.stderr)
+
+    groups = defaultdict(list)
+    for i in range(n):
+        groups[find(parent, i)].append(i)
+    group_reasons = defaultdict(set)
+    for (i, j), why in reasons.items():
+        group_reasons[find(parent, i)].update(why)
+    clusters = []
+    for root, idxs in groups.items():
+        if len(idxs) < 2:
+            continue
+        members = [{'source': records[i]['source'], 'index': records[i]['index'],
+                    'title': records[i]['title']} for i in idxs]
+        clusters.append({'members': members,
+                         'reasons': sorted(group_reasons[root])})
+    return clusters
+
+
+def load_records(fnames):
+    """Read records from json or json lines files and compute their
+    identifier keys and text signatures
+    """
+    records = []
+    for fname in fnames:
+        for idx, rec in enumerate(iter_json(fname)):
+            keys, title, text = record_keys(rec)
+            records.append({'source': fname, 'index': idx, 'keys': keys,
+                            'title': title,
+                            'signature': minhash(shingles(text))})
+    return records
+
+
+def write_report(clusters, fname):
+    """Save the clusters found by find_duplicates as json"""
+    with open(fname, 'wb') as f:
+        f.write(zjson.dumpb(clusters, indent=2))
+
+
+def duplicate_indices(fname, report, threshold=0.7):
+    """Return the positions of the records in a file that are likely
+    duplicates of an earlier record in the same file
+
+    The first record of each cluster is kept, the clusters are saved
+    to report.
+
+    Parameters
+    ----------
+    fname : str
+        Json or json lines file of plans or records, or an archive
+    report : str
+        Json file for the clusters found
+    threshold : float, optional
+        Minimum estimated similarity of texts (default 0.7)
+
+    Returns
+    -------
+    skip : set(int)
+        Positions in the file of the records to skip
+    """
+    clusters = find_duplicates(load_records([fname]), threshold=threshold)
+    write_report(clusters, report)
+    return {m['index'] for c in clusters for m in c['members'][1:]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Find likely duplicate " +
+        "datasets across plans and records")
+    parser.add_argument('fnames', nargs='+', help="json or json lines " +
+        "files of plans or records")
+    parser.add_argument('--output', '-o', default='duplicates.json',
+        help="Report of duplicate clusters, default is duplicates.json")
+    parser.add_argument('--threshold', '-t', type=float, default=0.7,
+        help="Minimum similarity of title and abstract, default is 0.7")
+    parser.add_argument('--max-bucket', type=int, default=100,
+        help="Skip groups of candidate texts larger than this, default is 100")
+    args = parser.parse_args()
+
+    records = load_records(args.fnames)
+    clusters = find_duplicates(records, threshold=args.threshold,
+                               max_bucket=args.max_bucket)
+    write_report(clusters, args.output)
+    print(f"Found {len(clusters)} clusters of likely duplicates in " +
+          f"{len(records)} records, see {args.output}")
+
+
+if __name__ == "__main__":
+    main()
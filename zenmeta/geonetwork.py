@@ -1,11 +1,92 @@
-import json
+import argparse
+import glob
+import os
 import sys
-import json
 import re
-from bs4 import BeautifulSoup
+from io import BytesIO
+from functools import partial
+from multiprocessing import Pool
+from lxml import etree
 from util import read_json, convert_for
+from cache import cached_extract
+import zjson
 from exception import ZenException
 
+
+# Increase when extract_fields output changes, to invalidate cached fields
+EXTRACTOR_VERSION = 1
+# Tags for which we keep the text of the first occurrence, as find_string
+TEXT_TAGS = ('title', 'alternateTitle', 'metadataStandardVersion',
+    'dataSetURI', 'useLimitation', 'MD_Format', 'mediumName', 'code',
+    'abstract', 'maintenanceAndUpdateFrequency', 'LI_Lineage', 'credit',
+    'MD_ClassificationCode', 'abs_code', 'abs_code_description')
+# Tags for which we keep the first occurrence text split in words
+SPLIT_TAGS = ('EX_GeographicBoundingBox', 'TimePeriod')
+# Tags for which we keep the text of every occurrence
+LIST_TAGS = ('keyword', 'URL', 'CI_Date')
+# Tags read inside each CI_ResponsibleParty
+PARTY_TAGS = ('CI_RoleCode', 'individualName', 'organisationName')
+
+
+def _localname(tag):
+    """Return tag name without namespace"""
+    return tag.rpartition('}')[2]
+
+
+def extract_fields(data):
+    """Extract all the fields we use from a ISO19139 xml record
+
+    The record is parsed once with lxml and every field is collected
+    in the same traversal. The values match what the old BeautifulSoup
+    find_string and find_all calls returned, except for whitespace
+    between tags in the list fields, which are only used once split.
+
+    Parameters
+    ----------
+    data : bytes or str
+        The xml record
+
+    Returns
+    -------
+    fields : dict
+        The fields values keyed by tag name, parties are under
+        CI_ResponsibleParty as a list of dictionaries
+    """
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    fields = {k: "" for k in TEXT_TAGS + SPLIT_TAGS}
+    fields.update({k: [] for k in LIST_TAGS})
+    fields['CI_ResponsibleParty'] = []
+    found = set()
+    party = None
+    for event, elem in etree.iterparse(BytesIO(data), events=('start', 'end'),
+                                       remove_comments=True, remove_pis=True):
+        tag = _localname(elem.tag)
+        if event == 'start':
+            if tag == 'CI_ResponsibleParty':
+                party = {k: "" for k in PARTY_TAGS}
+                party_found = set()
+            continue
+        if party is not None:
+            if tag in PARTY_TAGS and tag not in party_found:
+                party[tag] = "".join(elem.itertext()).strip()
+                party_found.add(tag)
+            elif tag == 'CI_ResponsibleParty':
+                fields['CI_ResponsibleParty'].append(party)
+                party = None
+        if tag in LIST_TAGS:
+            fields[tag].append("".join(elem.itertext()))
+        elif tag in found:
+            continue
+        elif tag in TEXT_TAGS:
+            fields[tag] = "".join(elem.itertext()).strip()
+            found.add(tag)
+        elif tag in SPLIT_TAGS:
+            fields[tag] = "".join(elem.itertext()).split()
+            found.add(tag)
+    return fields
+
+
 # Finding all instances of tag
 def find_string(soup, tag, multiple=False):
     """Find tag of a string element if not None return text
@@ -20,12 +101,27 @@ def find_string(soup, tag, multiple=False):
     return val
 
 
+def extract_fields_soup(data):
+    """Extract the same fields of extract_fields using BeautifulSoup
+
+    This is the original implementation, which walks the tree once for
+    each field. It is kept to check and benchmark extract_fields.
+    """
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(data, "xml")
+    fields = {k: find_string(soup, k) for k in TEXT_TAGS}
+    fields.update({k: find_string(soup, k, multiple=True) for k in SPLIT_TAGS})
+    fields.update({k: [x.text for x in soup.find_all(k)] for k in LIST_TAGS})
+    fields['CI_ResponsibleParty'] = [{k: find_string(p, k) for k in PARTY_TAGS}
+        for p in soup.find_all('CI_ResponsibleParty')]
+    return fields
+
+
 def process_urls(urls, geo_id):
     """
     """
     links = []
-    for x in urls:
-        url = x.text
+    for url in urls:
         if any(s in url for s in ['researchdata.edu.au','researchdata.ands.org.au']):
             links.append({'RDA': url})
         elif 'thredds' in url:
@@ -33,14 +129,14 @@ def process_urls(urls, geo_id):
         else:
             links.append({'other': url})
     links.append({'geonetwork': f"https://geonetwork.nci.org.au/geonetwork/srv/eng/catalog.search#/metadata/{geo_id}"})
-    links_unique = [dict(t) for t in {tuple(d.items()) for d in links}]
+    # dict keeps insertion order so output is the same at every run
+    links_unique = [dict(t) for t in dict.fromkeys(tuple(d.items()) for d in links)]
     return links_unique
 
 
-def process_abstract(soup):
-    """Extract abstract then looks for urls and wraps them in html
+def process_abstract(abstract):
+    """Looks for urls in abstract and wraps them in html
     """
-    abstract = find_string(soup, 'abstract')
     # find all occurences of http and add a html link
     idxs = [m.start() for m in re.finditer('http', abstract)] 
     # to add to index to keep into account its new position after html chars added
@@ -64,18 +160,17 @@ def process_abstract(soup):
     return abstract
 
 
-def process_description(soup, keywords, for_codes):
+def process_description(fields, keywords, for_codes):
     """Put together description adding to the abstract other fields that cannot be directly mapped to other fields
     """
 
     # retrieve all the relevant fields
-    abstract = find_string(soup, 'abstract')
-    abstract = process_abstract(soup)
-    update = "<p>Update: " + find_string(soup, 'maintenanceAndUpdateFrequency') + "</p>"
-    fformat = "<p>Format: " + find_string(soup, 'MD_Format') + "</p>"
-    lineage = "<p>Lineage: " + find_string(soup, 'LI_Lineage') + "</p>"
-    credit = "<p>Credit: " + find_string(soup, 'credit') + "</p>"
-    classification = "<p>Classification: " + find_string(soup, 'MD_ClassificationCode') + "</p>"
+    abstract = process_abstract(fields['abstract'])
+    update = "<p>Update: " + fields['maintenanceAndUpdateFrequency'] + "</p>"
+    fformat = "<p>Format: " + fields['MD_Format'] + "</p>"
+    lineage = "<p>Lineage: " + fields['LI_Lineage'] + "</p>"
+    credit = "<p>Credit: " + fields['credit'] + "</p>"
+    classification = "<p>Classification: " + fields['MD_ClassificationCode'] + "</p>"
     official_record = "<p>Official metadata and access to the data is via the NCI geonetwork record in related identifiers.</p>"
     # temporarily add keywords and for_codes here as we're using FOR codes 2020 and geonetwork sues older version 
     keystr = f"<p>Keywords: {', '.join(keywords)}</p>"
@@ -86,11 +181,11 @@ def process_description(soup, keywords, for_codes):
     return description
 
 
-def get_codes(soup):
+def get_codes(fields):
     """Retrieve for codes and keywords
     """
-    code = find_string(soup, 'abs_code')
-    term = find_string(soup, 'abs_code_description')
+    code = fields['abs_code']
+    term = fields['abs_code_description']
     codes = [] 
     if code != "":
         forc = {}
@@ -98,14 +193,14 @@ def get_codes(soup):
         forc['name'] = term
         codes.append(forc)
     keywords = []
-    keys = soup.find_all('keyword')
+    keys = fields['keyword']
     # check if there are more FOR codes in keywords
     #print(keys)
     if len(keys)>=0:
         for k in keys:
-            key = k.text.strip()
+            key = k.strip()
             if key is True:
-                key = k.text.strip()
+                key = k.strip()
                 if key[0] == "0":
                     bits = key.split()
                     if bits[0] != code:
@@ -115,17 +210,15 @@ def get_codes(soup):
     return keywords, codes
 
 
-def get_parties(soup):
+def get_parties(fields):
     """ Find parties
     """
-    parties = soup.find_all('CI_ResponsibleParty')
     people = [] 
-    for p in parties:
-        #role = p.find('CI_RoleCode').text.strip()
-        role = find_string(p,'CI_RoleCode')
+    for p in fields['CI_ResponsibleParty']:
+        role = p['CI_RoleCode']
         if role in ['author', 'owner', 'funder', 'principalInvestigator']:
-            person = { 'name': find_string(p, 'individualName'),
-                       'affiliation' : find_string(p, 'organisationName'),
+            person = { 'name': p['individualName'],
+                       'affiliation' : p['organisationName'],
                        'role': role, 'org': False} 
             if person['name'] == person['affiliation']:
                 person['org'] = True
@@ -142,7 +235,7 @@ def get_parties(soup):
     return people, cite_authors
 
 
-def get_dates(soup):
+def get_dates(fields):
     """Get relevant dates
     some date elements have "date time type", in others date and time are joined
     string is split and last "bit" is the type, other bits are joined but only
@@ -151,9 +244,8 @@ def get_dates(soup):
     """
 
     dates = {}
-    ci_dates = soup.find_all('CI_Date')
-    for d in ci_dates:
-        bits = d.text.split()
+    for text in fields['CI_Date']:
+        bits = text.split()
         dtype = bits[-1]
         date = " ".join(bits[:-1])[0:10] 
         dates[dtype] = date 
@@ -166,38 +258,45 @@ def get_dates(soup):
     return dates, year
 
 
-def main():
-    fname = sys.argv[1]
-    geo_id = fname.split(".")[0]
-    with open(fname, 'r') as f:
-        data = f.read()
-    # parse xml with Beautiful Soup
-    soup = BeautifulSoup(data, "xml")
+def convert_fields(fields, geo_id):
+    """Map the fields extracted from a ISO19139 record to a plan
 
+    Parameters
+    ----------
+    fields : dict
+        The fields returned by extract_fields
+    geo_id : str
+        The geonetwork id of the record
+
+    Returns
+    -------
+    out : dict
+        The plan
+    """
     # initial output dict
     # Retrieve string tags
     out = {}
-    out['title'] = find_string(soup, 'title')
-    out['alt_title'] = find_string(soup, 'alternateTitle')
-    out['version'] = find_string(soup, 'metadataStandardVersion')
-    out['doi'] = find_string(soup, 'dataSetURI')
-    out['license'] = find_string(soup, 'useLimitation')
-    out['fformat'] = find_string(soup, 'MD_Format')
-    path = find_string(soup, 'mediumName')
-    project = find_string(soup, 'code')
+    out['title'] = fields['title']
+    out['alt_title'] = fields['alternateTitle']
+    out['version'] = fields['metadataStandardVersion']
+    out['doi'] = fields['dataSetURI']
+    out['license'] = fields['useLimitation']
+    out['fformat'] = fields['MD_Format']
+    path = fields['mediumName']
+    project = fields['code']
     out['location'] = "".join(["<p>Direct access to the data is available on the NCI servers:</p>",
            f"<p>project: <a href='https://my.nci.org.au/mancini/login?next=/mancini/project/{project}'></a></p>",
            f"<p>path: {path}</p>"])
 
-    out['keywords'], for_codes  = get_codes(soup)
+    out['keywords'], for_codes  = get_codes(fields)
     out['for_codes'] = []
     for c in for_codes:
         codes20 = convert_for(c)
         out['for_codes'].extend(codes20)
  
-    out['parties'], cite_authors = get_parties(soup)
+    out['parties'], cite_authors = get_parties(fields)
 
-    dates, year = get_dates(soup)
+    dates, year = get_dates(fields)
     if dates['publication'] != "":
         out['publication_date'] = dates['publication']
     elif dates['creation'] != "":
@@ -211,18 +310,189 @@ def main():
                "<p>NCI Australia (2021): NCI THREDDS Data Service. NCI Australia. (Service)",
                "https://dx.doi.org/10.25914/608bfc062f4c7</p>"])
     # Links
-    urls = soup.find_all('URL')#.text.strip().split()
-    out['related_identifiers'] = process_urls(urls, geo_id)
+    out['related_identifiers'] = process_urls(fields['URL'], geo_id)
 
     # Find geo spatial extent
-    out['geospatial'] = find_string(soup, 'EX_GeographicBoundingBox', multiple=True)
-    out['time_coverage'] = find_string(soup, 'TimePeriod', multiple=True)
+    out['geospatial'] = fields['EX_GeographicBoundingBox']
+    out['time_coverage'] = fields['TimePeriod']
     # save 2008 version of for_codes in description
-    out['description'] = process_description(soup, out['keywords'], for_codes)
+    out['description'] = process_description(fields, out['keywords'], for_codes)
     out['publisher'] = 'NCI Australia'
+    return out
+
+
+def convert_xml(data, geo_id):
+    """Convert the content of a ISO19139 xml record to a plan
+
+    Parameters
+    ----------
+    data : bytes or str
+        The xml record
+    geo_id : str
+        The geonetwork id of the record
+
+    Returns
+    -------
+    out : dict
+        The plan
+    """
+    return convert_fields(extract_fields(data), geo_id)
+
+
+def file_geo_id(fname):
+    """Return the geonetwork id of a record file, its name without
+    directory and extension
+    """
+    return os.path.basename(fname).split(".")[0]
+
+
+def convert_file(fname, use_cache=True):
+    """Read a ISO19139 xml file and convert it to a plan,
+    the file name without extension is used as geonetwork id
+
+    Extracted fields are cached by file content, so if a file was
+    already converted only the mapping to a plan is run again.
+
+    Parameters
+    ----------
+    fname : str
+        The xml filename
+    use_cache : bool, optional
+        If False always parse the file (default True)
+
+    Returns
+    -------
+    out : dict
+        The plan
+    """
+    geo_id = file_geo_id(fname)
+    fields = cached_extract(fname, 'geonetwork', EXTRACTOR_VERSION,
+                            extract_fields, use_cache=use_cache)
+    return convert_fields(fields, geo_id)
+
+
+def _convert_worker(fname, use_cache=True):
+    """Convert a file in a worker process, errors are returned
+    instead of raised so one bad file doesn't stop the batch
+    """
+    try:
+        return fname, convert_file(fname, use_cache=use_cache), None
+    except Exception as e:
+        return fname, None, f"{type(e).__name__}: {e}"
+
+
+def find_files(paths):
+    """Expand directories and glob patterns to a sorted list of xml files
+
+    Parameters
+    ----------
+    paths : list(str)
+        Files, directories or glob patterns
+
+    Returns
+    -------
+    fnames : list(str)
+        Sorted and unique list of files
+    """
+    fnames = set()
+    for p in paths:
+        if os.path.isdir(p):
+            fnames.update(glob.glob(os.path.join(p, '*.xml')))
+        elif any(c in p for c in '*?['):
+            fnames.update(glob.glob(p))
+        else:
+            fnames.add(p)
+    return sorted(fnames)
+
+
+def convert_batch(paths, output, errors, workers=None, use_cache=True):
+    """Convert many xml files in parallel to one json lines plans file
+
+    Plans are written in the same order as the sorted input files,
+    files that cannot be converted are skipped and listed in errors.
+
+    Parameters
+    ----------
+    paths : list(str)
+        Files, directories or glob patterns
+    output : str
+        Json lines filename for plans
+    errors : str
+        Filename for the error report
+    workers : int, optional
+        Number of worker processes, if None use all cpus (default None)
+    use_cache : bool, optional
+        If False always parse the files (default True)
+
+    Returns
+    -------
+    nplans : int
+        Number of converted files
+    nerrors : int
+        Number of skipped files
+    """
+    fnames = find_files(paths)
+    nplans = 0
+    nerrors = 0
+    chunksize = max(1, len(fnames) // (4 * (workers or os.cpu_count() or 1)))
+    with Pool(workers) as pool, open(output, 'w', encoding='utf-8') as fout, \
+         open(errors, 'w') as ferr:
+        for fname, out, err in pool.imap(
+            partial(_convert_worker, use_cache=use_cache), fnames, chunksize):
+            if err is None:
+                fout.write(zjson.dumps(out) + "\n")
+                nplans += 1
+            else:
+                ferr.write(f"{fname}\t{err}\n")
+                nerrors += 1
+    return nplans, nerrors
+
+def convert(args):
+    """Run the conversion selected by the main arguments"""
+    if args.batch:
+        nplans, nerrors = convert_batch(args.paths, args.output, args.errors,
+                                        workers=args.workers,
+                                        use_cache=args.use_cache)
+        print(f"Converted {nplans} records to {args.output}, " +
+              f"skipped {nerrors} listed in {args.errors}")
+    else:
+        # the plan is saved as <geonetwork id>.json in the current
+        # directory
+        fname = args.paths[0]
+        out = convert_file(fname, use_cache=args.use_cache)
+        with open(f'{file_geo_id(fname)}.json', 'w', encoding='utf-8') as fp:
+            zjson.dump([out], fp)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert geonetwork " +
+        "ISO19139 xml records to plans")
+    parser.add_argument('paths', nargs='+', help="xml file, or with " +
+        "--batch any number of files, directories and glob patterns")
+    parser.add_argument('--batch', action='store_true', help="Convert " +
+        "all files to one json lines plans file")
+    parser.add_argument('--output', '-o', default='geonetwork_plans.jsonl',
+        help="Output file in batch mode, default is geonetwork_plans.jsonl")
+    parser.add_argument('--errors', '-e', default='geonetwork_errors.txt',
+        help="Error report in batch mode, default is geonetwork_errors.txt")
+    parser.add_argument('--workers', '-w', type=int, default=None,
+        help="Number of worker processes, default is number of cpus")
+    parser.add_argument('--no-cache', dest='use_cache', action='store_false',
+        help="Parse all files again instead of using cached fields")
+    parser.add_argument('--memory', action='store_true',
+        help="Trace memory and print peak memory at end, worker " +
+             "processes are not included")
+    args = parser.parse_args()
+
+    if args.memory:
+        import memory
+        memory.start('geonetwork')
+    try:
+        convert(args)
+    finally:
+        if args.memory:
+            memory.stop()
 
-    with open(f'{geo_id}.json', 'w') as fp:
-        json.dump([out], fp)
 
 if __name__ == "__main__":
     main()
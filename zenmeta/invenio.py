@@ -16,13 +16,16 @@
 # limitations under the License.
 
 import sys
-import json
 import requests
 import random
 import string
-from datetime import date
 from os.path import expanduser
-from util import post_json, put_json, get_token, read_json, get_records
+from util import (post_json, put_json, get_token, read_json, get_records,
+                  api_session)
+from cache import read_lookup, write_lookup
+import zjson
+from model import (Party, Record, dates_from_coverage, descriptions,
+                   license_rights, links_from_plan, polygon, split_parties)
 
 
 def set_invenio(ctx, production):
@@ -45,12 +48,17 @@ def set_invenio(ctx, production):
         base_url = 'https://oneclimate.acdguide.cloud.edu.au/api'
     else:
         base_url = 'https://zeroclimate.dmponline.cloud.edu.au/api'
+    # i.e. a local mock server for testing
+    if ctx.obj.get('api_url', None):
+        base_url = ctx.obj['api_url'].rstrip('/')
     ctx.obj['url'] = f'{base_url}/records'
     ctx.obj['deposit'] = f'{base_url}/records'
     ctx.obj['communities'] = f'{base_url}/communities'
+    ctx.obj['oai'] = base_url.replace('/api', '/oai2d')
     if ctx.obj['community_id'] == "":
         ctx.obj['community_id'] = "acdg"
-    ctx.obj['community_id_db'] = get_community_id(ctx.obj)
+    # community_id_db is resolved only by commands that need it,
+    # see get_community_id
     return ctx
 
 
@@ -76,43 +84,7 @@ def process_party(party, roles):
     party : dict
         A modified version of the author dictionary
     """
-    creator = {}
-    # open affiliations vocab to find id for institution
-    aff_dict = read_json('data/affiliations.json')
-    if 'affiliation' in [k for k in party.keys()]:
-        aff = party['affiliation']
-    # try to find affiliation name in key dictionary, if not try in 
-        aff_id = ""
-        try:
-            aff_id = aff_dict[aff]['id']
-        except:
-            for k,v in aff_dict.items():
-                if v['acronym'] == aff:
-                    aff_id = v['id']
-                    aff = k
-    else:
-        aff = ""
-        aff_id = ""
-    if aff_id != "":
-        creator['affiliations'] = [{'id': aff_id, 'name': aff}]
-    # assign role based on mapping dictionary
-    creator['role'] = roles[party['role']]
-    if party['org'] == False:
-        bits = party['name'].split()
-        firstname = " ".join(bits[:-1])
-        surname = bits[-1] 
-        creator['person_or_org'] = { 'family_name': surname,
-                'given_name' : firstname,
-                'name' : f"{surname}, {firstname}",
-                'type' : 'personal',
-                }
-        if 'orcid' in [k for k in party.keys()]:
-            creator['identifiers'] = [{'scheme': 'orcid',
-                                       'identifier': party['orcid']}]
-    else:
-        creator['person_or_org'] = { 'name': party['name'],
-                                     'type': "organizational"} 
-    return creator 
+    return Party(party, roles).to_json()
 
 
 def process_time(coverage):
@@ -130,15 +102,7 @@ def process_time(coverage):
     to_date : dict
         Dictionary following metadata schema for dates
     """
-    from_date = {'date': coverage[0],
-        'description': "Start of temporal coverage",
-        'type': { 'id': "from-date", 'title': {'en': "From date"} }
-        }
-    to_date = {'date': coverage[1],
-        'description': "End of temporal coverage",
-        'type': { 'id': "to-date", 'title': {'en': "To date"} }
-        }
-    return [from_date, to_date]
+    return [d.to_json() for d in dates_from_coverage(coverage)]
 
 
 def process_time_obsolete(coverage):
@@ -177,12 +141,7 @@ def process_spatial(geo):
     polygon : dict(list(list))
         Dictionary following GeoJSON polygon format 
     """
-
-    polygon = { "type": "Polygon",
-      "coordinates": [
-      [ [geo[0], geo[2]], [geo[0], geo[3]], [geo[1], geo[3]], [geo[1], geo[2]] ]
-      ]}
-    return polygon 
+    return polygon(geo)
 
 
 def add_description(citation, location):
@@ -201,18 +160,7 @@ def add_description(citation, location):
     descriptions : list(dict)
         List with the two addtional description dictionaries
     """
-
-    descriptions = [
-        { "description": citation,
-        "lang": { "id": "eng", "title": {"en": "English"} },
-        "type": { "id": "citation-access",
-                  "title": {"en": "Citation and access information"} }
-        },
-        { "description": location,
-        "lang": { "id": "eng", "title": {"en": "English"} },
-        "type": { "id": "location", "title": {"en": "Local host"} }
-        }]
-    return descriptions
+    return descriptions(citation, location)
 
 
 def process_license(license):
@@ -229,15 +177,7 @@ def process_license(license):
     zlicense : dict
         A modified version of the license dictionary following the api requirements
     """
-
-    ind = license.find('Attribution')
-    ind = license.find('creativecommons.org/licenses/')
-    if ind == -1:
-         zlicense = { "description": {"en": license},
-                      "title": {"en": "Custom license"} }
-    else:
-        zlicense = {"id": "-".join(["cc", license[ind:].split("/")[2],"4.0"])}
-    return zlicense
+    return license_rights(license)
 
 
 def process_links(links):
@@ -254,36 +194,7 @@ def process_links(links):
     related : list(dict)
         A list of dictionaries of related links following the metadata schema 
     """
-
-    related = []
-    for link in links:
-        for k,v in link.items():
-            if k in ['geonetwork','DAP']: 
-                related.append( {"identifier": v, "relation_type": {
-                    "id": "isvariantformof", "title": {"en": "Is variant form of"} },
-                    "resource_type": {"id": "metadata", "title": {"en": "Metadata record"}},
-                    "scheme": "url"} )
-            elif k == 'RDA': 
-                related.append( {"identifier": v, "relation_type": {
-                    "id": "isvariantformof", "title": {"en": "Is variant form of"} },
-                    "resource_type": {"id": "metadata", "title": {"en": "Metadata record"}},
-                    "scheme": "url"} )
-            elif k == 'TDS': 
-                related.append( {"identifier": v, "relation_type": {
-                    "id": "ismetadatafor", "title": {"en": "Is metadata for"} },
-                    "resource_type": {"id": "dataset", "title": {"en": "Dataset"}},
-                    "scheme": "url"} )
-            elif k == 'paper': 
-                related.append( {"identifier": v, "relation_type": {
-                    "id": "isdescribedby", "title": {"en": "Is cited by"} },
-                    "resource_type": {"id": "publication-article", "title": {"en": "Journal article"}},
-                    "scheme": "doi"} )
-            else: 
-                related.append( {"identifier": v, "relation_type": {
-                    "id": "isdocumentedby", "title": {"en": "Is documented by"} },
-                    "resource_type": {"id": "other-resource", "title": {"en": "Other"}},
-                    "scheme": "url"} )
-    return related
+    return [l.to_json() for l in links_from_plan(links)]
 
 
 def create_subject(scheme, sid, term):
@@ -341,110 +252,70 @@ def convert_format(fformat):
 def process_parties(parties):
     """Process contributors for plan and separate them in authors and contributors
     """
-    roles = read_json("data/CI_RoleCode.json")
-    creators = []
-    contributors = []
-    for p in parties:
-        party = process_party(p, roles) 
-        if p['role'] in ['author']:
-            creators.append( party )
-        else:
-            contributors.append( party )
-    # make sure there's at least 1 author otherwise use owner/`rightsholder`
-    if len(creators) == 0:
-        i = 0
-        for p in contributors:
-            owners_ind = []
-            if p['role']['id'] == 'rightsholder':
-                # add it to creators
-                creators.append(p)
-                owners_ind.append(i)
-            i+=1
-        # now remove owners from contributors list
-            [contributors.pop(i) for i in owners_ind]
-    return creators, contributors
+    return split_parties(Party(p) for p in parties)
+
+
+def plan_record(plan):
+    """Return the plan as a Record, a random test doi is assigned if
+    the plan has none
+
+    Records are more compact than plans and records in the api format,
+    use them to hold batches of plans and convert them with to_json
+    only when they are posted.
+    """
+    if not (plan['doi'] and plan['doi'].strip()):
+        plan['doi'] = "10.1234567/" + random_string()
+    return Record(plan)
 
 
 def process_invenio_plan(plan, community_id_db):
     """
     """
-    metadata = {}
-    plan_keys = [k for k in plan.keys()]
+    return plan_record(plan).to_json(community_id_db)
 
-    # Contributors
-    if 'parties' in plan_keys:
-        metadata['creators'] , metadata['contributors'] = process_parties(
-                                                       plan['parties'])
-    else:
-        metadata['creators'] , metadata['contributors'] = (plan['creators'], 
-                                                        plan['contributors'])
 
-    # Dates: publication date is required
-    if 'publication_date' in plan_keys:
-        metadata['publication_date'] = plan['publication_date']
-    else:
-        metadata['publication_date'] = date.today().strftime('%Y-%m-%d') 
-    metadata['dates'] = []
-    if plan['time_coverage'] not in [[], ""]:
-        metadata['dates'].extend(process_time(plan['time_coverage']))
-    # Titles, version, description
-    metadata['title'] = plan['title']
-    if plan['alt_title'] != "":
-        metadata['additional_titles'] = [{"title": plan['alt_title'], 
-            "type": {"id": "alternative-title", "title": {"en": "Alternative title"}}}]
-    # version it's only sometime available from geonetwork
-    if plan['version'] != "":
-        metadata['version'] = plan['version']
-    metadata['description'] = plan['description']
-    # License, additional descriptions
-    if plan['license'] != "":
-        metadata['rights'] = [ process_license(plan['license']) ]
-    metadata['additional_descriptions'] = add_description(plan['citation'], plan['location'])
-
-    # Geospatial info: build GeoJSON polygon
-    geospatial = plan.get('geospatial', "")
-    if geospatial not in [[], ""]:
-        metadata['locations'] = process_spatial(geospatial)
-
-    # Related identifiers and identifiers
-    metadata['related_identifiers'] = process_links(plan['related_identifiers'])
-    #if plan['doi'] != "":
-    #    metadata['identifiers'] = [{'identifier': plan['doi'], 'scheme': "doi"}]
-
-    # Create subjects based on fformat and for_codes
-    metadata['subjects'] = process_subjects(plan['fformat'], plan['for_codes'])
-    if 'resource_type' not in plan_keys:
-        metadata['resource_type'] = {'id': 'dataset', 'title': "Dataset"}
-    else:
-        metadata['resource_type'] = plan['resource_type']
-    metadata['language'] = 'English'
-    metadata['publisher'] = plan['publisher'] 
-    if plan.get('handle', None):
-        metadata['identifiers'] = [
-            {'identifier': plan['handle'], 'scheme': 'handle'}] 
-    final = {}
-    final['metadata'] = metadata
-    #final['modified'] = date.today().strftime("%Y-%m-%d")
-    final['files'] = {'enabled': False, "order": []}
-    final['access'] = {'record': "public", 'files': "public", 'status': "metadata-only",
-                       'embargo': {'active': False, 'reason': None} }
-    if not (plan['doi'] and plan['doi'].strip()):
-        plan['doi'] = "10.1234567/" + random_string() 
-    final['pids'] = {'doi': {'identifier': plan['doi'], 
-                                 'provider': 'external'}}
-    # set up record for submission to community
-    final["parent"] = {
-        "review": {
-            "type": "community-submission",
-            "receiver": {"community": community_id_db},
-        }
-    }
-    return final
+# time in seconds a community slug to db id mapping is cached
+COMMUNITY_TTL = 86400
 
 
-def get_community_id(obj):
+def get_community_id(obj, ttl=COMMUNITY_TTL, refresh=False):
     """Get community db id based on slug
 
+    The id is cached locally for ttl seconds, so most calls don't
+    need to query the api.
+
+    Parameters
+    ----------
+    obj : dict
+        The cli context obj including url, authentication token and community
+    ttl : float, optional
+        Seconds a cached id is valid (default COMMUNITY_TTL, one day)
+    refresh : bool, optional
+        If True ignore the cached id (default False)
+
+    Returns
+    -------
+    com_id : str
+        The id for the community, empty if not found
+    """
+    # key by api url so sandbox and production ids are kept apart
+    key = f"{obj['communities']}/{obj['community_id']}"
+    com_id = None if refresh else read_lookup('communities', key, ttl)
+    if com_id is None:
+        com_id = find_community_id(obj)
+        # don't cache a missing community, it might be created soon
+        if com_id:
+            write_lookup('communities', key, com_id)
+    obj['log'].debug("Community %s id: %s", obj['community_id'], com_id)
+    return com_id
+
+
+def find_community_id(obj):
+    """Query the api for the community db id based on slug
+
+    Try first the direct lookup communities/<slug>, if the instance
+    doesn't support it page through all the communities.
+
     Parameters
     ----------
     obj : dict
@@ -453,19 +324,34 @@ def get_community_id(obj):
     Returns
     -------
     com_id : str
-        The id for the community 
+        The id for the community, empty if not found
     """
     zen_log = obj['log']
-    r = requests.get(obj['communities'])
-    # this is not logging anything why???
-    zen_log.debug(f"Get community request: {r}")
-    communities = r.json()['hits']['hits']
-    com_id = ""
-    for c in communities:
-        if c['slug'] == obj['community_id']:
-            com_id = c['id']
+    slug = obj['community_id']
+    params = {'access_token': obj['token']} if obj.get('token') else {}
+    session = api_session()
+    r = session.get(f"{obj['communities']}/{slug}", params=params)
+    zen_log.debug("Get community request: %s %s", r.status_code, r.url)
+    if r.status_code == 200:
+        data = zjson.response_json(r)
+        if slug in (data.get('slug', None), data.get('id', None)):
+            return data['id']
+    url = obj['communities']
+    params['size'] = 100
+    while url:
+        r = session.get(url, params=params)
+        zen_log.debug("Get communities page: %s %s", r.status_code, r.url)
+        if r.status_code >= 400:
+            zen_log.info(r.text)
             break
-    return com_id
+        data = zjson.response_json(r)
+        for c in data['hits']['hits']:
+            if c['slug'] == slug:
+                return c['id']
+        # next link already includes the query parameters
+        url = data.get('links', {}).get('next', None)
+        params = {'access_token': obj['token']} if obj.get('token') else {}
+    return ""
 
 
 def submit_review(ctx, record_id):
@@ -483,7 +369,7 @@ def submit_review(ctx, record_id):
     """
     log = ctx.obj['log']
     url = '/'.join([ctx.obj['url'], record_id, 'draft', 'review'])
-    log.debug(f"Review url: {url}")
+    log.debug("Review url: %s", url)
     data = {
             'receiver': {'community': ctx.obj['community_id_db']},
             'type': 'community-submission',
@@ -498,31 +384,42 @@ def convert_v10(plan, community_id_db):
     """Applies to records changes in schema to migrate records to v10
     Map selected subjects to custom fields
     Convert temporal coverage to from-date/to-date
+
+    Applying it twice to the same record gives the same result, so a
+    backup can be migrated again safely.
     """
 
     # define list of subjects to map
     customs = ["region", "resolution", "frequency", "format", "realm"] 
     # get subjects from plan
     if 'subjects' in plan['metadata'].keys():
-        subjects = plan['metadata']['subjects'].copy()
-        plan['custom_fields'] = {k:[] for k in customs}
-    # this is so we update indexes after removing elements
-        removed = 0
-        for idx,sub in enumerate(subjects):
-            if 'scheme' in sub.keys() and sub['scheme'] in customs:
+        custom_fields = plan.setdefault('custom_fields', {})
+        for k in customs:
+            custom_fields.setdefault(k, [])
+        subjects = []
+        for sub in plan['metadata']['subjects']:
+            if sub.get('scheme', None) in customs:
                 field = {'id': sub['id'], 'title': {'en': sub['subject']}}
-                del plan['metadata']['subjects'][idx-removed]
-                plan['custom_fields'][sub['scheme']].append(field)
-                removed +=1
+                custom_fields[sub['scheme']].append(field)
+            else:
+                subjects.append(sub)
+        plan['metadata']['subjects'] = subjects
     # convert temporal range to from/to dates
     # currently we're not removing the temporal coverage
     # in case range search improves
     if 'dates' in plan['metadata'].keys():
-        for date in plan['metadata']['dates']:
+        dates = plan['metadata']['dates']
+        # skip coverages already converted so the step is idempotent
+        done = {(d['type']['id'], d['date']) for d in dates}
+        for date in list(dates):
             if date['type']['id'] == 'coverage':
                 coverage = date['date'].split("/")
                 newdates = process_time(coverage)
-                plan['metadata']['dates'].extend(newdates)
+                if all((d['type']['id'], d['date']) in done
+                       for d in newdates):
+                    continue
+                dates.extend(newdates)
+                done.update((d['type']['id'], d['date']) for d in newdates)
     # set up record for submission to community
     plan["parent"] = {
         "review": {
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2021 ARC Centre of Excellence for Climate Extremes
+# author: Paola Petrelli <paola.petrelli@utas.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+'''
+Report memory used by a command and its stages.
+
+With zen --memory, allocations are traced with tracemalloc and the
+resident set size (RSS) of the process is sampled in a thread. At the
+end of the command the peak traced memory, the growth and the peak RSS
+of each stage (see profiling.stage) are printed, with the allocation
+sites holding most memory at the largest snapshot taken at a stage
+boundary. Tracing allocations slows down the command, use it to size
+jobs and compare runs rather than with production loads.
+'''
+
+import os
+import sys
+import threading
+import tracemalloc
+from collections import defaultdict
+import profiling
+
+
+# active tracker, None when memory reports are disabled
+_tracker = None
+MB = 1024 * 1024
+
+
+def rss():
+    """Return the resident set size of the process in bytes"""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        # not linux, use the peak so far which is in KB on linux
+        # and bytes on mac
+        import resource
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+class MemoryTracker:
+    """Track peak memory of stages
+
+    Parameters
+    ----------
+    command : str
+        Name of the command being measured
+    interval : float, optional
+        Seconds between RSS samples (default 0.1)
+    top : int, optional
+        Number of allocation sites to report (default 10)
+    """
+
+    def __init__(self, command, interval=0.1, top=10):
+        self.command = command
+        self.interval = interval
+        self.top = top
+        # name: [calls, peak traced, net growth, peak rss]
+        self.stages = defaultdict(lambda: [0, 0, 0, 0])
+        # open stages: [name, traced at start, peak of children]
+        self.stack = []
+        self.lock = threading.Lock()
+        self.peak_rss = 0
+        self.start_rss = 0
+        self.snapshot = None
+        self.snapshot_size = 0
+        self._stop = threading.Event()
+        self._sampler = None
+
+    def start(self):
+        self.start_rss = rss()
+        tracemalloc.start()
+        self._sampler = threading.Thread(target=self._sample, daemon=True,
+                                         name='zen-rss')
+        self._sampler.start()
+        profiling.add_tracker(self)
+
+    def _sample(self):
+        while True:
+            value = rss()
+            with self.lock:
+                self.peak_rss = max(self.peak_rss, value)
+                # every open stage saw this rss
+                for name, _, _ in self.stack:
+                    s = self.stages[name]
+                    s[3] = max(s[3], value)
+            if self._stop.wait(self.interval):
+                break
+
+    def enter_stage(self, name):
+        if threading.current_thread() is not threading.main_thread():
+            return
+        current, peak = tracemalloc.get_traced_memory()
+        with self.lock:
+            if self.stack:
+                # keep the parent peak before resetting it
+                self.stack[-1][2] = max(self.stack[-1][2], peak)
+            self.stack.append([name, current, 0])
+        tracemalloc.reset_peak()
+
+    def exit_stage(self, name):
+        if threading.current_thread() is not threading.main_thread():
+            return
+        current, peak = tracemalloc.get_traced_memory()
+        with self.lock:
+            _, start, child_peak = self.stack.pop()
+            peak = max(peak, child_peak)
+            s = self.stages[name]
+            s[0] += 1
+            s[1] = max(s[1], peak)
+            s[2] += current - start
+            # short stages can fall between rss samples
+            s[3] = max(s[3], rss())
+            if self.stack:
+                self.stack[-1][2] = max(self.stack[-1][2], peak)
+        # keep the largest state seen at a stage boundary, only
+        # snapshot again when memory grew by 10% as it is slow
+        if current > self.snapshot_size * 1.1:
+            self.snapshot = tracemalloc.take_snapshot()
+            self.snapshot_size = current
+
+    def stop(self):
+        """Stop tracing and print the report"""
+        profiling.remove_tracker(self)
+        self._stop.set()
+        self._sampler.join()
+        current, peak = tracemalloc.get_traced_memory()
+        if current > self.snapshot_size:
+            self.snapshot = tracemalloc.take_snapshot()
+        # peak was reset by stages, these kept their own peaks
+        peak = max([peak] + [s[1] for s in self.stages.values()])
+        tracemalloc.stop()
+        self.report(peak)
+
+    def report(self, peak, stream=None):
+        """Print peak memory, stages and top allocation sites"""
+        stream = stream or sys.stderr
+        print(f"\n{self.command}: peak traced {peak/MB:.1f} MB, peak RSS " +
+              f"{self.peak_rss/MB:.1f} MB (start {self.start_rss/MB:.1f} MB)",
+              file=stream)
+        if self.stages:
+            print(f"{'stage':20} {'calls':>8} {'peak MB':>9} {'growth MB':>10} " +
+                  f"{'RSS MB':>9}", file=stream)
+        for name, (calls, speak, growth, srss) in sorted(self.stages.items(),
+                key=lambda x: -x[1][1]):
+            print(f"{name:20} {calls:8d} {speak/MB:9.1f} {growth/MB:10.1f} " +
+                  f"{srss/MB:9.1f}", file=stream)
+        if self.snapshot is not None:
+            snapshot = self.snapshot.filter_traces([
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap>")])
+            print(f"Top allocation sites at {self.snapshot_size/MB:.1f} MB:",
+                  file=stream)
+            for stat in snapshot.statistics('lineno')[:self.top]:
+                frame = stat.traceback[0]
+                print(f"{stat.size/MB:9.2f} MB {stat.count:9d} blocks  " +
+                      f"{frame.filename}:{frame.lineno}", file=stream)
+
+
+def start(command, interval=0.1):
+    """Start tracking memory of a command and return the tracker"""
+    global _tracker
+    _tracker = MemoryTracker(command, interval)
+    _tracker.start()
+    return _tracker
+
+
+def stop():
+    """Stop tracking memory and print the report"""
+    global _tracker
+    if _tracker is not None:
+        _tracker.stop()
+    _tracker = None
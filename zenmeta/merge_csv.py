@@ -1,47 +1,147 @@
+import argparse
 import csv
+import os
+import sqlite3
 import sys
+import tempfile
 
 
-def read_csv(fname, header=True):
-    """Read csv file and return list of rows"""
-    csvreader = csv.reader(fname)
-    if header is True:
-        header = next(csvreader)
-    rows = []
-    for row in csvreader:
-        rows.append(row)
-    return rows
+class KeyIndex:
+    """Set of row keys that moves to an on-disk sqlite index when it
+    holds more than max_keys keys
+
+    The limit is a number of keys, not bytes, the memory it allows
+    depends on the length of the keys, i.e. about 100 bytes each for
+    short ids.
+    """
+
+    def __init__(self, max_keys=1000000):
+        self.max_keys = max_keys
+        self.keys = set()
+        self.db = None
+        self.tmpdir = None
+
+    def _spill(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db = sqlite3.connect(os.path.join(self.tmpdir.name, 'keys.db'))
+        self.db.execute("PRAGMA journal_mode=OFF")
+        self.db.execute("PRAGMA synchronous=OFF")
+        self.db.execute("CREATE TABLE keys (k TEXT PRIMARY KEY) WITHOUT ROWID")
+        self.db.executemany("INSERT INTO keys VALUES (?)",
+                            ((k,) for k in self.keys))
+        self.keys = set()
+
+    def add(self, key):
+        """Add key and return True if it was not already there"""
+        if self.db is not None:
+            cur = self.db.execute("INSERT OR IGNORE INTO keys VALUES (?)", (key,))
+            return cur.rowcount == 1
+        if key in self.keys:
+            return False
+        self.keys.add(key)
+        if len(self.keys) > self.max_keys:
+            self._spill()
+        return True
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.tmpdir.cleanup()
+
+
+def key_columns(header, columns):
+    """Return the indexes of key columns given as names or positions"""
+    idxs = []
+    for c in columns.split(","):
+        idxs.append(int(c) if c.isdigit() else header.index(c))
+    return idxs
+
+
+def merge(fnames, writer, columns="0", wins="first", new_only=False,
+          max_keys=1000000):
+    """Stream rows of any number of csv files to writer, dropping rows
+    whose key was already written
+
+    Parameters
+    ----------
+    fnames : list(str)
+        Input csv files, all with the same header
+    writer : csv.writer
+        Writer for the output rows
+    columns : str, optional
+        Comma separated names or positions of the key columns (default "0")
+    wins : str, optional
+        Which file's row is kept when a key is in more than one file,
+        "first" or "last" (default "first"). With "last" files are read
+        in reverse order, so are their rows in output. Within the same
+        file the first row is always kept
+    new_only : bool, optional
+        If True only write rows whose key is not in the first file,
+        which is used as the existing catalogue (default False)
+    max_keys : int, optional
+        Number of keys, not bytes, held in memory before moving them
+        to disk (default 1000000)
+
+    Returns
+    -------
+    nrows : int
+        Number of rows written
+    """
+    # reading files in reverse order the first row found is the last one
+    order = list(fnames) if wins == "first" else list(reversed(fnames))
+    if new_only:
+        # existing catalogue is always read first but not written
+        order = [fnames[0]] + [f for f in order if f != fnames[0]]
+    index = KeyIndex(max_keys)
+    nrows = 0
+    header = None
+    for fname in order:
+        with open(fname, 'r', newline='') as f:
+            reader = csv.reader(f)
+            fheader = next(reader, None)
+            # an empty file, i.e. a search that found nothing
+            if fheader is None:
+                print(f"Skipping empty file {fname}", file=sys.stderr)
+                continue
+            if header is None:
+                header = fheader
+                idxs = key_columns(header, columns)
+                writer.writerow(header)
+            skip = new_only and fname == fnames[0]
+            for row in reader:
+                key = "\x1f".join(row[i] for i in idxs)
+                if index.add(key) and not skip:
+                    writer.writerow(row)
+                    nrows += 1
+    index.close()
+    return nrows
+
 
 def main():
-    # assign arguments
-    fname1, fname2 = sys.argv[1:3]
-    # open input/output files
-    f1 = open(fname1, 'r')
-    f2 = open(fname2, 'r')
-    fout = open('newrecords.csv', 'w')
-
-    # create the csv writer
-    writer = csv.writer(fout)
-    header = ["id", "title", "url", "type"]
-    writer.writerow(header)
-
-    # read the input files
-    rows1 = read_csv(f1)
-    f1.close()
-    rows2 = read_csv(f2)
-    f2.close()
-
-    # write first file rows into output
-    #for row in rows1:
-    #    writer.writerow(row)
-
-    # If row-id in rows2 already exist in rows1 do not add it to output
-    ids = [row[0] for row in rows1]
-
-    for row in rows2:
-        if row[0] not in ids:
-            writer.writerow(row)
-    fout.close()
+    parser = argparse.ArgumentParser(description="Merge csv catalogues " +
+        "removing duplicate rows")
+    parser.add_argument('fnames', nargs='+', help="csv files to merge")
+    parser.add_argument('--output', '-o', default='newrecords.csv',
+        help="Output csv file, default is newrecords.csv")
+    parser.add_argument('--keys', '-k', default="0",
+        help="Comma separated names or positions of key columns, " +
+             "default is first column")
+    parser.add_argument('--wins', choices=['first', 'last'], default='first',
+        help="Keep row from first or last file with the same key, " +
+             "default is first")
+    parser.add_argument('--all', dest='new_only', action='store_false',
+        help="Write all unique rows, by default rows with a key in " +
+             "the first file are not written")
+    parser.add_argument('--max-keys', type=int, default=1000000,
+        help="Number of keys, not bytes, held in memory before using " +
+             "an on-disk index, default is 1000000")
+    args = parser.parse_args()
+
+    with open(args.output, 'w', newline='') as fout:
+        writer = csv.writer(fout)
+        nrows = merge(args.fnames, writer, columns=args.keys, wins=args.wins,
+                      new_only=args.new_only, max_keys=args.max_keys)
+    print(f"Written {nrows} rows to {args.output}")
 
 if __name__ == "__main__":
     main()
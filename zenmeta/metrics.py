@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2021 ARC Centre of Excellence for Climate Extremes
+# author: Paola Petrelli <paola.petrelli@utas.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+'''
+Record latency, size and outcome of every api request.
+
+Sessions returned by util.api_session and util.get_session record an
+event for each request when a collector is active, i.e. when zen runs
+with --metrics or --metrics-file. At the end of the command a summary
+with latency percentiles per endpoint, error counts and records per
+second is printed, raw events can be saved as json lines.
+'''
+
+import json
+import math
+import os
+import re
+import sys
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+
+# path segments replaced by {id} in endpoint templates: numbers,
+# invenio pids like abcde-12345 and uuids or hex ids
+ID_SEGMENT = re.compile(r'^(\d+|[a-z0-9]{5}-[a-z0-9]{5}|[0-9a-f-]{32,36})$')
+
+# active collector, None when metrics are disabled
+_collector = None
+# per thread timings of the request being sent
+_local = threading.local()
+
+
+def endpoint_template(url):
+    """Return host and path of url with ids replaced by {id}"""
+    parts = urlsplit(url)
+    path = "/".join("{id}" if ID_SEGMENT.match(s) else s
+                    for s in parts.path.split("/"))
+    return f"{parts.netloc}{path}"
+
+
+def percentile(values, p):
+    """Return the p percentile of a sorted list, nearest rank method"""
+    if not values:
+        return None
+    # smallest value with at least p% of values less or equal to it
+    k = max(0, min(len(values) - 1, math.ceil(p * len(values) / 100) - 1))
+    return values[k]
+
+
+def error_class(status, exc=None):
+    """Return the outcome class of a request, i.e. 2xx, 429 or Timeout"""
+    if exc is not None:
+        return type(exc).__name__
+    # throttling is worth counting apart from other client errors
+    if status == 429:
+        return "429"
+    return f"{status // 100}xx"
+
+
+def _body_size(body):
+    if body is None:
+        return 0
+    if isinstance(body, (bytes, str)):
+        return len(body)
+    # a file being uploaded
+    try:
+        return os.fstat(body.fileno()).st_size
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+class Collector:
+    """Collect request events and records processed by a command
+
+    Parameters
+    ----------
+    command : str
+        Name of the command being measured
+    events_file : str, optional
+        Json lines file to write the raw events to (default None)
+    """
+
+    def __init__(self, command, events_file=None):
+        self.command = command
+        self.events = []
+        self.records = 0
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+        self.events_file = open(events_file, 'w') if events_file else None
+
+    def add_event(self, event):
+        with self.lock:
+            self.events.append(event)
+            if self.events_file:
+                self.events_file.write(json.dumps(event) + "\n")
+
+    def add_records(self, n):
+        with self.lock:
+            self.records += n
+
+    def summary(self):
+        """Return the end of run summary as a dictionary"""
+        elapsed = time.perf_counter() - self.start
+        endpoints = {}
+        for e in self.events:
+            endpoints.setdefault((e['method'], e['endpoint']), []).append(e)
+        summary = {'command': self.command, 'elapsed': elapsed,
+                   'requests': len(self.events), 'records': self.records,
+                   'records_per_s': self.records / elapsed if elapsed else 0,
+                   'errors': {}, 'endpoints': []}
+        for e in self.events:
+            if e['outcome'] != '2xx':
+                summary['errors'][e['outcome']] = summary['errors'].get(e['outcome'], 0) + 1
+        for (method, endpoint), events in sorted(endpoints.items()):
+            latency = sorted(e['latency'] for e in events)
+            wait = sorted(e.get('pool_wait', 0) for e in events)
+            summary['endpoints'].append({
+                'method': method, 'endpoint': endpoint, 'count': len(events),
+                'p50': percentile(latency, 50), 'p95': percentile(latency, 95),
+                'p99': percentile(latency, 99),
+                'pool_wait_p95': percentile(wait, 95),
+                'bytes_out': sum(e['bytes_out'] or 0 for e in events),
+                'bytes_in': sum(e['bytes_in'] or 0 for e in events)})
+        return summary
+
+    def report(self, stream=None):
+        """Print the summary"""
+        stream = stream or sys.stderr
+        s = self.summary()
+        print(f"\n{s['command']}: {s['requests']} requests, {s['records']} " +
+              f"records in {s['elapsed']:.2f} s, " +
+              f"{s['records_per_s']:.2f} records/s", file=stream)
+        if s['endpoints']:
+            print(f"{'method':7} {'count':>6} {'p50 ms':>8} {'p95 ms':>8} " +
+                  f"{'p99 ms':>8} {'wait ms':>8} {'KB out':>8} {'KB in':>8}  " +
+                  "endpoint", file=stream)
+        for e in s['endpoints']:
+            print(f"{e['method']:7} {e['count']:6d} {e['p50']*1000:8.1f} " +
+                  f"{e['p95']*1000:8.1f} {e['p99']*1000:8.1f} " +
+                  f"{e['pool_wait_p95']*1000:8.1f} " +
+                  f"{e['bytes_out']/1024:8.1f} {e['bytes_in']/1024:8.1f}  " +
+                  f"{e['endpoint']}", file=stream)
+        if s['errors']:
+            errors = ", ".join(f"{k}: {v}" for k, v in sorted(s['errors'].items()))
+            print(f"Errors: {errors}", file=stream)
+
+    def close(self):
+        if self.events_file:
+            self.events_file.close()
+
+
+def start(command, events_file=None):
+    """Start collecting metrics for a command and return the collector"""
+    global _collector
+    _collector = Collector(command, events_file)
+    return _collector
+
+
+def stop():
+    """Stop collecting, print the summary and close the events file"""
+    global _collector
+    if _collector is not None:
+        _collector.report()
+        _collector.close()
+    _collector = None
+
+
+def add_records(n):
+    """Count records processed by the command, if metrics are active"""
+    if _collector is not None:
+        _collector.add_records(n)
+
+
+class _PoolWaitMixin:
+    """Add the time spent getting a connection from the pool to the
+    request being timed
+    """
+
+    def _get_conn(self, timeout=None):
+        start = time.perf_counter()
+        try:
+            return super()._get_conn(timeout=timeout)
+        finally:
+            if getattr(_local, 'pool_wait', None) is not None:
+                _local.pool_wait += time.perf_counter() - start
+
+
+class TimedHTTPConnectionPool(_PoolWaitMixin, HTTPConnectionPool):
+    pass
+
+
+class TimedHTTPSConnectionPool(_PoolWaitMixin, HTTPSConnectionPool):
+    pass
+
+
+class InstrumentedAdapter(HTTPAdapter):
+    """Adapter whose connection pools time the wait for a connection
+
+    With pool_block=True requests wait for a free connection when all
+    pool_maxsize are in use, otherwise the wait is only taking one
+    from the pool, as a new connection is opened when none is free.
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': TimedHTTPConnectionPool,
+            'https': TimedHTTPSConnectionPool}
+
+
+class InstrumentedSession(requests.Session):
+    """Session recording an event for each request when metrics are active
+
+    Each event has the method, endpoint template, status, outcome
+    class, bytes sent and received, the time spent preparing the
+    request before it is sent, the time waiting for a pool connection,
+    and the total wall time, including any retries done by the adapter.
+    The pool wait is only measured with an InstrumentedAdapter, which
+    the session mounts by default.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.mount("https://", InstrumentedAdapter())
+        self.mount("http://", InstrumentedAdapter())
+
+    def request(self, method, url, *args, **kwargs):
+        if _collector is None:
+            return super().request(method, url, *args, **kwargs)
+        _local.sent = None
+        _local.pool_wait = 0.0
+        start = time.perf_counter()
+        r = None
+        exc = None
+        try:
+            r = super().request(method, url, *args, **kwargs)
+            return r
+        except requests.RequestException as e:
+            exc = e
+            raise
+        finally:
+            end = time.perf_counter()
+            sent = _local.sent or end
+            pool_wait = _local.pool_wait
+            _local.pool_wait = None
+            event = {'time': time.time(), 'method': method.upper(),
+                     'endpoint': endpoint_template(url),
+                     'status': r.status_code if r is not None else None,
+                     'outcome': error_class(r.status_code if r is not None else 0, exc),
+                     'bytes_out': _body_size(r.request.body) if r is not None else None,
+                     'bytes_in': len(r.content) if r is not None and not kwargs.get('stream') else None,
+                     'prepare': sent - start, 'pool_wait': pool_wait,
+                     'latency': end - start}
+            _collector.add_event(event)
+
+    def send(self, request, **kwargs):
+        # only the first send counts, later ones are redirects
+        if getattr(_local, 'sent', 0) is None:
+            _local.sent = time.perf_counter()
+        return super().send(request, **kwargs)
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2021 ARC Centre of Excellence for Climate Extremes
+# author: Paola Petrelli <paola.petrelli@utas.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+from multiprocessing import Pool
+from util import iter_json, write_json_stream, batches
+from profiling import timed_iter
+from invenio import convert_v10
+from exception import ZenException
+
+
+# Registered schema migrations: {from_version: (to_version, function)}
+# each function takes a record and the community db id and returns
+# the record updated to to_version
+MIGRATIONS = {}
+# migration functions that use the community db id
+COMMUNITY_STEPS = set()
+
+
+def register_migration(from_version, to_version, community=False):
+    """Decorator to register a function as a migration step
+
+    Parameters
+    ----------
+    from_version: int
+        Schema version of the records the step applies to
+    to_version: int
+        Schema version of the records returned by the step
+    community: bool, optional
+        If True the step uses the community db id, which then has to
+        be resolved with the api before migrating (default False)
+
+    Returns
+    -------
+    register: function
+        Decorator adding the function to MIGRATIONS
+    """
+    def register(func):
+        if from_version in MIGRATIONS.keys():
+            raise ZenException(f"A migration from v{from_version} " +
+                               "is already registered")
+        MIGRATIONS[from_version] = (to_version, func)
+        if community:
+            COMMUNITY_STEPS.add(func)
+        return func
+    return register
+
+
+register_migration(9, 10, community=True)(convert_v10)
+
+
+def latest_version():
+    """Return the most recent schema version we can migrate to"""
+    return max(to for to, func in MIGRATIONS.values())
+
+
+def migration_chain(from_version, to_version=None):
+    """Find the ordered list of steps to go from one version to another
+
+    Parameters
+    ----------
+    from_version: int
+        Schema version of input records
+    to_version: int, optional
+        Schema version wanted, if None use the latest (default None)
+
+    Returns
+    -------
+    chain: list
+        List of migration functions to apply in order
+    """
+    if to_version is None:
+        to_version = latest_version()
+    chain = []
+    version = from_version
+    while version < to_version:
+        if version not in MIGRATIONS.keys():
+            raise ZenException(f"No migration registered from v{version}")
+        version, func = MIGRATIONS[version]
+        chain.append(func)
+    if version != to_version:
+        raise ZenException(f"Cannot migrate records from v{from_version}" +
+                           f" to v{to_version}")
+    return chain
+
+
+def needs_community(chain):
+    """Return True if any step of a migration chain uses the community
+    db id
+    """
+    return any(func in COMMUNITY_STEPS for func in chain)
+
+
+def migrate_record(record, chain, community_id_db):
+    """Apply a chain of migration steps to a record
+
+    Parameters
+    ----------
+    record: dict
+        The record as retrieved from the api
+    chain: list
+        Migration functions as returned by migration_chain
+    community_id_db: str
+        The community db id used by the migration steps
+
+    Returns
+    -------
+    record: dict
+        The migrated record
+    """
+    for func in chain:
+        record = func(record, community_id_db)
+    return record
+
+
+# set by _init_worker in each of the pool processes
+_worker_args = None
+
+
+def _init_worker(from_version, to_version, community_id_db):
+    global _worker_args
+    _worker_args = (migration_chain(from_version, to_version), community_id_db)
+
+
+def _migrate_worker(record):
+    chain, community_id_db = _worker_args
+    return migrate_record(record, chain, community_id_db)
+
+
+def migrate_file(fname, outname, community_id_db, from_version=9,
+                 to_version=None, workers=None, batch_size=1000):
+    """Migrate all the records in a backup file and write them to a new file
+
+    Records are read and written as a stream, in batches that are
+    split among a pool of worker processes. The output records are
+    in the same order as the input.
+
+    Parameters
+    ----------
+    fname: str
+        Backup json or json lines file
+    outname: str
+        Json file to write migrated records to
+    community_id_db: str
+        The community db id used by the migration steps
+    from_version: int, optional
+        Schema version of the backup (default 9)
+    to_version: int, optional
+        Schema version wanted, if None use the latest (default None)
+    workers: int, optional
+        Number of worker processes, if None use all cpus (default None)
+    batch_size: int, optional
+        Number of records held in memory at any time (default 1000)
+
+    Returns
+    -------
+    nrec: int
+        Number of records migrated
+    """
+    # check the chain exists before starting the workers
+    migration_chain(from_version, to_version)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    chunksize = max(1, batch_size // (4 * workers))
+    with Pool(workers, initializer=_init_worker,
+              initargs=(from_version, to_version, community_id_db)) as pool:
+        migrated = (record for batch in timed_iter(batches(iter_json(fname),
+                    batch_size), 'read')
+                    for record in pool.imap(_migrate_worker, batch, chunksize))
+        nrec = write_json_stream(migrated, outname)
+    return nrec
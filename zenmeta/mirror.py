@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2021 ARC Centre of Excellence for Climate Extremes
+# author: Paola Petrelli <paola.petrelli@utas.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+'''
+Keep a local copy of the records of a community or of a user.
+
+A mirror is a directory with:
+  state.json       last updated timestamp seen and current version of
+                   each record
+  changes.jsonl    one line per record added, updated or deleted
+  objects/         record versions, as gzip json named by content hash
+
+Each run only requests records updated since the last one, sorted by
+update time, so a nightly run costs only the records that changed.
+A version already stored is never written again. Records deleted
+from the api can only be found by listing all of them, this is done
+with full=True, i.e. zen mirror --full, which can run less often.
+
+Changes are appended to changes.jsonl in batches, each followed by
+the state, which records the size of changes.jsonl it covers. Lines
+written after the last state saved, by an interrupted run, are
+removed by the next run, which then finds the same changes again.
+'''
+
+import gzip
+import hashlib
+import os
+import datetime as dt
+import zjson
+from util import api_session
+from profiling import stage
+from exception import ZenException
+
+
+STATE = 'state.json'
+CHANGES = 'changes.jsonl'
+# search apis return at most this many results for the same query,
+# after that the query is started again from the last updated seen
+MAX_RESULTS = 10000
+# changes written to changes.jsonl before saving the state
+CHECKPOINT = 1000
+
+
+def source_url(obj, user=False):
+    """Return search url and parameters for the records to mirror
+
+    Parameters
+    ----------
+    obj : dict
+        Click context obj with urls, portal, token and community_id
+    user : bool, optional
+        If True mirror the user records instead of the community
+        ones (default False)
+
+    Returns
+    -------
+    url : str
+        The search url
+    params : dict
+        The query parameters, apart from the updated range
+    """
+    params = {'access_token': obj['token']}
+    if obj['portal'] == 'zenodo':
+        url = obj['deposit'] if user else obj['url']
+        if not user:
+            params['communities'] = obj['community_id']
+    elif user:
+        url = obj['url'].replace("/records", "/user/records")
+    else:
+        url = f"{obj['communities']}/{obj['community_id']}/records"
+    return url, params
+
+
+def content_hash(record):
+    """Return sha256 of the record json with sorted keys"""
+    return hashlib.sha256(zjson.dumpb(record, sort_keys=True)).hexdigest()
+
+
+def object_path(path, digest):
+    return os.path.join(path, 'objects', digest[:2], f"{digest}.json.gz")
+
+
+def store_object(path, record):
+    """Save a record version if not already stored and return its hash"""
+    digest = content_hash(record)
+    fname = object_path(path, digest)
+    if not os.path.exists(fname):
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        tmpname = f"{fname}.{os.getpid()}.tmp"
+        with open(tmpname, 'wb') as f:
+            f.write(gzip.compress(zjson.dumpb(record), mtime=0))
+        os.replace(tmpname, fname)
+    return digest
+
+
+def read_object(path, digest):
+    """Return the record version with hash digest"""
+    with open(object_path(path, digest), 'rb') as f:
+        return zjson.loads(gzip.decompress(f.read()))
+
+
+def read_mirror_state(path):
+    """Return the mirror state, empty for a new mirror"""
+    try:
+        with open(os.path.join(path, STATE), 'rb') as f:
+            return zjson.load(f)
+    except FileNotFoundError:
+        return {'updated': None, 'records': {}, 'deleted': {}}
+
+
+def write_mirror_state(path, state):
+    """Save the mirror state, replacing the old one only when complete"""
+    fname = os.path.join(path, STATE)
+    tmpname = f"{fname}.tmp"
+    with open(tmpname, 'w', encoding='utf-8') as f:
+        zjson.dump(state, f, indent=2)
+    os.replace(tmpname, fname)
+
+
+def search_pages(url, params, since, page_size, log):
+    """Yield records updated since a timestamp, oldest first
+
+    Pages are followed with links.next, as they include the query.
+    When MAX_RESULTS records are returned the query is sent again
+    starting from the last updated timestamp seen.
+
+    Parameters
+    ----------
+    url : str
+        The search url
+    params : dict
+        Query parameters with the access token
+    since : str or None
+        Only return records updated at or after this timestamp, if
+        None return all records
+    page_size : int
+        Records per request
+    log : logging.Logger
+        The zen log
+
+    Yields
+    ------
+    record : dict
+        The next record
+    """
+    session = api_session()
+    while True:
+        query = dict(params, size=page_size, sort='updated-asc')
+        if since:
+            query['q'] = f'updated:["{since}" TO *]'
+        next_url = url
+        nrec = 0
+        last = since
+        while next_url:
+            with stage('network'):
+                r = session.get(next_url, params=query)
+            log.debug("Mirror page: %s %s", r.status_code, r.url)
+            if r.status_code >= 400:
+                raise ZenException(f"Search request failed: {r.status_code} " +
+                                   f"{r.text}")
+            data = zjson.response_json(r)
+            for record in data['hits']['hits']:
+                nrec += 1
+                last = record.get('updated', last)
+                yield record
+            next_url = data.get('links', {}).get('next', None)
+            # next link already includes the query parameters
+            query = {'access_token': params['access_token']}
+        if nrec < MAX_RESULTS:
+            return
+        if last == since:
+            raise ZenException(f"More than {MAX_RESULTS} records updated " +
+                               f"at {since}, cannot page past them")
+        since = last
+
+
+def mirror(obj, path, user=False, full=False, page_size=100):
+    """Update a local mirror of the community or user records
+
+    Parameters
+    ----------
+    obj : dict
+        Click context obj with log, urls, portal, token and community_id
+    path : str
+        Mirror directory, created if missing
+    user : bool, optional
+        Mirror user records instead of community ones (default False)
+    full : bool, optional
+        List all records, not only the ones updated since the last
+        run, and mark the ones not listed as deleted (default False)
+    page_size : int, optional
+        Records per request (default 100)
+
+    Returns
+    -------
+    counts : dict
+        Number of records added, updated, unchanged and deleted
+    """
+    log = obj['log']
+    url, params = source_url(obj, user=user)
+    os.makedirs(path, exist_ok=True)
+    state = read_mirror_state(path)
+    if state.get('source', url) != url:
+        raise ZenException(f"{path} mirrors {state['source']}, not {url}")
+    state['source'] = url
+    records = state['records']
+    since = None if full else state['updated']
+    now = dt.datetime.now(dt.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+    counts = {'added': 0, 'updated': 0, 'unchanged': 0, 'deleted': 0}
+    seen = set()
+    highwater = state['updated']
+    pending = []
+    fname = os.path.join(path, CHANGES)
+    with open(fname, 'ab') as changes:
+        # drop lines of an interrupted run not covered by the state
+        size = state.get('changes_size', changes.tell())
+        if changes.tell() > size:
+            log.info(f"Mirror: removing changes after {size} bytes " +
+                     "not recorded in the state")
+            changes.truncate(size)
+            changes.seek(size)
+
+        def checkpoint():
+            changes.write(b"".join(pending))
+            changes.flush()
+            os.fsync(changes.fileno())
+            pending.clear()
+            state['changes_size'] = changes.tell()
+            state['updated'] = highwater
+            write_mirror_state(path, state)
+
+        def change(action, rid, digest, updated):
+            counts[action] += 1
+            pending.append(zjson.dumpb({'time': now, 'action': action,
+                'id': rid, 'hash': digest, 'updated': updated}) + b"\n")
+            if len(pending) >= CHECKPOINT:
+                checkpoint()
+
+        for record in search_pages(url, params, since, page_size, log):
+            rid = str(record['id'])
+            seen.add(rid)
+            updated = record.get('updated', None)
+            if updated and (highwater is None or updated > highwater):
+                highwater = updated
+            with stage('write'):
+                digest = store_object(path, record)
+            old = records.get(rid, None)
+            if old is not None and old['hash'] == digest:
+                counts['unchanged'] += 1
+                continue
+            records[rid] = {'hash': digest, 'updated': updated}
+            state['deleted'].pop(rid, None)
+            change('updated' if old else 'added', rid, digest, updated)
+        if full:
+            for rid in [r for r in records if r not in seen]:
+                old = records.pop(rid)
+                state['deleted'][rid] = now
+                change('deleted', rid, old['hash'], old['updated'])
+        state['last_run'] = now
+        checkpoint()
+    return counts
+
+
+def iter_mirror(path):
+    """Yield the current version of all records in a mirror"""
+    state = read_mirror_state(path)
+    for rid, entry in state['records'].items():
+        yield read_object(path, entry['hash'])
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2021 ARC Centre of Excellence for Climate Extremes
+# author: Paola Petrelli <paola.petrelli@utas.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+'''
+Local stand-in for a GeoNetwork CSW endpoint, to test csw.py.
+
+Usage:
+  python mock_csw.py <dir, files or globs> [--port 5001]
+
+Then harvest from it:
+  python csw.py --url http://127.0.0.1:5001/csw --full
+
+The ISO19139 xml files passed are served as GetRecords results, in
+name order, with startPosition and maxRecords paging. The modified
+date of a record is its gmd:dateStamp, the Modified >= 'date' CQL
+constraint sent for incremental harvests is applied to it. A fraction
+of requests can fail with a 503, to check retries.
+'''
+
+import argparse
+import random
+import re
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+from lxml import etree
+from geonetwork import find_files
+
+
+NS = {'gmd': 'http://www.isotc211.org/2005/gmd',
+      'gco': 'http://www.isotc211.org/2005/gco'}
+CSW_NS = 'http://www.opengis.net/cat/csw/2.0.2'
+
+
+def load_records(paths):
+    """Return [(modified, xml bytes)] of the records in paths"""
+    records = []
+    for fname in sorted(find_files(paths)):
+        root = etree.parse(fname).getroot()
+        stamp = (root.findtext('gmd:dateStamp/gco:DateTime', namespaces=NS)
+                 or root.findtext('gmd:dateStamp/gco:Date', namespaces=NS)
+                 or "")
+        records.append((stamp, etree.tostring(root)))
+    return records
+
+
+class CSWHandler(BaseHTTPRequestHandler):
+    """Answer GetRecords requests from the loaded records"""
+
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _send(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        query = {k: v[0] for k, v in parse_qs(urlsplit(self.path).query).items()}
+        with server.lock:
+            server.requests += 1
+            fail = server.rng.random() < server.error_rate
+        if fail:
+            return self._send(503, b"<error>Injected error</error>")
+        if query.get('request') != 'GetRecords':
+            body = (b'<ows:ExceptionReport xmlns:ows="http://www.opengis.net/ows">'
+                    b'<ows:Exception><ows:ExceptionText>Only GetRecords is '
+                    b'supported</ows:ExceptionText></ows:Exception>'
+                    b'</ows:ExceptionReport>')
+            return self._send(200, body)
+        records = server.records
+        since = re.search(r"Modified >= '([^']+)'", query.get('constraint', ""))
+        if since:
+            records = [r for r in records if r[0] >= since.group(1)]
+        start = int(query.get('startPosition', 1))
+        size = int(query.get('maxRecords', 10))
+        page = records[start-1:start-1+size]
+        following = start + len(page)
+        if following > len(records):
+            following = 0
+        body = (f'<csw:GetRecordsResponse xmlns:csw="{CSW_NS}">'
+                f'<csw:SearchResults numberOfRecordsMatched="{len(records)}" '
+                f'numberOfRecordsReturned="{len(page)}" '
+                f'nextRecord="{following}">').encode()
+        body += b"".join(xml for stamp, xml in page)
+        body += b'</csw:SearchResults></csw:GetRecordsResponse>'
+        self._send(200, body)
+
+
+def make_server(records, port=5001, error_rate=0, seed=None, verbose=False):
+    """Return a CSW stand-in serving records on localhost:port, port 0
+    picks a free port, start it with serve_forever
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', port), CSWHandler)
+    server.daemon_threads = True
+    server.records = records
+    server.error_rate = error_rate
+    server.rng = random.Random(seed)
+    server.lock = threading.Lock()
+    server.requests = 0
+    server.verbose = verbose
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stand-in CSW endpoint")
+    parser.add_argument('paths', nargs='+', help="ISO19139 xml files, " +
+        "directories or glob patterns to serve")
+    parser.add_argument('--port', '-p', type=int, default=5001,
+        help="Port to listen on, default is 5001")
+    parser.add_argument('--error-rate', type=float, default=0,
+        help="Fraction of requests failing with 503, default is 0")
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--verbose', '-v', action='store_true',
+        help="Log each request")
+    args = parser.parse_args()
+
+    records = load_records(args.paths)
+    server = make_server(records, args.port, args.error_rate, args.seed,
+                         args.verbose)
+    print(f"Serving {len(records)} records on " +
+          f"http://127.0.0.1:{server.server_address[1]}/csw")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"Answered {server.requests} requests")
+
+
+if __name__ == "__main__":
+    main()
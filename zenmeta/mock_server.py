@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2021 ARC Centre of Excellence for Climate Extremes
+# author: Paola Petrelli <paola.petrelli@utas.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+'''
+Local stand-in for the Invenio and Zenodo apis used by zenmeta.
+
+Usage:
+  python mock_server.py [--port 5000] [--latency 50] [--jitter 20]
+      [--error-rate 0.01] [--throttle-rate 0.02] [--rate-limit 100]
+
+Then run zen against it, with any token:
+  python cli.py -t test --api-url http://localhost:5000/api list
+
+Records are kept in memory. The server implements records, user
+records, drafts, review, communities (any slug exists, all records
+are in all communities), file buckets and searches by updated range. Each request is delayed by latency plus an exponential
+jitter, a fraction of requests fail with 5xx errors or 429, and
+requests above the rate limit get 429 with a Retry-After header, so
+concurrency and retries can be tuned without touching real services.
+'''
+
+import argparse
+import json
+import random
+import re
+import string
+import threading
+import time
+import uuid
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from datetime import datetime, timezone
+from urllib.parse import urlsplit, parse_qs, urlencode
+
+
+def now():
+    """Return the current UTC time as the api formats it"""
+    return datetime.now(timezone.utc).isoformat()
+
+
+class MockState:
+    """Records, communities and fault injection settings
+
+    Parameters
+    ----------
+    latency : float, optional
+        Seconds added to each request (default 0)
+    jitter : float, optional
+        Mean of exponential extra delay in seconds (default 0)
+    error_rate : float, optional
+        Fraction of requests failing with a 5xx error (default 0)
+    throttle_rate : float, optional
+        Fraction of requests answered with 429 (default 0)
+    rate_limit : float, optional
+        Requests per second allowed, 429 above it, 0 for no limit
+        (default 0)
+    seed : int, optional
+        Seed for the injected faults (default None)
+    """
+
+    def __init__(self, latency=0, jitter=0, error_rate=0, throttle_rate=0,
+                 rate_limit=0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.rate_limit = rate_limit
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.records = {}
+        self.communities = {}
+        self.files = {}
+        self.counts = {}
+        # token bucket for the rate limit
+        self.tokens = rate_limit
+        self.last = time.monotonic()
+
+    def new_id(self):
+        chars = string.ascii_lowercase + string.digits
+        return "-".join("".join(self.rng.choice(chars) for _ in range(5))
+                        for _ in range(2))
+
+    def fault(self):
+        """Return the status of an injected fault, None for no fault"""
+        with self.lock:
+            if self.rate_limit:
+                now = time.monotonic()
+                self.tokens = min(self.rate_limit,
+                    self.tokens + (now - self.last) * self.rate_limit)
+                self.last = now
+                if self.tokens < 1:
+                    return 429
+                self.tokens -= 1
+            r = self.rng.random()
+            error = self.rng.choice([500, 502, 503])
+            delay = self.latency + (self.rng.expovariate(1 / self.jitter)
+                                    if self.jitter else 0)
+        time.sleep(delay)
+        if r < self.throttle_rate:
+            return 429
+        if r < self.throttle_rate + self.error_rate:
+            return error
+        return None
+
+    def community(self, slug):
+        with self.lock:
+            if slug not in self.communities:
+                self.communities[slug] = {'id': str(uuid.uuid4()), 'slug': slug,
+                    'metadata': {'title': slug.upper()}}
+            return self.communities[slug]
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    """Route requests to the in-memory api"""
+
+    protocol_version = 'HTTP/1.1'
+    # buffer responses so headers and body go out in one packet,
+    # otherwise delayed acks add ~40 ms to each request
+    wbufsize = -1
+    ROUTES = [
+        ('GET', r'/api/communities', 'list_communities'),
+        ('GET', r'/api/communities/(?P<slug>[^/]+)', 'get_community'),
+        ('GET', r'/api/communities/(?P<slug>[^/]+)/records', 'search'),
+        ('GET', r'/api/(user/)?records', 'search'),
+        ('POST', r'/api/records', 'create'),
+        ('GET', r'/api/records/(?P<rid>[^/]+)(?P<draft>/draft)?', 'get'),
+        ('PUT', r'/api/records/(?P<rid>[^/]+)(?P<draft>/draft)?', 'update'),
+        ('DELETE', r'/api/records/(?P<rid>[^/]+)/draft', 'delete'),
+        ('PUT', r'/api/records/(?P<rid>[^/]+)/draft/review', 'review'),
+        ('GET', r'/api/deposit/depositions', 'search'),
+        ('POST', r'/api/deposit/depositions', 'create'),
+        ('GET', r'/api/deposit/depositions/(?P<rid>[^/]+)', 'get'),
+        ('DELETE', r'/api/deposit/depositions/(?P<rid>[^/]+)', 'delete'),
+        ('PUT', r'/api/files/(?P<bucket>[^/]+)/(?P<key>.+)', 'put_file'),
+    ]
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _send(self, status, data=None, headers=None):
+        body = json.dumps(data).encode() if data is not None else b""
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length', 0) or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _route(self, method):
+        parts = urlsplit(self.path)
+        self.query = parse_qs(parts.query)
+        # read body before replying so the connection can be reused
+        self.body = self._body()
+        state = self.server.state
+        for m, pattern, name in self.ROUTES:
+            match = re.fullmatch(pattern, parts.path.rstrip('/'))
+            if m == method and match:
+                break
+        else:
+            return self._send(404, {'status': 404, 'message': "Not found"})
+        with state.lock:
+            state.counts[name] = state.counts.get(name, 0) + 1
+        if 'access_token' not in self.query and 'Authorization' not in self.headers:
+            return self._send(401, {'status': 401, 'message': "No token"})
+        status = state.fault()
+        if status == 429:
+            return self._send(429, {'status': 429, 'message': "Too many requests"},
+                              {'Retry-After': "1"})
+        if status is not None:
+            return self._send(status, {'status': status, 'message': "Injected error"})
+        getattr(self, name)(**{k: v for k, v in match.groupdict().items()})
+
+    def do_GET(self):
+        self._route('GET')
+
+    def do_POST(self):
+        self._route('POST')
+
+    def do_PUT(self):
+        self._route('PUT')
+
+    def do_DELETE(self):
+        self._route('DELETE')
+
+    def _base(self):
+        return f"http://{self.headers.get('Host', 'localhost')}/api"
+
+    def _record_json(self, rec):
+        base = self._base()
+        rec = dict(rec)
+        rec['links'] = {'self': f"{base}/records/{rec['id']}",
+            'self_html': f"{base[:-4]}/records/{rec['id']}",
+            'parent_html': f"{base[:-4]}/records/{rec['id']}",
+            'bucket': f"{base}/files/{rec['bucket']}"}
+        return rec
+
+    def list_communities(self):
+        state = self.server.state
+        size = int(self.query.get('size', ['10'])[0])
+        page = int(self.query.get('page', ['1'])[0])
+        with state.lock:
+            hits = list(state.communities.values())
+        data = {'hits': {'hits': hits[(page-1)*size:page*size], 'total': len(hits)},
+                'links': {}}
+        if page * size < len(hits):
+            data['links']['next'] = f"{self._base()}/communities?page={page+1}&size={size}"
+        self._send(200, data)
+
+    def get_community(self, slug):
+        self._send(200, self.server.state.community(slug))
+
+    def search(self, slug=None):
+        state = self.server.state
+        size = int(self.query.get('size', ['10'])[0])
+        page = int(self.query.get('page', ['1'])[0])
+        q = self.query.get('q', [""])[0]
+        sort = self.query.get('sort', [""])[0]
+        with state.lock:
+            records = list(state.records.values())
+        if 'is_published:false' in q or self.query.get('status') == ['draft']:
+            records = [r for r in records if not r['is_published']]
+        # only the updated range used by zen mirror is supported
+        since = re.search(r'updated:\["?([^" ]+)"? TO \*\]', q)
+        if since:
+            records = [r for r in records if r['updated'] >= since.group(1)]
+        if sort == 'updated-asc':
+            records.sort(key=lambda r: r['updated'])
+        hits = [self._record_json(r) for r in records[(page-1)*size:page*size]]
+        data = {'hits': {'hits': hits, 'total': len(records)}, 'links': {}}
+        if page * size < len(records):
+            query = urlencode({'page': page + 1, 'size': size, 'q': q,
+                               'sort': sort})
+            data['links']['next'] = f"http://{self.headers.get('Host')}" + \
+                f"{urlsplit(self.path).path}?{query}"
+        self._send(200, data)
+
+    def create(self):
+        state = self.server.state
+        try:
+            data = json.loads(self.body or b"{}")
+        except ValueError:
+            return self._send(400, {'status': 400, 'message': "Invalid json"})
+        if 'metadata' not in data:
+            return self._send(400, {'status': 400, 'message': "Missing metadata"})
+        rec = dict(data)
+        rec['id'] = state.new_id()
+        rec['bucket'] = str(uuid.uuid4())
+        rec['is_published'] = False
+        rec['created'] = rec['updated'] = now()
+        rec.setdefault('parent', {})
+        rec['parent'].setdefault('communities', {'ids': []})
+        with state.lock:
+            state.records[rec['id']] = rec
+        self._send(201, self._record_json(rec))
+
+    def get(self, rid, draft=None):
+        rec = self.server.state.records.get(rid, None)
+        if rec is None:
+            return self._send(404, {'status': 404, 'message': "Record not found"})
+        self._send(200, self._record_json(rec))
+
+    def update(self, rid, draft=None):
+        state = self.server.state
+        if rid not in state.records:
+            return self._send(404, {'status': 404, 'message': "Record not found"})
+        data = json.loads(self.body or b"{}")
+        with state.lock:
+            rec = state.records[rid]
+            for k, v in data.items():
+                if k not in ('id', 'bucket', 'links', 'created', 'updated'):
+                    rec[k] = v
+            rec['updated'] = now()
+        self._send(200, self._record_json(rec))
+
+    def delete(self, rid):
+        with self.server.state.lock:
+            rec = self.server.state.records.pop(rid, None)
+        if rec is None:
+            return self._send(404, {'status': 404, 'message': "Record not found"})
+        self._send(204)
+
+    def review(self, rid):
+        state = self.server.state
+        if rid not in state.records:
+            return self._send(404, {'status': 404, 'message': "Record not found"})
+        data = json.loads(self.body or b"{}")
+        with state.lock:
+            state.records[rid]['review'] = data
+        self._send(200, {'id': str(uuid.uuid4()), 'status': "submitted",
+                         'receiver': data.get('receiver', {})})
+
+    def put_file(self, bucket, key):
+        with self.server.state.lock:
+            self.server.state.files[(bucket, key)] = len(self.body)
+        self._send(201, {'key': key, 'size': len(self.body),
+                         'links': {'self': f"{self._base()}/files/{bucket}/{key}"}})
+
+
+def make_server(port=5000, state=None, verbose=False):
+    """Return a mock server listening on localhost:port, port 0 picks a
+    free port, start it with serve_forever
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', port), MockHandler)
+    server.daemon_threads = True
+    server.state = state or MockState()
+    server.verbose = verbose
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock Invenio/Zenodo api")
+    parser.add_argument('--port', '-p', type=int, default=5000,
+        help="Port to listen on, default is 5000")
+    parser.add_argument('--latency', type=float, default=0,
+        help="Milliseconds added to each request, default is 0")
+    parser.add_argument('--jitter', type=float, default=0,
+        help="Mean of exponential extra delay in ms, default is 0")
+    parser.add_argument('--error-rate', type=float, default=0,
+        help="Fraction of requests failing with 5xx, default is 0")
+    parser.add_argument('--throttle-rate', type=float, default=0,
+        help="Fraction of requests answered with 429, default is 0")
+    parser.add_argument('--rate-limit', type=float, default=0,
+        help="Requests per second before answering 429, default is no limit")
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--verbose', '-v', action='store_true',
+        help="Log each request")
+    args = parser.parse_args()
+
+    state = MockState(args.latency / 1000, args.jitter / 1000, args.error_rate,
+                      args.throttle_rate, args.rate_limit, args.seed)
+    server = make_server(args.port, state, args.verbose)
+    print(f"Mock api on http://127.0.0.1:{server.server_address[1]}/api")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(state.counts))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,358 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2021 ARC Centre of Excellence for Climate Extremes
+# author: Paola Petrelli <paola.petrelli@utas.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+'''
+Compact model of plans for holding and transforming large batches.
+
+Plans are read into Record objects, with parties, related identifiers
+and dates as small slotted objects, and are only expanded to the
+nested dictionaries of the Invenio metadata schema by to_json, right
+before being sent. Strings repeated across records, such as roles,
+affiliations and publishers, are interned, and the vocabulary entries
+in the output, i.e. relation and resource types, are the same dict
+objects for all records. They are shared, so the output of to_json
+should be serialised as it is and never modified in place. Party
+roles come from the cached CI_RoleCode vocabulary and are copied by
+to_json, so the cache can't be changed through a record.
+'''
+
+import copy
+import functools
+import sys
+from datetime import date
+from util import read_vocab
+
+
+def _term(tid, title):
+    return {'id': tid, 'title': {'en': title}}
+
+
+RELATION_TYPES = {tid: _term(tid, title) for tid, title in [
+    ('isvariantformof', "Is variant form of"),
+    ('ismetadatafor', "Is metadata for"),
+    ('isdescribedby', "Is cited by"),
+    ('isdocumentedby', "Is documented by"),
+    ('ispartof', "Is part of"),
+    ('isrelatedto', "Is related to")]}
+
+RESOURCE_TYPES = {tid: _term(tid, title) for tid, title in [
+    ('metadata', "Metadata record"),
+    ('dataset', "Dataset"),
+    ('publication-article', "Journal article"),
+    ('service-portal', "Data portal"),
+    ('other-resource', "Other")]}
+
+# plan link type: (relation type, resource type, scheme)
+LINK_TYPES = {
+    'geonetwork': ('isvariantformof', 'metadata', 'url'),
+    'DAP': ('isvariantformof', 'metadata', 'url'),
+    'RDA': ('isvariantformof', 'metadata', 'url'),
+    'TDS': ('ismetadatafor', 'dataset', 'url'),
+    'paper': ('isdescribedby', 'publication-article', 'doi'),
+    'other': ('isdocumentedby', 'other-resource', 'url')}
+
+# date type: (description, type)
+DATE_TYPES = {
+    'from-date': ("Start of temporal coverage", _term('from-date', "From date")),
+    'to-date': ("End of temporal coverage", _term('to-date', "To date"))}
+
+LANG_ENG = _term('eng', "English")
+DESCRIPTION_TYPES = {
+    'citation-access': _term('citation-access', "Citation and access information"),
+    'location': _term('location', "Local host")}
+ALT_TITLE_TYPE = _term('alternative-title', "Alternative title")
+DATASET_TYPE = {'id': 'dataset', 'title': "Dataset"}
+
+# orcid of a party without the key, an orcid that is None is kept
+NO_ORCID = object()
+
+
+def _intern(value):
+    """Intern value if it is a string"""
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+@functools.lru_cache(maxsize=None)
+def _acronyms():
+    """Return {acronym: (name, id)} for the affiliations vocabulary"""
+    return {v['acronym']: (k, v['id'])
+            for k, v in read_vocab('affiliations.json').items()}
+
+
+class Party:
+    """An author or contributor of a plan
+
+    Parameters
+    ----------
+    party : dict
+        The plan party with name, role, org and optionally affiliation
+        and orcid, as generated by scraping geonetwork
+    roles : dict, optional
+        Mapping of geonetwork (iso19115) roles to invenio (datacite)
+        ones, if None the CI_RoleCode.json vocabulary (default None)
+    """
+
+    __slots__ = ('name', 'plan_role', 'role', 'org', 'affiliation',
+                 'affiliation_id', 'orcid')
+
+    def __init__(self, party, roles=None):
+        if roles is None:
+            roles = read_vocab("CI_RoleCode.json")
+        self.name = party['name']
+        self.plan_role = sys.intern(party['role'])
+        # the vocab entry, shared by all parties with the same role,
+        # to_json returns a copy
+        self.role = roles[party['role']]
+        self.org = party['org']
+        self.orcid = party.get('orcid', NO_ORCID)
+        aff = party.get('affiliation', None)
+        aff_id = ""
+        if aff is not None:
+            # try to find affiliation name in dictionary, if not as acronym
+            entry = read_vocab('affiliations.json').get(aff, None)
+            if entry is not None:
+                aff_id = entry['id']
+            elif aff in _acronyms():
+                aff, aff_id = _acronyms()[aff]
+        self.affiliation = _intern(aff) if aff_id else None
+        self.affiliation_id = _intern(aff_id) if aff_id else None
+
+    def to_json(self):
+        """Return the party as an Invenio creator or contributor"""
+        creator = {}
+        if self.affiliation_id:
+            creator['affiliations'] = [{'id': self.affiliation_id,
+                                        'name': self.affiliation}]
+        creator['role'] = copy.deepcopy(self.role)
+        if self.org == False:
+            bits = self.name.split()
+            firstname = " ".join(bits[:-1])
+            surname = bits[-1]
+            creator['person_or_org'] = {'family_name': surname,
+                'given_name': firstname,
+                'name': f"{surname}, {firstname}",
+                'type': 'personal'}
+            if self.orcid is not NO_ORCID:
+                creator['identifiers'] = [{'scheme': 'orcid',
+                                           'identifier': self.orcid}]
+        else:
+            creator['person_or_org'] = {'name': self.name,
+                                        'type': "organizational"}
+        return creator
+
+
+class RelatedIdentifier:
+    """A link of a plan, kind is one of LINK_TYPES keys, unknown kinds
+    are stored as 'other'
+    """
+
+    __slots__ = ('identifier', 'kind')
+
+    def __init__(self, kind, identifier):
+        self.kind = kind if kind in LINK_TYPES else 'other'
+        self.identifier = identifier
+
+    def to_json(self):
+        """Return the link as an Invenio related identifier"""
+        relation, resource, scheme = LINK_TYPES[self.kind]
+        return {'identifier': self.identifier,
+                'relation_type': RELATION_TYPES[relation],
+                'resource_type': RESOURCE_TYPES[resource],
+                'scheme': scheme}
+
+
+class Date:
+    """A date of a plan, kind is one of DATE_TYPES keys"""
+
+    __slots__ = ('date', 'kind')
+
+    def __init__(self, kind, value):
+        self.kind = kind
+        self.date = value
+
+    def to_json(self):
+        """Return the date as an Invenio date"""
+        description, dtype = DATE_TYPES[self.kind]
+        return {'date': self.date, 'description': description, 'type': dtype}
+
+
+def links_from_plan(links):
+    """Return RelatedIdentifier objects for a plan list of {kind: url}"""
+    return tuple(RelatedIdentifier(k, v) for link in links
+                 for k, v in link.items())
+
+
+def dates_from_coverage(coverage):
+    """Return from and to Date objects for a [from, to] time coverage"""
+    return (Date('from-date', coverage[0]), Date('to-date', coverage[1]))
+
+
+def descriptions(citation, location):
+    """Return the citation and local location additional descriptions"""
+    return [{'description': citation, 'lang': LANG_ENG,
+             'type': DESCRIPTION_TYPES['citation-access']},
+            {'description': location, 'lang': LANG_ENG,
+             'type': DESCRIPTION_TYPES['location']}]
+
+
+def split_parties(parties):
+    """Return Invenio creators and contributors from Party objects
+
+    Parties with role author are creators, if there are none the
+    rights holders are used as creators instead.
+    """
+    creators = []
+    contributors = []
+    for p in parties:
+        if p.plan_role == 'author':
+            creators.append(p.to_json())
+        else:
+            contributors.append(p.to_json())
+    if len(creators) == 0:
+        # same as the original loop, which removed each rights holder
+        # while iterating, so one that follows another rights holder
+        # stays a contributor
+        i = 0
+        while i < len(contributors):
+            if contributors[i]['role']['id'] == 'rightsholder':
+                creators.append(contributors.pop(i))
+            i += 1
+    return creators, contributors
+
+
+def license_rights(license):
+    """Return the Invenio rights entry for a plan license, Creative
+    Commons urls are converted to their id
+    """
+    ind = license.find('creativecommons.org/licenses/')
+    if ind == -1:
+        return {'description': {'en': license},
+                'title': {'en': "Custom license"}}
+    return {'id': "-".join(["cc", license[ind:].split("/")[2], "4.0"])}
+
+
+def polygon(geo):
+    """Return a GeoJSON polygon for [minLon, maxLon, minLat, maxLat]"""
+    return {'type': "Polygon",
+            'coordinates': [[[geo[0], geo[2]], [geo[0], geo[3]],
+                             [geo[1], geo[3]], [geo[1], geo[2]]]]}
+
+
+class Record:
+    """A plan to be published on Invenio
+
+    Parameters
+    ----------
+    plan : dict
+        The plan as generated by geonetwork.py or csiro.py, it should
+        already have a doi
+    """
+
+    __slots__ = ('title', 'alt_title', 'version', 'description', 'license',
+                 'citation', 'location', 'publication_date', 'dates',
+                 'geospatial', 'links', 'for_codes', 'resource_type',
+                 'publisher', 'handle', 'doi', 'parties', 'creators',
+                 'contributors')
+
+    def __init__(self, plan):
+        if 'parties' in plan:
+            self.parties = tuple(Party(p) for p in plan['parties'])
+            self.creators = self.contributors = None
+        else:
+            self.parties = None
+            self.creators = plan['creators']
+            self.contributors = plan['contributors']
+        self.publication_date = plan.get('publication_date', None)
+        coverage = plan['time_coverage']
+        self.dates = () if coverage in [[], ""] else dates_from_coverage(coverage)
+        self.title = plan['title']
+        self.alt_title = plan['alt_title']
+        self.version = _intern(plan['version'])
+        self.description = plan['description']
+        self.license = _intern(plan['license'])
+        self.citation = plan['citation']
+        self.location = _intern(plan['location'])
+        geospatial = plan.get('geospatial', "")
+        self.geospatial = None if geospatial in [[], ""] else tuple(geospatial)
+        self.links = links_from_plan(plan['related_identifiers'])
+        self.for_codes = tuple((_intern(c['code']), _intern(c['name']))
+                               for c in plan['for_codes'])
+        self.resource_type = plan.get('resource_type', DATASET_TYPE)
+        self.publisher = _intern(plan['publisher'])
+        self.handle = plan.get('handle', None)
+        self.doi = plan['doi']
+
+    def to_json(self, community_id_db):
+        """Return the record in the format expected by the Invenio api
+
+        Parameters
+        ----------
+        community_id_db : str
+            The db id of the community the record is submitted to
+
+        Returns
+        -------
+        final : dict
+            The record, vocabulary entries are shared with other records
+        """
+        metadata = {}
+        if self.parties is not None:
+            metadata['creators'], metadata['contributors'] = split_parties(
+                self.parties)
+        else:
+            metadata['creators'], metadata['contributors'] = (self.creators,
+                self.contributors)
+        if self.publication_date is not None:
+            metadata['publication_date'] = self.publication_date
+        else:
+            metadata['publication_date'] = date.today().strftime('%Y-%m-%d')
+        metadata['dates'] = [d.to_json() for d in self.dates]
+        metadata['title'] = self.title
+        if self.alt_title != "":
+            metadata['additional_titles'] = [{'title': self.alt_title,
+                                              'type': ALT_TITLE_TYPE}]
+        if self.version != "":
+            metadata['version'] = self.version
+        metadata['description'] = self.description
+        if self.license != "":
+            metadata['rights'] = [license_rights(self.license)]
+        metadata['additional_descriptions'] = descriptions(self.citation,
+                                                           self.location)
+        if self.geospatial is not None:
+            metadata['locations'] = polygon(self.geospatial)
+        metadata['related_identifiers'] = [l.to_json() for l in self.links]
+        metadata['subjects'] = [{'id': code, 'scheme': 'ANZSRC-FOR',
+                                 'subject': name} for code, name in self.for_codes]
+        metadata['resource_type'] = self.resource_type
+        metadata['language'] = 'English'
+        metadata['publisher'] = self.publisher
+        if self.handle:
+            metadata['identifiers'] = [{'identifier': self.handle,
+                                        'scheme': 'handle'}]
+        final = {}
+        final['metadata'] = metadata
+        final['files'] = {'enabled': False, 'order': []}
+        final['access'] = {'record': "public", 'files': "public",
+                           'status': "metadata-only",
+                           'embargo': {'active': False, 'reason': None}}
+        final['pids'] = {'doi': {'identifier': self.doi,
+                                 'provider': 'external'}}
+        # set up record for submission to community
+        final['parent'] = {'review': {'type': "community-submission",
+                           'receiver': {'community': community_id_db}}}
+        return final
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2021 ARC Centre of Excellence for Climate Extremes
+# author: Paola Petrelli <paola.petrelli@utas.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import xml.etree.ElementTree as ET
+from os.path import expanduser
+from metrics import InstrumentedSession
+from util import read_state, write_state
+from profiling import stage, timed_iter
+import zjson
+from exception import ZenException
+
+
+OAI_NS = '{http://www.openarchives.org/OAI/2.0/}'
+
+
+def state_key(url, prefix, set_spec):
+    """Key used in the state file for a harvest"""
+    return f"{url}|{prefix}|{set_spec or ''}"
+
+
+def parse_record(elem):
+    """Convert an OAI-PMH record element to a dictionary
+
+    Parameters
+    ----------
+    elem : ElementTree.Element
+        The record element
+
+    Returns
+    -------
+    record : dict
+        Record identifier, datestamp, sets, deleted status and
+        metadata as a xml string
+    """
+    header = elem.find(f'{OAI_NS}header')
+    record = {'identifier': header.findtext(f'{OAI_NS}identifier'),
+              'datestamp': header.findtext(f'{OAI_NS}datestamp'),
+              'sets': [s.text for s in header.findall(f'{OAI_NS}setSpec')],
+              'deleted': header.get('status') == 'deleted',
+              'metadata': None}
+    metadata = elem.find(f'{OAI_NS}metadata')
+    if metadata is not None and len(metadata) > 0:
+        record['metadata'] = ET.tostring(metadata[0], encoding='unicode')
+    return record
+
+
+def parse_page(stream):
+    """Parse a ListRecords response incrementally
+
+    Each record is yielded as soon as its closing tag is read and then
+    removed from the tree, so memory doesn't grow with the page size.
+    The resumption token, if any, is yielded last as a string.
+
+    Parameters
+    ----------
+    stream : file-like obj
+        The raw response content
+
+    Yields
+    ------
+    record : dict or str
+        The parsed records followed by the resumption token
+    """
+    token = None
+    for event, elem in ET.iterparse(stream, events=('end',)):
+        if elem.tag == f'{OAI_NS}record':
+            yield parse_record(elem)
+            elem.clear()
+        elif elem.tag == f'{OAI_NS}resumptionToken':
+            token = (elem.text or "").strip() or None
+        elif elem.tag == f'{OAI_NS}error':
+            # no records since last harvest is not an error for us
+            if elem.get('code') != 'noRecordsMatch':
+                raise ZenException(f"OAI-PMH error {elem.get('code')}: " +
+                                   f"{elem.text}")
+    yield token
+
+
+def list_records(url, prefix='oai_datacite', set_spec=None, from_date=None,
+                 log=None):
+    """Stream all records from an OAI-PMH ListRecords query
+
+    Follows resumption tokens until the list is complete, reusing the
+    same connection for every page.
+
+    Parameters
+    ----------
+    url : str
+        The OAI-PMH endpoint
+    prefix : str, optional
+        The metadata format (default oai_datacite)
+    set_spec : str, optional
+        The set to harvest, i.e. user-<community> (default None)
+    from_date : str, optional
+        Only return records changed since this datestamp (default None)
+    log : obj, optional
+        The logging obj to send debug information
+
+    Yields
+    ------
+    record : dict
+        Records as returned by parse_record
+    """
+    params = {'verb': 'ListRecords', 'metadataPrefix': prefix}
+    if set_spec:
+        params['set'] = set_spec
+    if from_date:
+        params['from'] = from_date
+    with InstrumentedSession() as session:
+        while params is not None:
+            r = session.get(url, params=params, stream=True)
+            if log:
+                log.debug("OAI request url: %s", r.url)
+                log.debug("Request status code: %s", r.status_code)
+            if r.status_code >= 400:
+                raise ZenException(f"OAI-PMH request failed: {r.status_code}")
+            r.raw.decode_content = True
+            params = None
+            for item in parse_page(r.raw):
+                if isinstance(item, dict):
+                    yield item
+                elif item is not None:
+                    params = {'verb': 'ListRecords', 'resumptionToken': item}
+            r.close()
+
+
+def harvest(url, output, prefix='oai_datacite', set_spec=None, full=False,
+            state_file=None, log=None):
+    """Harvest records to a json lines file, one record per line
+
+    Unless full is True only records changed since the last harvest of
+    the same set are requested, and appended to output.
+    The high-water mark is updated only after a complete harvest.
+    As OAI-PMH from includes the datestamp passed, the identifiers of
+    the records at the mark are saved with it, so they are not written
+    again by the next harvest unless their datestamp changes.
+
+    Parameters
+    ----------
+    url : str
+        The OAI-PMH endpoint
+    output : str
+        Json lines filename to write records to
+    prefix : str, optional
+        The metadata format (default oai_datacite)
+    set_spec : str, optional
+        The set to harvest (default None)
+    full : bool, optional
+        If True ignore the high-water mark and overwrite output
+        (default False)
+    state_file : str, optional
+        Json file storing high-water marks (default ~/.zenmeta_oai_state.json)
+    log : obj, optional
+        The logging obj to send debug information
+
+    Returns
+    -------
+    nrec : int
+        Number of records harvested
+    """
+    if state_file is None:
+        state_file = expanduser('~/.zenmeta_oai_state.json')
+    state = read_state(state_file)
+    key = state_key(url, prefix, set_spec)
+    mark = None if full else state.get(key, None)
+    # older state files saved only the datestamp
+    if isinstance(mark, str):
+        mark = {'datestamp': mark, 'identifiers': []}
+    from_date = mark['datestamp'] if mark else None
+    seen = set(mark['identifiers']) if mark else set()
+    if log:
+        log.info(f"Harvesting {set_spec or 'all sets'} from {url}, " +
+                 f"changed since: {from_date}")
+    highwater = from_date or ""
+    at_highwater = set(seen)
+    nrec = 0
+    mode = 'w' if full or from_date is None else 'a'
+    with open(output, mode, encoding='utf-8') as f:
+        records = list_records(url, prefix=prefix, set_spec=set_spec,
+                               from_date=from_date, log=log)
+        for record in timed_iter(records, 'harvest'):
+            stamp = record['datestamp']
+            # already written by the last harvest
+            if from_date and stamp == from_date and record['identifier'] in seen:
+                continue
+            with stage('write'):
+                f.write(zjson.dumps(record) + '\n')
+            nrec += 1
+            # datestamps are UTC in ISO8601 so they sort as strings
+            if stamp and stamp > highwater:
+                highwater = stamp
+                at_highwater = set()
+            if stamp and stamp == highwater:
+                at_highwater.add(record['identifier'])
+    if highwater:
+        state[key] = {'datestamp': highwater,
+                      'identifiers': sorted(at_highwater)}
+        write_state(state, state_file)
+    return nrec
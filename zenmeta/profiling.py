@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2021 ARC Centre of Excellence for Climate Extremes
+# author: Paola Petrelli <paola.petrelli@utas.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+'''
+Time the stages of a command and optionally profile it.
+
+Code wraps its stages in "with stage('name'):", which costs a single
+check unless zen runs with --profile. With --profile the wall and cpu
+time of each stage are printed at the end of the command, nested
+stages are included in their parent total and excluded from its self
+time. --profiler cprofile also runs cProfile and writes a report of
+the functions with most time, --profiler sample samples the stacks of
+all threads at regular intervals and writes the report and a folded
+stack file that flamegraph.pl, speedscope or inferno can draw.
+'''
+
+import cProfile
+import io
+import pstats
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager, nullcontext
+
+
+# active profile, None when profiling is disabled
+_profile = None
+_null_stage = nullcontext()
+# other trackers notified of stages, i.e. memory.MemoryTracker,
+# objects with enter_stage(name) and exit_stage(name) methods
+_trackers = []
+
+
+class Profile:
+    """Stage timers and optional profiler for one command
+
+    Parameters
+    ----------
+    command : str
+        Name of the command being profiled
+    profiler : str, optional
+        'cprofile', 'sample' or None for stage timers only (default None)
+    output : str, optional
+        Prefix of the report files (default 'zen_profile')
+    interval : float, optional
+        Seconds between stack samples (default 0.005)
+    """
+
+    def __init__(self, command, profiler=None, output='zen_profile',
+                 interval=0.005):
+        self.command = command
+        self.profiler = profiler
+        self.output = output
+        self.interval = interval
+        # name: [calls, wall, cpu, child wall]
+        self.stages = defaultdict(lambda: [0, 0.0, 0.0, 0.0])
+        # stage stack of each thread, read by the sampler
+        self.stacks = defaultdict(list)
+        self.lock = threading.Lock()
+        self.samples = Counter()
+        self.start_time = time.perf_counter()
+        self._cprofile = None
+        self._sampler = None
+        self._stop = threading.Event()
+
+    def start(self):
+        if self.profiler == 'cprofile':
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+        elif self.profiler == 'sample':
+            self._sampler = threading.Thread(target=self._sample, daemon=True,
+                                             name='zen-sampler')
+            self._sampler.start()
+
+    @contextmanager
+    def stage(self, name):
+        stack = self.stacks[threading.get_ident()]
+        stack.append(name)
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = time.thread_time() - cpu
+            stack.pop()
+            with self.lock:
+                s = self.stages[name]
+                s[0] += 1
+                s[1] += wall
+                s[2] += cpu
+                if stack:
+                    self.stages[stack[-1]][3] += wall
+
+    def _sample(self):
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for tid, frame in sys._current_frames().items():
+                if tid == me:
+                    continue
+                funcs = []
+                while frame is not None:
+                    code = frame.f_code
+                    funcs.append(f"{code.co_filename.rsplit('/', 1)[-1]}:" +
+                                 f"{code.co_name}:{frame.f_lineno}")
+                    frame = frame.f_back
+                stages = [f"[{s}]" for s in list(self.stacks.get(tid, []))]
+                self.samples[";".join(stages + funcs[::-1])] += 1
+
+    def stop(self):
+        """Stop profilers and write the reports"""
+        elapsed = time.perf_counter() - self.start_time
+        if self._cprofile is not None:
+            self._cprofile.disable()
+            self._write_cprofile()
+        if self._sampler is not None:
+            self._stop.set()
+            self._sampler.join()
+            self._write_samples()
+        self.report(elapsed)
+
+    def report(self, elapsed, stream=None):
+        """Print the stage timers"""
+        stream = stream or sys.stderr
+        print(f"\n{self.command}: {elapsed:.3f} s", file=stream)
+        print(f"{'stage':20} {'calls':>8} {'wall s':>9} {'self s':>9} " +
+              f"{'cpu s':>9} {'% wall':>7}", file=stream)
+        for name, (calls, wall, cpu, child) in sorted(self.stages.items(),
+                key=lambda x: -x[1][1]):
+            print(f"{name:20} {calls:8d} {wall:9.3f} {wall-child:9.3f} " +
+                  f"{cpu:9.3f} {100*wall/elapsed if elapsed else 0:7.1f}",
+                  file=stream)
+
+    def _write_cprofile(self):
+        self._cprofile.dump_stats(f"{self.output}.prof")
+        out = io.StringIO()
+        stats = pstats.Stats(self._cprofile, stream=out)
+        stats.sort_stats('tottime').print_stats(40)
+        stats.sort_stats('cumulative').print_stats(40)
+        with open(f"{self.output}.txt", 'w') as f:
+            f.write(out.getvalue())
+        print(f"cProfile report in {self.output}.txt, " +
+              f"stats in {self.output}.prof", file=sys.stderr)
+
+    def _write_samples(self):
+        with open(f"{self.output}.folded", 'w') as f:
+            for stack, count in sorted(self.samples.items()):
+                f.write(f"{stack} {count}\n")
+        # self and total samples of each function
+        own = Counter()
+        total = Counter()
+        for stack, count in self.samples.items():
+            funcs = [s.rsplit(':', 1)[0] for s in stack.split(';')
+                     if not s.startswith('[')]
+            if funcs:
+                own[funcs[-1]] += count
+            for func in set(funcs):
+                total[func] += count
+        nsamples = sum(self.samples.values()) or 1
+        with open(f"{self.output}.txt", 'w') as f:
+            f.write(f"{nsamples} samples every {self.interval*1000:.1f} ms\n\n")
+            f.write(f"{'self %':>7} {'total %':>7}  function\n")
+            for func, count in own.most_common(40):
+                f.write(f"{100*count/nsamples:7.1f} " +
+                        f"{100*total[func]/nsamples:7.1f}  {func}\n")
+        print(f"Hot functions in {self.output}.txt, " +
+              f"flamegraph stacks in {self.output}.folded", file=sys.stderr)
+
+
+def start(command, profiler=None, output='zen_profile'):
+    """Start profiling a command and return the profile"""
+    global _profile
+    _profile = Profile(command, profiler, output)
+    _profile.start()
+    return _profile
+
+
+def stop():
+    """Stop profiling and write the reports"""
+    global _profile
+    if _profile is not None:
+        _profile.stop()
+    _profile = None
+
+
+def add_tracker(tracker):
+    """Notify tracker when stages start and end"""
+    _trackers.append(tracker)
+
+
+def remove_tracker(tracker):
+    """Stop notifying tracker of stages"""
+    _trackers.remove(tracker)
+
+
+@contextmanager
+def _tracked_stage(name):
+    for t in _trackers:
+        t.enter_stage(name)
+    try:
+        if _profile is None:
+            yield
+        else:
+            with _profile.stage(name):
+                yield
+    finally:
+        for t in reversed(_trackers):
+            t.exit_stage(name)
+
+
+def stage(name):
+    """Context manager timing a stage of the command when profiling"""
+    if _trackers:
+        return _tracked_stage(name)
+    if _profile is None:
+        return _null_stage
+    return _profile.stage(name)
+
+
+def timed_iter(iterable, name):
+    """Yield from iterable timing each step as stage name"""
+    it = iter(iterable)
+    while True:
+        with stage(name):
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+        yield item
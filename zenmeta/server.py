@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2021 ARC Centre of Excellence for Climate Extremes
+# author: Paola Petrelli <paola.petrelli@utas.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+'''
+Run zen commands in a long-running process listening on a Unix socket.
+
+"zen serve" starts the server. While it runs, "zen list", "zen meta"
+and "zen community" send their arguments and working directory to it
+and print its output, so they don't pay again for interpreter start,
+imports, vocabularies, tokens, community lookups and new connections
+to the api. Commands are run one at a time, in the client working
+directory. Set ZENMETA_NO_SERVER to always run commands locally.
+
+The server keeps tokens and vocabularies it read at start, restart it
+after changing them.
+'''
+
+import contextlib
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import sys
+from os.path import expanduser
+
+
+# commands that are sent to the server when it is running
+FORWARDED = ('list', 'meta', 'community')
+
+
+def socket_path():
+    """Return the server socket path, ~/.zenmeta.sock unless
+    ZENMETA_SOCKET is set
+    """
+    return os.environ.get('ZENMETA_SOCKET', expanduser('~/.zenmeta.sock'))
+
+
+def value_options(zen):
+    """Return the names of the zen group options followed by a value"""
+    import click
+    return {name for p in zen.params
+            if isinstance(p, click.Option) and not p.is_flag and not p.count
+            for name in p.opts + p.secondary_opts}
+
+
+def command_name(argv, zen):
+    """Return the zen command in a list of arguments, None if
+    there is no command
+    """
+    options = value_options(zen)
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg in options:
+            skip = True
+        elif not arg.startswith('-'):
+            return arg
+    return None
+
+
+def forward(argv, zen, path=None):
+    """Run a command with the server if it is running
+
+    Parameters
+    ----------
+    argv : list(str)
+        The zen command line arguments
+    zen : click.Group
+        The zen command group, to find the command in argv
+    path : str, optional
+        The server socket, if None use socket_path() (default None)
+
+    Returns
+    -------
+    code : int or None
+        The command exit code, None if the command should run locally
+    """
+    if os.environ.get('ZENMETA_NO_SERVER') or '--help' in argv:
+        return None
+    # most calls run without a server, check the socket first
+    path = path or socket_path()
+    if not os.path.exists(path) or command_name(argv, zen) not in FORWARDED:
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except (ConnectionRefusedError, FileNotFoundError):
+        # socket left behind by a server that is not running
+        sock.close()
+        return None
+    with sock, sock.makefile('rwb') as f:
+        request = {'argv': argv, 'cwd': os.getcwd()}
+        f.write(json.dumps(request).encode() + b"\n")
+        f.flush()
+        code = 1
+        for line in f:
+            msg = json.loads(line)
+            if 'exit' in msg:
+                code = msg['exit']
+                break
+            stream = sys.stdout if msg['stream'] == 'out' else sys.stderr
+            stream.write(msg['data'])
+            stream.flush()
+    return code
+
+
+class _StreamWriter:
+    """File-like object sending what is written to the client
+    as json lines tagged with the stream name
+    """
+
+    def __init__(self, wfile, stream):
+        self.wfile = wfile
+        self.stream = stream
+
+    def write(self, data):
+        if isinstance(data, bytes):
+            data = data.decode(errors='replace')
+        if data:
+            msg = {'stream': self.stream, 'data': data}
+            self.wfile.write(json.dumps(msg).encode() + b"\n")
+        return len(data)
+
+    def flush(self):
+        self.wfile.flush()
+
+    def isatty(self):
+        return False
+
+
+class ZenHandler(socketserver.StreamRequestHandler):
+    """Run the command sent by a client and send back its output"""
+
+    def handle(self):
+        import click
+        zen = self.server.zen
+        request = json.loads(self.rfile.readline())
+        log = self.server.log
+        log.info(f"Server running: zen {' '.join(request['argv'])}")
+        out = _StreamWriter(self.wfile, 'out')
+        err = _StreamWriter(self.wfile, 'err')
+        cwd = os.getcwd()
+        # --debug sets the level of the shared zen logger, restore it
+        # so it doesn't apply to the next clients
+        zen_log = logging.getLogger('zen_log')
+        level = zen_log.level
+        try:
+            os.chdir(request['cwd'])
+            with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+                try:
+                    zen.main(args=request['argv'], prog_name='zen',
+                             standalone_mode=False)
+                    code = 0
+                except click.exceptions.Exit as e:
+                    code = e.exit_code
+                except click.ClickException as e:
+                    e.show()
+                    code = e.exit_code
+                except click.exceptions.Abort:
+                    code = 1
+                except Exception as e:
+                    click.echo(f"ERROR: {e}")
+                    logging.getLogger('zen_debug').exception(e)
+                    code = 1
+        finally:
+            os.chdir(cwd)
+            zen_log.setLevel(level)
+        self.wfile.write(json.dumps({'exit': code}).encode() + b"\n")
+
+
+def server_alive(path):
+    """Return True if a server accepts connections on path"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.close()
+
+
+def serve(path, log, zen):
+    """Listen on a Unix socket and run commands sent by clients
+
+    Commands are handled one at a time, as they change the working
+    directory and standard output of the process.
+
+    Parameters
+    ----------
+    path : str
+        The socket path
+    log : logging.Logger
+        The zen logger
+    zen : click.Group
+        The zen command group run for each client
+    """
+    # warm-up: import the api modules, which the commands import when
+    # they run, and read the vocabularies, so the first client doesn't
+    # wait for them
+    import invenio
+    import zenodo
+    from util import read_vocab
+    for fname in ('affiliations.json', 'for_map.json', 'CI_RoleCode.json'):
+        read_vocab(fname)
+    zenodo.license_ids()
+
+    if os.path.exists(path):
+        if server_alive(path):
+            raise OSError(f"A server is already listening on {path}")
+        os.remove(path)
+    # the socket runs commands with the user tokens, only the
+    # user should be able to connect
+    old_umask = os.umask(0o177)
+    try:
+        server = socketserver.UnixStreamServer(path, ZenHandler)
+    finally:
+        os.umask(old_umask)
+    server.log = log
+    server.zen = zen
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    log.info(f"Server listening on {path}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(path)
+        log.info("Server stopped")
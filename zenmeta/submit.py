@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2021 ARC Centre of Excellence for Climate Extremes
+# author: Paola Petrelli <paola.petrelli@utas.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import logging
+from util import post_json
+import zjson
+from metrics import add_records
+from profiling import stage, timed_iter
+from zenodo import process_zenodo_plan, to_invenio
+from invenio import process_invenio_plan
+from model import Record
+from migrate import migration_chain, migrate_record
+
+
+def submit_plans(ctx, plans, skip=False, fromzen=False):
+    """Convert plans to records and post them to the api
+
+    Parameters
+    ----------
+    ctx: dict
+        Click context obj including api information, as set by setup_ctx
+    plans: iterable(dict or Record)
+        The plans to upload, invenio plans can be already converted to
+        Record objects by invenio.plan_record
+    skip: bool, optional
+        If True plans are records from a backup, only migrate them
+        to the latest schema (default False)
+    fromzen: bool, optional
+        If True plans are zenodo records, minimal processing (default False)
+
+    Returns
+    -------
+    nposted: int
+        Number of records posted successfully
+    nfailed: int
+        Number of records the api refused
+    """
+    token = ctx.obj['token']
+    zen_log = ctx.obj['log']
+    nposted = 0
+    nfailed = 0
+    # records from a backup are migrated to the latest schema
+    if skip and ctx.obj['portal'] != 'zenodo':
+        chain = migration_chain(9)
+    # process data for each plan and post records returned by process_plan()
+    for plan in timed_iter(plans, 'read'):
+        with stage('transform'):
+            if ctx.obj['portal'] == 'zenodo':
+                zen_log.info(plan['metadata']['title'])
+                if skip:
+                    record = plan
+                else:
+                    record = process_zenodo_plan(plan, ctx.obj['community_id'])
+            else:
+                if skip:
+                    record = migrate_record(plan, chain,
+                                            ctx.obj['community_id_db'])
+                elif fromzen:
+                    zen_log.info(plan['metadata']['title'])
+                    record = to_invenio(plan)
+                    if record == {}:
+                        zen_log.info('Skipping record')
+                        continue
+                elif isinstance(plan, Record):
+                    zen_log.info(plan.title)
+                    record = plan.to_json(ctx.obj['community_id_db'])
+                else:
+                    zen_log.info(plan['title'])
+                    record = process_invenio_plan(plan, ctx.obj['community_id_db'])
+        r = post_json(ctx.obj['url'], token, record, zen_log)
+        zen_log.debug("Request: %s", r.request)
+        zen_log.debug("Request url: %s", r.url)
+        # decoding the response for its id is skipped if not logged
+        if zen_log.isEnabledFor(logging.INFO):
+            zen_log.info(r.status_code, extra={'stage': 'post',
+                'record_id': _response_id(r), 'status': r.status_code,
+                'latency': round(r.elapsed.total_seconds(), 3)})
+        add_records(1)
+        if r.status_code >= 400:
+            nfailed += 1
+        else:
+            nposted += 1
+        #if ctx.obj['portal'] == "invenio" and ctx.obj['community_id_db'] != "":
+        #    r_review = submit_review(ctx, r.json()['id'])
+        #zen_log.debug(f"Review request: {r_review.request}") 
+        #zen_log.debug(f"Review request url: {r_review.url}") 
+        #zen_log.info(r_review.status_code) 
+    return nposted, nfailed
+
+
+def _response_id(r):
+    """Return the id of the record created, None if the request failed"""
+    if r.status_code >= 400:
+        return None
+    try:
+        return zjson.response_json(r).get('id', None)
+    except ValueError:
+        return None
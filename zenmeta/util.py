@@ -17,30 +17,85 @@
 
 import requests
 import json
+import atexit
 import logging
+import logging.handlers
 import os
+import queue
 import datetime as dt 
-from bs4 import BeautifulSoup
+import functools
+import io
 from os.path import expanduser
+from urllib3.util.retry import Retry
 from exception import ZenException
+from metrics import InstrumentedSession, InstrumentedAdapter
+from profiling import stage
+import zjson
 
 
-def config_log():
-    """Configure log file to keep track of activity"""
+# vocabularies are read relative to this file, so commands work
+# from any directory
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+
+# extra fields added to log lines when passed to the logger, i.e.
+# log.info("Posted", extra={'record_id': rid, 'latency': 0.2})
+LOG_FIELDS = ('record_id', 'stage', 'status', 'latency')
+
+
+class StructuredFormatter(logging.Formatter):
+    """Formatter appending the LOG_FIELDS present in a record
+    as key=value pairs
+    """
+
+    def format(self, record):
+        line = super().format(record)
+        fields = [f"{k}={getattr(record, k)}" for k in LOG_FIELDS
+                  if getattr(record, k, None) is not None]
+        if fields:
+            line += " [" + " ".join(fields) + "]"
+        return line
+
+
+def config_log(max_bytes=10*1024*1024, backups=5):
+    """Configure log file to keep track of activity
+
+    Log records are put on a queue and written to file by a background
+    thread, so logging doesn't block the command. The file is
+    ~/zenmeta_log.txt, or ZENMETA_LOG if set, and rotates when it
+    reaches max_bytes. Rotation is not safe with many zen processes
+    writing the same file, set ZENMETA_LOG for each of them instead.
+
+    Parameters
+    ----------
+    max_bytes : int, optional
+        Size of log file before rotating it (default 10 MB)
+    backups : int, optional
+        Number of rotated files kept (default 5)
+
+    Returns
+    -------
+    logger : logging.Logger
+        The zen_log logger
+    """
 
     # start a logger
+    logger = logging.getLogger('zen_log')
+    # already configured, i.e. by a previous command run by zen serve
+    if logger.handlers:
+        return logger
     for handler in logging.root.handlers[:]:
         logging.root.removeHandler(handler)
-    logger = logging.getLogger('zen_log')
     # set a formatter to manage the output format of our handler
-    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s',
-                                  "%Y-%m-%d %H:%M")
+    formatter = StructuredFormatter('%(asctime)s - %(levelname)s - %(message)s',
+                                    "%Y-%m-%d %H:%M")
     # set the level for the logger, has to be logging.LEVEL not a string
     # until we do so cleflog doesn't have a level and inherits the root
     # logger level:WARNING
     logger.setLevel(logging.INFO)
 
-    # add a handler to send WARNING level messages to console
+    # add a handler to send WARNING level messages to console,
+    # these are rare and should show up straight away
     clog = logging.StreamHandler()
     clog.setLevel(logging.WARNING)
     logger.addHandler(clog)
@@ -48,17 +103,25 @@ def config_log():
     # add a handler to send DEBUG/INFO level messages to file
     # use DEBUG level for file handler, if main log level is INFO
     # only INFO messages will pass has this filter is applied first
-    logname = expanduser(f'~/zenmeta_log.txt')
-
-    flog = logging.FileHandler(logname)
+    logname = os.environ.get('ZENMETA_LOG', expanduser('~/zenmeta_log.txt'))
+    flog = logging.handlers.RotatingFileHandler(logname, maxBytes=max_bytes,
+                                                backupCount=backups)
     flog.setLevel(logging.DEBUG)
     flog.setFormatter(formatter)
-    logger.addHandler(flog)
+    # the file is written by the listener thread
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, flog,
+                                              respect_handler_level=True)
+    listener.start()
+    # write what is left in the queue when the command ends
+    atexit.register(listener.stop)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
 
     # return the logger object
     return logger
 
 
+@functools.lru_cache(maxsize=None)
 def get_token(portal, production=False):
     """Read api authentication token for production/test api
         
@@ -84,6 +147,35 @@ def get_token(portal, production=False):
     return token
 
 
+@functools.lru_cache(maxsize=None)
+def api_session():
+    """Return the requests session shared by all api calls
+
+    Reusing one session keeps connections to the api open between
+    requests, this matters most when commands are run by zen serve
+    """
+    return InstrumentedSession()
+
+
+@functools.lru_cache(maxsize=None)
+def read_vocab(fname):
+    """Read a vocabulary json file from the data directory once
+    and return its content, the content must not be modified
+
+    Parameters
+    ----------
+    fname : str
+        The vocabulary file name, i.e. affiliations.json
+
+    Returns
+    -------
+    data : dict
+        The vocabulary
+    """
+    with stage('vocab'):
+        return read_json(os.path.join(DATA_DIR, fname))
+
+
 def read_json(fname):
     """ Read a json file and return content 
         
@@ -99,8 +191,8 @@ def read_json(fname):
     """
 
     try:
-        with open(fname, 'r') as f:
-            data = json.load(f)
+        with open(fname, 'rb') as f:
+            data = zjson.load(f)
     except:
         ZenException(f"Check that {fname} exists and it is a proper json file")
     return data
@@ -121,13 +213,180 @@ def write_json(data, fname='output.json'):
     """
 
     try:
-        with open(fname, 'w') as f:
-            json.dump(data, f, indent = 3)
+        with open(fname, 'w', encoding='utf-8') as f:
+            zjson.dump(data, f, indent=3)
     except:
         ZenException(f"Check that {data} exists and it is an object compatible with json")
     return 
 
 
+def read_state(fname):
+    """Read a state file, i.e. harvest high-water marks or processed files
+
+    Parameters
+    ----------
+    fname : str
+        Json state filename
+
+    Returns
+    -------
+    state : dict
+        The saved state, empty if the file doesn't exist
+    """
+    if not os.path.exists(fname):
+        return {}
+    with open(fname, 'rb') as f:
+        state = zjson.load(f)
+    return state
+
+
+def write_state(state, fname):
+    """Save a state file, the file is replaced only once written
+    completely so an interrupted run leaves the old state
+    """
+    tmpname = fname + '.tmp'
+    with open(tmpname, 'wb') as f:
+        f.write(zjson.dumpb(state, indent=2))
+    os.replace(tmpname, fname)
+    return
+
+
+def iter_json(fname, bufsize=65536):
+    """Read records one at a time from a json list or a json lines file
+
+    The file is read in chunks so only the record being decoded is kept
+    in memory, this works for backups written by write_json, for
+    json lines files where each line is one record and for archives
+    written by archive.py. Json lines are
+    decoded one line at a time with the fast backend in zjson, if a
+    record spans more than one line the rest of the file is decoded
+    as a stream of json objects.
+
+    Parameters
+    ----------
+    fname : str
+        Json or json lines filename, or archive directory
+    bufsize : int, optional
+        Number of characters read from file at each step (default 65536)
+
+    Yields
+    ------
+    record : dict
+        The next record in the file
+    """
+
+    if os.path.isdir(fname):
+        from archive import iter_archive
+        yield from iter_archive(fname)
+        return
+    with open(fname, 'r', encoding='utf-8') as f:
+        yield from _iter_file(f, fname, bufsize)
+
+
+def iter_json_data(data, name="<data>", bufsize=65536):
+    """Read records one at a time from json list or json lines bytes,
+    i.e. a file content already read, see iter_json
+
+    Parameters
+    ----------
+    data : bytes
+        Json list or json lines, utf-8 encoded
+    name : str, optional
+        Name of the source used in error messages (default "<data>")
+    bufsize : int, optional
+        Number of characters decoded at each step (default 65536)
+
+    Yields
+    ------
+    record : dict
+        The next record
+    """
+    yield from _iter_file(io.StringIO(data.decode('utf-8')), name, bufsize)
+
+
+def _iter_file(f, fname, bufsize):
+    """Decode the records in text file object f, see iter_json"""
+    buf = f.read(bufsize).lstrip()
+    # a json list is wrapped in [], json lines are simply concatenated
+    if buf.startswith('['):
+        yield from _iter_stream(f, fname, buf[1:], bufsize, True)
+        return
+    f.seek(0)
+    for line in f:
+        if line.isspace():
+            continue
+        try:
+            record = zjson.loads(line)
+        except ValueError:
+            yield from _iter_stream(f, fname, line, bufsize, False)
+            return
+        yield record
+
+
+def _iter_stream(f, fname, buf, bufsize, is_list):
+    """Decode json values from buf and the rest of file f, see iter_json"""
+
+    decoder = json.JSONDecoder()
+    eof = False
+    while True:
+        buf = buf.lstrip().lstrip(',').lstrip()
+        if is_list and buf.startswith(']'):
+            return
+        if buf == "":
+            if eof:
+                if is_list:
+                    raise ZenException(f"{fname} is not a complete json list")
+                return
+            buf = f.read(bufsize)
+            eof = buf == ""
+            continue
+        try:
+            record, end = decoder.raw_decode(buf)
+        except json.JSONDecodeError:
+            if eof:
+                raise ZenException(f"Check that {fname} is a proper json file")
+            chunk = f.read(bufsize)
+            eof = chunk == ""
+            buf += chunk
+            continue
+        yield record
+        buf = buf[end:]
+
+
+def write_json_stream(records, fname='output.json', indent=3):
+    """Write records to a json list as they are produced
+
+    The output has the same format of write_json but records are
+    written one at a time, so the full list is never held in memory
+
+    Parameters
+    ----------
+    records : iterable
+        The records to write, each one a json compatible object
+    fname : str
+        Json filename
+    indent : int, optional
+        Indentation passed to zjson.dumps (default 3)
+
+    Returns
+    -------
+    nrec : int
+        Number of records written
+    """
+
+    nrec = 0
+    with open(fname, 'w', encoding='utf-8') as f:
+        f.write('[')
+        for record in records:
+            if nrec > 0:
+                f.write(',')
+            f.write('\n')
+            f.write(zjson.dumps(record, indent=indent))
+            nrec += 1
+        f.write('\n]\n')
+    return nrec
+
+
 def read_xml(fname):
     """ Read a xml file and return content 
         
@@ -150,6 +409,58 @@ def read_xml(fname):
     return data
 
 
+def batches(records, size):
+    """Group records from an iterable in lists of size elements
+
+    Parameters
+    ----------
+    records : iterable
+        The records to group
+    size : int
+        Number of records in each list, the last one can be shorter
+
+    Yields
+    ------
+    batch : list
+        The next list of records
+    """
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def get_session(workers=10, retries=5):
+    """Return a requests session that reuses connections and retries
+    failed or throttled requests with exponential backoff
+
+    Parameters
+    ----------
+    workers : int, optional
+        Maximum number of connections kept open per host, should match
+        the number of threads using the session (default 10)
+    retries : int, optional
+        Maximum number of retries for each request (default 5)
+
+    Returns
+    -------
+    session : requests.Session
+        The configured session
+    """
+    retry = Retry(total=retries, backoff_factor=1,
+                  status_forcelist=[429, 500, 502, 503, 504],
+                  allowed_methods=["GET", "PUT", "DELETE"])
+    adapter = InstrumentedAdapter(pool_maxsize=workers, max_retries=retry)
+    session = InstrumentedSession()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
 def post_json(url, token, data, log):
     """ Post data to a json file
         
@@ -170,12 +481,16 @@ def post_json(url, token, data, log):
       The requests response object
     """
 
-    log.debug(f"Post request url: {url}")
+    log.debug("Post request url: %s", url)
     headers = {"Content-Type": "application/json"}
     params = {'access_token': token}
-    r = requests.post(url,
-            params=params, json=data,
-            headers=headers)
+    # encode here rather than with json= so encoding is timed apart
+    with stage('encode'):
+        body = zjson.dumpb(data)
+    with stage('network'):
+        r = api_session().post(url,
+                params=params, data=body,
+                headers=headers)
     if r.status_code >= 400:
         log.info(r.text)
     return r
@@ -201,12 +516,16 @@ def put_json(url, token, data, log):
       The requests response object
     """
 
-    log.debug(f"Post request url: {url}")
+    log.debug("Post request url: %s", url)
     headers = {"Content-Type": "application/json"}
     params = {'access_token': token}
-    r = requests.put(url,
-            params=params, json=data,
-            headers=headers)
+    # encode here rather than with json= so encoding is timed apart
+    with stage('encode'):
+        body = zjson.dumpb(data)
+    with stage('network'):
+        r = api_session().put(url,
+                params=params, data=body,
+                headers=headers)
     if r.status_code >= 400:
         log.info(r.text)
     return r
@@ -231,10 +550,10 @@ def get_bucket(url, token, record_id):
     """
 
     headers = {"Content-Type": "application/json"}
-    url += f"{record_id}"
-    r = requests.get(url, params={'access_token': token},
+    url += f"/{record_id}"
+    r = api_session().get(url, params={'access_token': token},
                      headers=headers)
-    return r.json()["links"]["bucket"]
+    return zjson.response_json(r)["links"]["bucket"]
 
 
 def extract_records(ctx, records, mode, lrids, user=False, draft=False):
@@ -347,20 +666,61 @@ def get_records(ctx, record_id=None, user=False, draft=False, mode='json'):
         elif ctx.obj['portal'] == "zenodo":
             params['status'] = "draft"
     # send request
-    r = requests.get(url, params=params,
-                     headers=headers[mode])
-    ctx.obj['log'].debug(f"{headers[mode]}")
-    ctx.obj['log'].debug(f"{params}")
-    ctx.obj['log'].debug(f"Request status code: {r.status_code}")
-    ctx.obj['log'].debug(f"Request url: {r.url}")
+    with stage('network'):
+        r = api_session().get(url, params=params,
+                         headers=headers[mode])
+    ctx.obj['log'].debug("%s", headers[mode])
+    ctx.obj['log'].debug("%s", params)
+    ctx.obj['log'].debug("Request status code: %s", r.status_code)
+    ctx.obj['log'].debug("Request url: %s", r.url)
     if mode in ['json', 'datacite-json', 'csl', 'vnd.zenodo.v1+json', 'ids']:
-        output = r.json()
+        output = zjson.response_json(r)
         # should differentiate ids from others!!!
     else:
         output = r.text
-    ctx.obj['log'].debug(f"Type of output returned: {type(output)}")
+    ctx.obj['log'].debug("Type of output returned: %s", type(output))
     return output
 
+def iter_records(ctx, user=False, draft=False, mode='json'):
+    """Yield the records of a get_records query page by page
+
+    Pages after the first are requested by following links.next, so
+    only one page of records is held at a time, i.e. while writing
+    them to an archive.
+
+    Parameters
+    ----------
+    ctx : Click Context obj
+        Including base url and cite url, community_id, portal and token info
+    user : bool, optional
+        If True retrieve all records for the user (default False)
+    draft : bool, optional
+        If True then retrieve only draft records (default False)
+    mode : str, optional
+        A json output mode, see get_records (default 'json')
+
+    Yields
+    ------
+    record : dict
+        The next record
+    """
+    page = get_records(ctx, user=user, draft=draft, mode=mode)
+    while True:
+        yield from page['hits']['hits']
+        next_url = page.get('links', {}).get('next', None)
+        if not next_url:
+            return
+        # the next link already includes the query parameters
+        with stage('network'):
+            r = api_session().get(next_url,
+                    params={'access_token': ctx.obj['token']},
+                    headers={"Content-Type": "application/json"})
+        ctx.obj['log'].debug("Request url: %s", r.url)
+        if r.status_code >= 400:
+            raise ZenException(f"Request failed: {r.status_code} {r.text}")
+        page = zjson.response_json(r)
+
+
 # https://zenodo.org/oai2d?verb=ListRecords&metadataPrefix=oai_datacite
 # for communities
 # https://zenodo.org/oai2d?verb=ListRecords&metadataPrefix=oai_datacite&set=user-cfa
@@ -381,7 +741,7 @@ def remove_record(ctx, record_id, safe):
     else:
         answer = 'Y'
     if answer == 'Y':
-        r = requests.delete(url,
+        r = api_session().delete(url,
                 params={'access_token': ctx.obj['token']},
                 headers=headers)
         if r.status_code == 204:
@@ -408,7 +768,7 @@ def convert_ror(affiliation):
     ror: str
         ROR id as recorded in invenio affiliations vocabulary
     """
-    rors = read_json("data/affiliations.json")
+    rors = read_vocab("affiliations.json")
     if affiliation == "University of New South Wales":
         affiliation = "UNSW Sydney"
     # intialise ror in case there is no match
@@ -434,7 +794,7 @@ def convert_for(code08):
         List of FOR2020 mappings (dictionaries) for input code
     """
     map_codes = []
-    codes20 = read_json("data/for_map.json")
+    codes20 = read_vocab("for_map.json")
     if isinstance(code08, int):
         map_codes = codes20[code08['code']]['codes_2020']
     else:
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2021 ARC Centre of Excellence for Climate Extremes
+# author: Paola Petrelli <paola.petrelli@utas.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+'''
+Watch a spool directory and upload plan files as they appear.
+
+New or modified json and json lines files are detected with inotify
+and uploaded once no more changes happen for the debounce time, so
+files still being written are not read. The content hash of each
+uploaded file is saved in a state file, a file is uploaded again only
+if its content changes. Files already in the directory when the watch
+starts are uploaded if they are not in the state.
+'''
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+from os.path import expanduser
+from cache import content_hash
+from util import read_state, write_state
+from exception import ZenException
+
+
+# inotify constants from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+EVENT_HEADER = struct.Struct('iIII')
+
+PLAN_SUFFIXES = ('.json', '.jsonl')
+
+
+class Inotify:
+    """Minimal inotify wrapper watching one directory"""
+
+    def __init__(self, path, mask=IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE):
+        libc_name = ctypes.util.find_library('c')
+        try:
+            libc = ctypes.CDLL(libc_name, use_errno=True)
+            init = libc.inotify_init1
+        except (OSError, AttributeError, TypeError):
+            raise ZenException("inotify is not available on this system")
+        self.fd = init(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        wd = libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, f"Cannot watch {path}: {os.strerror(err)}")
+
+    def fileno(self):
+        return self.fd
+
+    def read(self):
+        """Return list of (mask, name) for the events available"""
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+        events = []
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, pos)
+            pos += EVENT_HEADER.size
+            name = data[pos:pos+length].rstrip(b"\0")
+            pos += length
+            events.append((mask, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+def is_plan_file(name):
+    """Return True for json files, ignoring hidden and temporary files"""
+    return not name.startswith('.') and name.endswith(PLAN_SUFFIXES)
+
+
+def process_file(path, state, handler, log):
+    """Upload a file if its content is not in the state
+
+    The file is read once, the hash saved is of the same bytes passed
+    to the handler. If the handler fails the file is recorded as failed
+    and it is tried again only when its content changes.
+
+    Parameters
+    ----------
+    path : str
+        The plan file
+    state : dict
+        Processed files, {path: {'hash', 'posted', 'failed', 'time'}},
+        with 'error' instead of posted and failed if the upload failed
+    handler : function
+        Called with the file path and content, returns number of
+        records posted and failed
+    log : logging.Logger
+        The zen logger
+
+    Returns
+    -------
+    processed : bool
+        True if the state of the file changed
+    """
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return False
+    digest = content_hash(data)
+    if state.get(path, {}).get('hash', None) == digest:
+        log.debug("Watch: %s already processed", path)
+        return False
+    now = time.strftime('%Y-%m-%dT%H:%M:%S')
+    try:
+        posted, failed = handler(path, data)
+    except Exception as e:
+        # i.e. an incomplete file or a plan missing a key, skip the
+        # file until it changes rather than stopping the watch
+        log.warning(f"Watch: cannot process {path}: {e}", exc_info=True,
+                    extra={'stage': 'watch'})
+        state[path] = {'hash': digest, 'error': f"{type(e).__name__}: {e}",
+                       'time': now}
+        return True
+    state[path] = {'hash': digest, 'posted': posted, 'failed': failed,
+                   'time': now}
+    log.info(f"Watch: {path} posted {posted} records, {failed} failed",
+             extra={'stage': 'watch'})
+    return True
+
+
+def watch(path, handler, log, debounce=2.0, state_file=None):
+    """Upload plan files written to a directory until interrupted
+
+    Parameters
+    ----------
+    path : str
+        The directory to watch
+    handler : function
+        Called with a file path and its content, returns number of
+        records posted and failed
+    log : logging.Logger
+        The zen logger
+    debounce : float, optional
+        Seconds without changes before a file is read (default 2.0)
+    state_file : str, optional
+        File recording processed files, default ~/.zenmeta_watch_state.json
+    """
+    path = os.path.abspath(path)
+    if state_file is None:
+        state_file = expanduser('~/.zenmeta_watch_state.json')
+    state = read_state(state_file)
+    notifier = Inotify(path)
+    # pending files and the time they last changed, files already
+    # there are handled as if they just changed
+    pending = {os.path.join(path, name): time.monotonic()
+               for name in sorted(os.listdir(path)) if is_plan_file(name)}
+    log.info(f"Watching {path} for plan files")
+    try:
+        while True:
+            if pending:
+                timeout = max(0, min(pending.values()) + debounce - time.monotonic())
+            else:
+                timeout = None
+            ready, _, _ = select.select([notifier], [], [], timeout)
+            if ready:
+                for mask, name in notifier.read():
+                    if mask & IN_Q_OVERFLOW:
+                        # events were lost, check the whole directory
+                        for n in os.listdir(path):
+                            if is_plan_file(n):
+                                pending[os.path.join(path, n)] = time.monotonic()
+                    elif is_plan_file(name):
+                        pending[os.path.join(path, name)] = time.monotonic()
+            now = time.monotonic()
+            ready_files = sorted(f for f, t in pending.items() if now - t >= debounce)
+            for fname in ready_files:
+                del pending[fname]
+                if process_file(fname, state, handler, log):
+                    write_state(state, state_file)
+    finally:
+        notifier.close()
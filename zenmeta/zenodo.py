@@ -15,15 +15,25 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import requests
 import json
 import csv
+import functools
+import os
 from datetime import date
 from os.path import expanduser
-from util import convert_for, convert_ror
+from util import convert_for, convert_ror, api_session, DATA_DIR
+from model import RELATION_TYPES, RESOURCE_TYPES
 from exception import ZenException
 
 
+# to_invenio links the zenodo record with this title, which differs in
+# case from the shared vocabulary entry
+METADATA_FOR = {'id': "ismetadatafor", 'title': {'en': "Is Metadata for"}}
+
+# authors already processed, {name: creators}, upload_meta can load it from file
+authors = {}
+
+
 def set_zenodo(ctx, production):
     """Add Zenodo details: api urls, communities, to context object
 
@@ -44,11 +54,15 @@ def set_zenodo(ctx, production):
         base_url = "https://zenodo.org/api"
     else:
         base_url = "https://sandbox.zenodo.org/api"
+    # i.e. a local mock server for testing
+    if ctx.obj.get('api_url', None):
+        base_url = ctx.obj['api_url'].rstrip('/')
     # removing this for the moment as this doesn't filter based on user
     #can lead to list all the zenodo if used without
     ctx.obj['url'] = f"{base_url}/records"
     ctx.obj['deposit'] = f"{base_url}/deposit/depositions"
     ctx.obj['community'] = "&communities="
+    ctx.obj['oai'] = base_url.replace("/api", "/oai2d")
     return ctx
 
 
@@ -75,7 +89,7 @@ def upload_file(bucket_url, token, record_id, fpath):
 
     headers = {'Content-Type': "application/octet-stream"}
     with open(fpath, 'rb') as fp:
-        r = requests.put(
+        r = api_session().put(
             f"{bucket_url}/{fpath}",
             data=fp,
             params={'access_token': token},
@@ -276,7 +290,7 @@ def map_identifiers(idlist):
         #else:
             rel_ids.append( {'identifier': rid['identifier'],
                 'relation_type': {'id': rid['relation'].lower()},
-                'resource_type': {'id': "other-resource", 'title': {'en': "Other"}},
+                'resource_type': RESOURCE_TYPES['other-resource'],
                 'scheme': rid['scheme']} )
     #return rel_ids, alt_ids
     return rel_ids
@@ -308,14 +322,18 @@ def invenio_creator(record):
         'name': record['name'], 'type': "personal" }
     return new
 
+@functools.lru_cache(maxsize=None)
+def license_ids():
+    """Return the license ids in the invenio licenses vocabulary"""
+    with open(os.path.join(DATA_DIR, 'licenses.csv'), newline='') as csvfile:
+        reader = csv.reader(csvfile, delimiter=";")
+        return frozenset(row[0] for row in reader)
+
+
 def invenio_license(license):
     """
     """
-    licenses = [] 
-    with open('data/licenses.csv', newline='') as csvfile:
-        reader = csv.reader(csvfile, delimiter=";")
-        for row in reader:
-            licenses.append(row[0])
+    licenses = license_ids()
     if license.lower() in licenses:
         right = {'id': license.lower()} 
     else:
@@ -375,8 +393,8 @@ def to_invenio(plan):
     # zenodo url -> related_identifiers
     url = plan['links']['parent_html']
     rel_ids.append( {'identifier': url,
-         'relation_type': {'id': "ismetadatafor", 'title': {'en': "Is Metadata for"} },
-         'resource_type': {'id': "metadata", 'title': {'en': "Metadata record"}},
+         'relation_type': METADATA_FOR,
+         'resource_type': RESOURCE_TYPES['metadata'],
          'scheme': "url"} )
     # communities -> related_identifiers
     recognised_coms = ["arc-coe-clex-data", "arc-coe-clex"]
@@ -385,8 +403,8 @@ def to_invenio(plan):
         identifiers = [c['id'] for c in communities if c['id'] in recognised_coms]
         for comid in identifiers:
             rel_ids.append( {'identifier': f"https://zenodo.org/communities/{comid}",
-                   'relation_type': {'id': "ispartof", 'title': {'en': "Is part of"} },
-                   'resource_type': {'id': "service-portal", 'title': {'en': "Data portal"}},
+                   'relation_type': RELATION_TYPES['ispartof'],
+                   'resource_type': RESOURCE_TYPES['service-portal'],
                    'scheme': "url"} )
     # grants  -> grants?? related_identifiers
     # grants will be eventually a field in itslef for the moment add to related_identifiers
@@ -397,8 +415,8 @@ def to_invenio(plan):
         identifiers = [g['id'] for g in grants]
         for gid in identifiers:
             rel_ids.append( {'identifier': f"{gid}",
-                   'relation_type': {'id': "isrelatedto", 'title': {'en': "Is related to"} },
-                   'resource_type': {'id': "other-resource", 'title': {'en': "Other"}},
+                   'relation_type': RELATION_TYPES['isrelatedto'],
+                   'resource_type': RESOURCE_TYPES['other-resource'],
                    'scheme': "doi"} )
     meta['related_identifiers'] = rel_ids
 
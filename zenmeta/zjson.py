@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2021 ARC Centre of Excellence for Climate Extremes
+# author: Paola Petrelli <paola.petrelli@utas.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+'''
+Encode and decode json with orjson if it is installed, otherwise with
+the json module of the standard library.
+
+Both backends produce the same json, apart from whitespace: pretty
+output from orjson is always indented by 2 spaces, and NaN or infinite
+floats are encoded as null by orjson while the json module writes them
+as NaN and Infinity, as it always did here, although they are not valid
+json.
+'''
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+BACKEND = 'orjson' if orjson else 'json'
+
+
+def dumpb(obj, indent=None, sort_keys=False):
+    """Encode obj as json bytes, i.e. to send as a request body
+
+    Parameters
+    ----------
+    obj : json compatible object
+        The object to encode
+    indent : int, optional
+        Pretty print with this indentation, if None the output is
+        compact (default None)
+    sort_keys : bool, optional
+        Sort keys of objects, so equal objects give the same bytes,
+        i.e. to hash them (default False)
+
+    Returns
+    -------
+    data : bytes
+        The utf-8 encoded json
+    """
+    if orjson:
+        option = orjson.OPT_NON_STR_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, option=option)
+    return dumps(obj, indent=indent, sort_keys=sort_keys).encode()
+
+
+def dumps(obj, indent=None, sort_keys=False):
+    """Encode obj as a json string, see dumpb"""
+    if orjson:
+        return dumpb(obj, indent=indent, sort_keys=sort_keys).decode()
+    if indent:
+        return json.dumps(obj, indent=indent, ensure_ascii=False,
+                          sort_keys=sort_keys)
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False,
+                      sort_keys=sort_keys)
+
+
+def loads(data):
+    """Decode a json string or bytes
+
+    Raises json.JSONDecodeError, a ValueError, if data is not valid json
+    """
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dump(obj, f, indent=None):
+    """Write obj as json to a text file object, see dumpb"""
+    f.write(dumps(obj, indent=indent))
+
+
+def load(f):
+    """Read json from a text or binary file object"""
+    return loads(f.read())
+
+
+def response_json(r):
+    """Decode the body of a requests response, as r.json() does"""
+    return loads(r.content)